@@ -108,6 +108,12 @@ export const useCurrentProjectStore = defineStore('currentProject', () => {
 
             const message = event.data as string;
 
+            // heartbeat, the server disconnects silent clients
+            if (message.startsWith('ping ')) {
+                newSocket.send('pong null');
+                return;
+            }
+
             // first connect message
             if (message.startsWith('[')) {
                 elements.value = [];
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Iterable, Optional, Union
+
+from fastapi import WebSocket
+from server.projects.content import COMMANDS
+from server.root.metrics import counter, gauge, histogram
+from server.root.settings import OUTBOX_POLICY, OUTBOX_SIZE
+from starlette import status
+
+outbox_messages = gauge("outbox_messages")
+outbox_dropped = counter("outbox_dropped")
+outbox_coalesced = counter("outbox_coalesced")
+outbox_disconnected = counter("outbox_disconnected")
+send_latency = histogram("send_latency_seconds")
+
+
+class Connection:
+    """
+    Client socket with a bounded outbound queue.
+
+    Messages are only queued by the room,
+    a dedicated task writes them to the socket,
+    so a slow client delays nobody but itself.
+    When the queue is full the policy decides what to do:
+    "drop" discards the new message,
+    "coalesce" merges queued updates of the same element
+    and queued presence states, and disconnects if that is not enough,
+    "disconnect" closes the socket, the client reconnects
+    and receives the actual document.
+    Lossy messages are dropped by any policy.
+
+    A large document is streamed: every chunk is produced
+    only after the previous one is written,
+    other messages are held until the stream ends.
+    """
+
+    def __init__(
+        self,
+        socket: WebSocket,
+        size: int = OUTBOX_SIZE,
+        policy: str = OUTBOX_POLICY,
+    ) -> None:
+        """
+        Initializes a new instance of the Connection class.
+
+        Args:
+            socket: client socket.
+            size: max amount of queued messages.
+            policy: one of drop, coalesce or disconnect.
+        """
+
+        self.socket = socket
+        self.size = size
+        self.policy = policy
+
+        self.queue: deque[tuple[Union[str, bytes], float]] = deque()
+        # Time of the last frame of the client.
+        self.received = time.monotonic()
+        self.overflowed = False
+        self.closed = False
+        # Code to close the socket with, set when the server disconnects.
+        self.close_code: Optional[int] = None
+        self.held: Optional[list[Union[str, bytes]]] = None
+
+        self._ready = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._writer: Optional[asyncio.Task] = None
+        self._streamer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """
+        Starts writing queued messages to the socket.
+
+        Returns:
+            None.
+        """
+
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    def send(self, message: Union[str, bytes], lossy: bool = False) -> None:
+        """
+        Queues a message without waiting for the socket.
+
+        Args:
+            message: text or binary message to send.
+            lossy: drop the message instead of overflowing the queue.
+
+        Returns:
+            None.
+        """
+
+        if self.overflowed or self.closed:
+            return
+
+        if self.held is not None:
+            if len(self.held) < self.size:
+                self.held.append(message)
+            elif lossy:
+                outbox_dropped.inc()
+            else:
+                self._overflow()
+            return
+
+        self._enqueue(message, lossy)
+
+    def stream(self, messages: Iterable[Union[str, bytes]]) -> None:
+        """
+        Sends lazily produced messages one by one,
+        messages sent meanwhile are held until all of them are written.
+
+        Args:
+            messages: text or binary messages to send.
+
+        Returns:
+            None.
+        """
+
+        self.held = []
+        self._streamer = asyncio.create_task(self._stream(messages))
+
+    def disconnect(self, code: int = status.WS_1013_TRY_AGAIN_LATER) -> None:
+        """
+        Discards queued messages and closes the socket,
+        the handler of the client sees the disconnect.
+
+        Args:
+            code: websocket close code.
+
+        Returns:
+            None.
+        """
+
+        self._discard()
+        self.close_code = code
+        self._ready.set()
+
+    async def close(self) -> None:
+        """
+        Stops the writer, queued messages are discarded.
+
+        Returns:
+            None.
+        """
+
+        for task in (self._writer, self._streamer):
+            if task is not None:
+                task.cancel()
+        self._writer = self._streamer = None
+
+        self._discard()
+
+    def _enqueue(self, message: Union[str, bytes], lossy: bool = False) -> None:
+        if len(self.queue) >= self.size:
+            policy = "drop" if lossy else self.policy
+            match policy:
+                case "drop":
+                    outbox_dropped.inc()
+                    return
+                case "coalesce":
+                    self._coalesce()
+
+            if len(self.queue) >= self.size:
+                self._overflow()
+                return
+
+        self.queue.append((message, time.perf_counter()))
+        outbox_messages.inc()
+        self._drained.clear()
+        self._ready.set()
+
+    def _discard(self) -> None:
+        self.closed = True
+        outbox_messages.dec(len(self.queue))
+        self.queue.clear()
+        self._drained.set()
+
+    def _overflow(self) -> None:
+        outbox_disconnected.inc()
+        self.overflowed = True
+        self.disconnect()
+
+    def _coalesce(self) -> None:
+        items = []
+        merged_items = {}
+
+        for message, queued_at in self.queue:
+            # Frames stamped with sequence numbers are never merged,
+            # the client would miss the numbers of merged ones.
+            # Binary clients receive no text frames at all.
+            if isinstance(message, bytes):
+                items.append((message, queued_at))
+                continue
+
+            command, _, data = message.partition(" ")
+            if command not in ("update", "presence"):
+                items.append((message, queued_at))
+                # Updates are merged only across frames of other elements,
+                # frames of unknown elements end every merge.
+                if command in COMMANDS:
+                    merged_items.pop(("update", json.loads(data)["id"]), None)
+                else:
+                    merged_items = {
+                        key: merged
+                        for key, merged in merged_items.items()
+                        if key[0] != "update"
+                    }
+                continue
+
+            # Later states of the users replace earlier ones.
+            payload = json.loads(data)
+            key = (command, payload["id"] if command == "update" else None)
+            merged = merged_items.get(key)
+            if merged is None:
+                merged_items[key] = payload
+                items.append(((command, payload), queued_at))
+            else:
+                merged.update(payload)
+
+        outbox_coalesced.inc(len(self.queue) - len(items))
+        outbox_messages.dec(len(self.queue) - len(items))
+
+        self.queue = deque(
+            (
+                (item, queued_at)
+                if not isinstance(item, tuple)
+                else (f"{item[0]} {json.dumps(item[1])}", queued_at)
+            )
+            for item, queued_at in items
+        )
+
+    async def _write(self) -> None:
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            if self.close_code is not None:
+                try:
+                    await self.socket.close(code=self.close_code)
+                except Exception:
+                    pass
+                return
+
+            while self.queue:
+                message, queued_at = self.queue.popleft()
+                outbox_messages.dec()
+
+                try:
+                    if isinstance(message, bytes):
+                        await self.socket.send_bytes(message)
+                    else:
+                        await self.socket.send_text(message)
+                except Exception:
+                    # The handler of the client sees the disconnect.
+                    self._discard()
+                    return
+
+                send_latency.observe(time.perf_counter() - queued_at)
+
+            self._drained.set()
+
+    async def _stream(self, messages: Iterable[Union[str, bytes]]) -> None:
+        messages = iter(messages)
+
+        # The next message is produced once the previous one is written.
+        while True:
+            await self._drained.wait()
+            if self.overflowed or self.closed:
+                return
+
+            message = next(messages, None)
+            if message is None:
+                break
+            self._enqueue(message)
+
+        held, self.held = self.held, None
+        for message in held:
+            self.send(message)
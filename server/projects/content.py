@@ -1,13 +1,18 @@
-def create(content_list, element_data):
-    # TODO: need check id
-    id = element_data["id"]
+import sys
+from collections import deque
+from typing import Hashable, Iterable, Iterator, Optional
 
-    if any(e["id"] == id for e in content_list):
-        return
+from server.root.codec import dumps, loads
+from server.root.settings import HISTORY_SIZE
 
-    content_list.append(element_data)
+COMMANDS = ("create", "update", "put", "delete")
 
-    return content_list
+# Commands changing the structure of the tree, expanded by the document
+# into the basic commands against its current state.
+STRUCTURAL = ("duplicate", "group", "ungroup", "reparent")
+
+# Estimated memory of the index entries of an element.
+INDEX_BYTES = 400
 
 
 def _is_default(value) -> bool:
@@ -30,6 +35,49 @@ def _is_default(value) -> bool:
     return False # TODO: is None is False for every type?
 
 
+def _estimate(element: dict) -> int:
+    """
+    Estimates memory used by the element in a document,
+    nested values are counted only by their own size.
+
+    Args:
+        element: element data.
+
+    Returns:
+        int: size in bytes.
+    """
+
+    return (
+        INDEX_BYTES
+        + sys.getsizeof(element)
+        + sum(sys.getsizeof(value) for value in element.values())
+    )
+
+
+def _offset(element: dict, origin: dict, sign: int) -> dict:
+    """
+    Moves the position of the element by the position of another one.
+
+    Args:
+        element: element data.
+        origin: element data with the offset.
+        sign: 1 to add the offset, -1 to subtract it.
+
+    Returns:
+        dict: changed x and y, empty if the offset is zero.
+    """
+
+    return {
+        key: element.get(key, 0) + sign * origin[key]
+        for key in ("x", "y")
+        if origin.get(key)
+        and all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in (origin[key], element.get(key, 0))
+        )
+    }
+
+
 def _remove_defaults(data: dict) -> dict:
     """
     Removes default values from data.
@@ -50,49 +98,636 @@ def _remove_defaults(data: dict) -> dict:
     return undefaulted
 
 
-def update(content_list, element_data):
-    for i, element in enumerate(content_list):
-        if element["id"] == element_data["id"]:
-            for key, value in element_data.items():
-                content_list[i][key] = value
-            content_list[i] = _remove_defaults(content_list[i])
-            break
+class Document:
+    """
+    Project content as an indexed tree of elements.
 
-    return content_list
+    Keeps an id to element map, a parent to children index
+    and a doubly linked list with the order of the elements,
+    so every operation runs in constant time
+    (delete is linear in the size of the removed subtree).
+    Serializes to the same JSON array that is stored in Project.content.
 
+    Also tracks ids of the elements changed since the document
+    was stored element-wise, an element is changed
+    when its data or its previous element changes.
 
-def put(content_list, element_data):
-    foundIndex = next(
-        (i for i, e in enumerate(content_list) if e["id"] == element_data["id"]), None
-    )
-    if foundIndex is None:
-        return
-    found = content_list[foundIndex]
-    temp = content_list[:foundIndex] + content_list[foundIndex + 1 :]
-
-    newIndex = 0
-    if "after" in element_data:
-        whomIndex = next(
-            (i for i, e in enumerate(temp) if e["id"] == element_data["after"]), None
-        )
-        if whomIndex is None:
+    Applied batches can provide operations reverting them,
+    a deleted subtree is restored with its order.
+
+    Memory used by the elements is estimated as they change.
+
+    Structural commands are expanded into the basic ones
+    in a single pass over the affected part of the tree.
+    """
+
+    def __init__(self, elements: Iterable[dict] = ()) -> None:
+        """
+        Initializes a new instance of the Document class.
+
+        Args:
+            elements: elements in the document order.
+        """
+
+        self.elements: dict[Hashable, dict] = {}
+        self.children: dict[Optional[Hashable], dict[Hashable, None]] = {}
+
+        # None is a sentinel: _next[None] is the first element,
+        # _prev[None] is the last one.
+        self._next: dict[Optional[Hashable], Optional[Hashable]] = {None: None}
+        self._prev: dict[Optional[Hashable], Optional[Hashable]] = {None: None}
+
+        # None means none of the elements is stored.
+        self.dirty: Optional[set[Hashable]] = None
+        # Estimated memory of the elements in bytes.
+        self.size = 0
+
+        for element in elements:
+            self.create(element)
+
+    @classmethod
+    def loads(cls, data: str) -> "Document":
+        """
+        Builds a document from the JSON array.
+
+        Args:
+            data: JSON array of elements as stored in Project.content.
+
+        Returns:
+            Document: new document.
+        """
+
+        return cls(loads(data))
+
+    def dumps(self) -> str:
+        """
+        Serializes the document to the JSON array.
+
+        Returns:
+            str: JSON array of elements in the document order.
+        """
+
+        return dumps(self.to_list())
+
+    def to_list(self) -> list[dict]:
+        """
+        Provides elements in the document order.
+
+        Returns:
+            list[dict]: elements.
+        """
+
+        return list(self)
+
+    def __iter__(self) -> Iterator[dict]:
+        id = self._next[None]
+        while id is not None:
+            yield self.elements[id]
+            id = self._next[id]
+
+    def __len__(self) -> int:
+        return len(self.elements)
+
+    def __contains__(self, id: Hashable) -> bool:
+        return id in self.elements
+
+    def get(self, id: Hashable) -> Optional[dict]:
+        """
+        Provides an element by id.
+
+        Args:
+            id: element id.
+
+        Returns:
+            Optional[dict]: element if found, None otherwise.
+        """
+
+        return self.elements.get(id)
+
+    def previous(self, id: Hashable) -> Optional[Hashable]:
+        """
+        Provides id of the element right before another one.
+
+        Args:
+            id: element id.
+
+        Returns:
+            Optional[Hashable]: previous element id,
+            None for the first element.
+        """
+
+        return self._prev[id]
+
+    def descendants(self, id: Hashable) -> list[Hashable]:
+        """
+        Provides ids of all descendants of the element.
+
+        Args:
+            id: element id.
+
+        Returns:
+            list[Hashable]: descendants ids, parents before their children.
+        """
+
+        found = []
+        visited = {id}
+        stack = list(reversed(self.children.get(id, ())))
+
+        while stack:
+            child = stack.pop()
+            if child in visited:
+                continue
+            visited.add(child)
+            found.append(child)
+            stack.extend(reversed(self.children.get(child, ())))
+
+        return found
+
+    def apply(self, command: str, element_data: dict) -> bool:
+        """
+        Applies a socket command to the document.
+
+        Args:
+            command: one of create, update, put or delete.
+            element_data: command payload with element id.
+
+        Returns:
+            bool: True if the document was changed, False otherwise.
+
+        Raises:
+            ValueError: if the command is unknown.
+        """
+
+        match command:
+            case "create":
+                return self.create(element_data)
+            case "update":
+                return self.update(element_data)
+            case "delete":
+                return self.delete(element_data["id"])
+            case "put":
+                return self.put(element_data)
+            case _:
+                raise ValueError(f"Invalid command {command}.")
+
+    def apply_batch(
+        self,
+        operations: list[tuple[str, dict]],
+        inverse: Optional[list[tuple[str, dict]]] = None,
+    ) -> int:
+        """
+        Applies several socket commands to the document at once.
+
+        Args:
+            operations: pairs of command and element data,
+            validated beforehand, so either all of them are applied
+            or the document is untouched.
+            inverse: list to extend with operations reverting
+            the applied ones, if needed.
+
+        Returns:
+            int: amount of operations that changed the document.
+
+        Raises:
+            ValueError: if any of the commands is unknown.
+        """
+
+        for command, _ in operations:
+            if command not in COMMANDS:
+                raise ValueError(f"Invalid command {command}.")
+
+        if inverse is None:
+            return sum(
+                self.apply(command, element_data)
+                for command, element_data in operations
+            )
+
+        # Every operation is reverted against the state it was applied to.
+        steps = []
+        for command, element_data in operations:
+            step = self.inverse(command, element_data)
+            if self.apply(command, element_data):
+                steps.append(step)
+
+        inverse.extend(operation for step in reversed(steps) for operation in step)
+
+        return len(steps)
+
+    def inverse(self, command: str, element_data: dict) -> list[tuple[str, dict]]:
+        """
+        Provides operations reverting a socket command,
+        called before the command is applied.
+
+        Args:
+            command: one of create, update, put or delete.
+            element_data: command payload with element id.
+
+        Returns:
+            list[tuple[str, dict]]: pairs of command and element data,
+            empty if the command changes nothing.
+        """
+
+        id = element_data["id"]
+        element = self.elements.get(id)
+
+        match command:
+            case "create" if element is None:
+                return [("delete", {"id": id})]
+            case "update" if element is not None:
+                # Missing attributes are removed by null values.
+                return [("update", {key: element.get(key) for key in element_data})]
+            case "put" if element is not None:
+                return [("put", {"id": id, "after": self._prev[id]})]
+            case "delete" if element is not None:
+                return self._recreate([id] + self.descendants(id))
+            case _:
+                return []
+
+    def expand(self, operations: list[tuple[str, dict]]) -> list[tuple[str, dict]]:
+        """
+        Replaces structural commands with the basic ones,
+        called before the operations are applied.
+
+        A structural command is expanded against the current state,
+        so it is the only one in its frame.
+
+        Args:
+            operations: pairs of command and element data.
+
+        Returns:
+            list[tuple[str, dict]]: pairs of basic command and element data.
+        """
+
+        found = []
+
+        for command, payload in operations:
+            match command:
+                case "duplicate":
+                    found.extend(self._duplicate(payload["id"], payload["ids"]))
+                case "group":
+                    found.extend(self._group(payload))
+                case "ungroup":
+                    found.extend(self._ungroup(payload["id"]))
+                case "reparent":
+                    found.extend(self._reparent(payload["ids"], payload.get("parent")))
+                case _:
+                    found.append((command, payload))
+
+        return found
+
+    def create(self, element_data: dict) -> bool:
+        """
+        Appends a new element to the end of the document.
+
+        Args:
+            element_data: element data with id.
+
+        Returns:
+            bool: True if the element was created,
+            False if an element with the same id already exists.
+        """
+
+        # TODO: need check id
+        id = element_data["id"]
+
+        if id in self.elements:
+            return False
+
+        element = dict(element_data)
+        self.elements[id] = element
+        self.size += _estimate(element)
+        self._link_after(id, self._prev[None])
+        self._attach(id, element.get("parent"))
+
+        return True
+
+    def update(self, element_data: dict) -> bool:
+        """
+        Updates element attributes, removing the default ones.
+
+        Args:
+            element_data: element id and attributes to update.
+
+        Returns:
+            bool: True if the element was updated, False if not found.
+        """
+
+        id = element_data["id"]
+
+        element = self.elements.get(id)
+        if element is None:
+            return False
+
+        parent = element.get("parent")
+        self.size -= _estimate(element)
+
+        # Elements are replaced, not changed,
+        # so they can be serialized after the update.
+        element = _remove_defaults(element | element_data)
+        self.elements[id] = element
+        self.size += _estimate(element)
+        self._mark(id)
+
+        if element.get("parent") != parent:
+            self._detach(id, parent)
+            self._attach(id, element.get("parent"))
+
+        return True
+
+    def put(self, element_data: dict) -> bool:
+        """
+        Moves the element right after another one
+        or to the beginning of the document.
+
+        Args:
+            element_data: element id and optional id of the element
+            to put after.
+
+        Returns:
+            bool: True if the element was moved,
+            False if any of the elements is not found.
+        """
+
+        id = element_data["id"]
+        if id not in self.elements:
+            return False
+
+        after = element_data.get("after")
+        if after is not None and (after == id or after not in self.elements):
+            return False
+
+        self._unlink(id)
+        self._link_after(id, after)
+
+        return True
+
+    def delete(self, id: Hashable) -> bool:
+        """
+        Deletes the element with all of its descendants.
+
+        Args:
+            id: element id.
+
+        Returns:
+            bool: True if anything was deleted, False otherwise.
+        """
+
+        removed = ([id] if id in self.elements else []) + self.descendants(id)
+
+        for removed_id in removed:
+            element = self.elements.pop(removed_id)
+            self.size -= _estimate(element)
+            self._unlink(removed_id)
+            self._detach(removed_id, element.get("parent"))
+
+        self.children.pop(id, None)
+        for removed_id in removed:
+            self.children.pop(removed_id, None)
+
+        return bool(removed)
+
+    def _duplicate(
+        self,
+        source: Hashable,
+        ids: list[list[Hashable]],
+    ) -> list[tuple[str, dict]]:
+        # Copies are appended with the ids they are mapped to,
+        # elements without a free id are skipped with their descendants.
+        mapping = dict(map(tuple, ids))
+        copied = {}
+        used = set()
+        found = []
+        stack = [source]
+
+        while stack:
+            id = stack.pop()
+            new = mapping.get(id)
+            if id in copied or id not in self.elements or new is None:
+                continue
+            if new in self.elements or new in used:
+                continue
+
+            element = self.elements[id] | {"id": new}
+            if id != source:
+                element["parent"] = copied[element["parent"]]
+            copied[id] = new
+            used.add(new)
+            found.append(("create", element))
+            stack.extend(reversed(self.children.get(id, ())))
+
+        return found
+
+    def _group(self, element_data: dict) -> list[tuple[str, dict]]:
+        # The group takes the place of the first member under its parent,
+        # members keep their place on the canvas. Positions are relative
+        # to parents, so only siblings of the first member are grouped.
+        id = element_data["id"]
+        members = [
+            member
+            for member in dict.fromkeys(element_data["ids"])
+            if member != id and member in self.elements
+        ]
+        if id in self.elements or not members:
+            return []
+
+        group = {key: value for key, value in element_data.items() if key != "ids"}
+        parent = self.elements[members[0]].get("parent")
+        if parent is not None:
+            group["parent"] = parent
+
+        found = [
+            ("create", group),
+            ("put", {"id": id, "after": self._prev[members[0]]}),
+        ]
+        for member in members:
+            if self.elements[member].get("parent") == parent:
+                data = _offset(self.elements[member], group, -1)
+                found.append(("update", {"id": member, "parent": id} | data))
+
+        return found
+
+    def _ungroup(self, id: Hashable) -> list[tuple[str, dict]]:
+        # Children are moved to the parent of the group,
+        # which is deleted then. Elements without children aren't groups.
+        group = self.elements.get(id)
+        if group is None or not self.children.get(id):
+            return []
+
+        parent = group.get("parent")
+        found = []
+        for child in self.children.get(id, ()):
+            data = _offset(self.elements[child], group, 1)
+            found.append(("update", {"id": child, "parent": parent} | data))
+        found.append(("delete", {"id": id}))
+
+        return found
+
+    def _reparent(
+        self,
+        ids: list[Hashable],
+        parent: Optional[Hashable],
+    ) -> list[tuple[str, dict]]:
+        # Elements can't be moved under themselves or their descendants.
+        if parent is not None and parent not in self.elements:
+            return []
+
+        ancestors = self._ancestors(parent)
+
+        return [
+            ("update", {"id": id, "parent": parent})
+            for id in dict.fromkeys(ids)
+            if id in self.elements
+            and id not in ancestors
+            and self.elements[id].get("parent") != parent
+        ]
+
+    def _ancestors(self, id: Optional[Hashable]) -> set[Hashable]:
+        found = set()
+        while id in self.elements and id not in found:
+            found.add(id)
+            id = self.elements[id].get("parent")
+
+        return found
+
+    def _recreate(self, ids: list[Hashable]) -> list[tuple[str, dict]]:
+        # Elements are created at the end, then put after the previous ones,
+        # which are restored first if they are removed too.
+        removed = set(ids)
+        restored = set()
+        found = []
+
+        for start in ids:
+            chain = []
+            id = start
+            while id in removed and id not in restored:
+                restored.add(id)
+                chain.append(id)
+                id = self._prev[id]
+
+            for id in reversed(chain):
+                found.append(("create", self.elements[id]))
+                found.append(("put", {"id": id, "after": self._prev[id]}))
+
+        return found
+
+    def _link_after(self, id: Hashable, after: Optional[Hashable]) -> None:
+        following = self._next[after]
+        self._next[after] = id
+        self._prev[id] = after
+        self._next[id] = following
+        self._prev[following] = id
+        self._mark(id)
+        self._mark(following)
+
+    def _unlink(self, id: Hashable) -> None:
+        previous = self._prev.pop(id)
+        following = self._next.pop(id)
+        self._next[previous] = following
+        self._prev[following] = previous
+        self._mark(id)
+        self._mark(following)
+
+    def _mark(self, id: Optional[Hashable]) -> None:
+        if self.dirty is not None and id is not None:
+            self.dirty.add(id)
+
+    def _attach(self, id: Hashable, parent: Optional[Hashable]) -> None:
+        self.children.setdefault(parent, {})[id] = None
+
+    def _detach(self, id: Hashable, parent: Optional[Hashable]) -> None:
+        siblings = self.children.get(parent)
+        if siblings is None:
+            return
+
+        siblings.pop(id, None)
+        if not siblings:
+            del self.children[parent]
+
+
+class History:
+    """
+    Undo and redo stacks of a user editing a document.
+
+    Entries are operations reverting changes of the user.
+    The stacks are bounded by the size of the entries as JSON,
+    the oldest entries are forgotten first.
+    """
+
+    def __init__(self, size: int = HISTORY_SIZE) -> None:
+        """
+        Initializes a new instance of the History class.
+
+        Args:
+            size: max size of all entries as JSON.
+        """
+
+        self.size = size
+        self.used = 0
+        self.undo: deque[tuple[list[tuple[str, dict]], int]] = deque()
+        self.redo: deque[tuple[list[tuple[str, dict]], int]] = deque()
+
+    def record(
+        self,
+        operations: list[tuple[str, dict]],
+        command: Optional[str] = None,
+    ) -> None:
+        """
+        Adds operations reverting an applied change.
+
+        Args:
+            operations: pairs of command and element data.
+            command: undo or redo if the change reverted an entry,
+            None if it is a new change, it forgets undone entries.
+
+        Returns:
+            None.
+        """
+
+        if not operations:
             return
-        newIndex = whomIndex + 1
 
-    return temp[:newIndex] + [found] + temp[newIndex:]
+        match command:
+            case "undo":
+                stack = self.redo
+            case "redo":
+                stack = self.undo
+            case _:
+                stack = self.undo
+                self.used -= sum(size for _, size in self.redo)
+                self.redo.clear()
+
+        size = len(dumps(operations))
+        if size > self.size:
+            # Older entries can't be reverted without this one.
+            self.used = 0
+            self.undo.clear()
+            self.redo.clear()
+            return
+
+        stack.append((operations, size))
+        self.used += size
+
+        while self.used > self.size:
+            oldest = self.undo if self.undo else self.redo
+            self.used -= oldest.popleft()[1]
+
+    def pop(self, command: str) -> Optional[list[tuple[str, dict]]]:
+        """
+        Takes the latest entry to apply.
 
+        Args:
+            command: undo or redo.
 
-def delete(elements, id):
-    def find_descendants(id):
-        return [element["id"] for element in elements if element.get("parent") == id]
+        Returns:
+            Optional[list[tuple[str, dict]]]: pairs of command
+            and element data, None if there is nothing to revert.
+        """
 
-    def delete_recursive(id):
-        descendants = find_descendants(id)
-        for descendant in descendants:
-            delete_recursive(descendant)
-        nonlocal elements
-        elements = [element for element in elements if element["id"] != id]
+        stack = self.undo if command == "undo" else self.redo
+        if not stack:
+            return None
 
-    delete_recursive(id)
+        operations, size = stack.pop()
+        self.used -= size
 
-    return elements
+        return operations
@@ -0,0 +1,251 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from server.projects.content import Document
+from server.projects.models import Change
+from server.projects.storage import storage
+from server.root.db import pooled_session
+from server.root.metrics import SIZE_BUCKETS, counter, histogram
+from server.root.settings import (
+    CHANGES_RETENTION,
+    FLUSH_INTERVAL,
+    FLUSH_OPERATIONS,
+    SNAPSHOT_OPERATIONS,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+flush_latency = histogram("flush_latency_seconds")
+flush_batch_size = histogram("flush_batch_operations", SIZE_BUCKETS)
+flush_errors = counter("flush_errors")
+snapshots = counter("snapshots")
+
+Snapshot = tuple[Any, int]
+
+
+async def save_changes(
+    project_id: int,
+    changes: list[dict],
+    snapshot: Optional[Snapshot],
+) -> None:
+    """
+    Persists project changes in a short-lived db session.
+
+    Args:
+        project_id: project id.
+        changes: new changes to append to the log.
+        snapshot: project content prepared by the storage
+        with its revision, changes older than the retention
+        are compacted after it.
+
+    Returns:
+        None.
+    """
+
+    async with pooled_session() as session:
+        if changes:
+            await Change.append(changes, session)
+
+        if snapshot is not None:
+            data, revision = snapshot
+            await storage.save(project_id, data, revision, session)
+            await Change.compact(project_id, revision - CHANGES_RETENTION, session)
+
+        await session.commit()
+
+
+class Flusher:
+    """
+    Write-behind persistence of a project document.
+
+    Every operation becomes a row of the change log,
+    rows are inserted once per interval
+    or as soon as enough operations are collected.
+    The whole document is written only every few operations
+    and when the project is closed.
+    """
+
+    def __init__(
+        self,
+        project_id: int,
+        interval: float = FLUSH_INTERVAL,
+        operations: int = FLUSH_OPERATIONS,
+        snapshot_operations: int = SNAPSHOT_OPERATIONS,
+        save: Callable[
+            [int, list[dict], Optional[Snapshot]], Awaitable[None]
+        ] = save_changes,
+    ) -> None:
+        """
+        Initializes a new instance of the Flusher class.
+
+        Args:
+            project_id: id of the project to persist.
+            interval: max seconds between a change and its flush.
+            operations: amount of pending operations forcing a flush.
+            snapshot_operations: amount of operations between snapshots.
+            save: coroutine writing changes and the serialized document.
+        """
+
+        self.project_id = project_id
+        self.interval = interval
+        self.operations = operations
+        self.snapshot_operations = snapshot_operations
+        self.save = save
+
+        self.document: Optional[Document] = None
+        self.revision = 0
+        self.snapshot_revision = 0
+        self.changes: list[dict] = []
+        self.pending = 0
+
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def load(self, document: Document, revision: int, snapshot_revision: int) -> None:
+        """
+        Sets the document loaded from the database.
+
+        Args:
+            document: project document.
+            revision: sequence number of the last applied change.
+            snapshot_revision: revision of the stored content.
+
+        Returns:
+            None.
+        """
+
+        self.document = document
+        self.revision = revision
+        self.snapshot_revision = snapshot_revision
+
+    def mark_dirty(
+        self,
+        document: Document,
+        revision: int,
+        change: Optional[dict] = None,
+    ) -> None:
+        """
+        Schedules the document to be persisted.
+
+        Args:
+            document: changed document.
+            revision: sequence number of the applied operation.
+            change: change to append to the log,
+            None if another worker logs it.
+
+        Returns:
+            None.
+        """
+
+        self.document = document
+        self.revision = revision
+        self.pending += 1
+
+        if change is not None:
+            self.changes.append(change)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+        if self.pending >= self.operations:
+            self._full.set()
+
+    async def flush(self, snapshot: bool = False) -> None:
+        """
+        Writes pending changes to the database, if any.
+
+        Args:
+            snapshot: write the document even if it is not due yet.
+
+        Returns:
+            None.
+
+        Raises:
+            SQLAlchemyError: if the write failed,
+            the changes stay pending in this case.
+            TypeError: if the document can't be serialized,
+            the changes stay pending too.
+        """
+
+        async with self._lock:
+            due = self.revision - self.snapshot_revision
+            snapshot = due > 0 and (snapshot or due >= self.snapshot_operations)
+            if not self.changes and not snapshot:
+                self.pending = 0
+                return
+
+            data = None
+            if snapshot:
+                # Operations applied during the dump are left to the next one.
+                revision = self.revision
+                dirty, self.document.dirty = self.document.dirty, set()
+                try:
+                    data = (await storage.dump(self.document, dirty), revision)
+                except Exception:
+                    self._restore(dirty)
+                    flush_errors.inc()
+                    raise
+
+            # Changes are taken once the document is prepared,
+            # so they stay pending if it can't be.
+            batch, self.pending = self.pending, 0
+            changes, self.changes = self.changes, []
+
+            start = time.perf_counter()
+            try:
+                await self.save(self.project_id, changes, data)
+            except SQLAlchemyError:
+                self.pending += batch
+                self.changes = changes + self.changes
+                if data is not None:
+                    self._restore(dirty)
+                flush_errors.inc()
+                raise
+
+            flush_latency.observe(time.perf_counter() - start)
+            flush_batch_size.observe(batch)
+
+            if data is not None:
+                self.snapshot_revision = data[1]
+                snapshots.inc()
+
+    async def close(self) -> None:
+        """
+        Stops the scheduled flush and writes pending changes
+        with the document.
+
+        Returns:
+            None.
+        """
+
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # The cancelled flush finishes before the pending changes are written.
+            await asyncio.wait([task])
+
+        await self.flush(snapshot=True)
+
+    def _restore(self, dirty: Optional[set]) -> None:
+        # Elements changed meanwhile are dirty too.
+        self.document.dirty = (
+            None
+            if dirty is None or self.document.dirty is None
+            else dirty | self.document.dirty
+        )
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.wait_for(self._full.wait(), self.interval)
+        except TimeoutError:
+            pass
+
+        self._full.clear()
+        self._task = None
+
+        try:
+            await self.flush()
+        except SQLAlchemyError:
+            if self._task is None:
+                self._task = asyncio.create_task(self._flush_later())
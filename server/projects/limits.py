@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from server.root.metrics import counter
+from server.root.settings import RATE_BURST, RATE_BYTES, RATE_OPERATIONS, RATE_POLICY
+
+limited_frames = counter("limited_frames")
+rejected_frames = counter("rejected_frames")
+rejected_bytes = counter("rejected_bytes")
+
+
+class TokenBucket:
+    """
+    Tokens refilled at a constant rate up to the capacity.
+
+    Any amount is taken while some tokens are left,
+    the bucket goes into debt then, so a large frame
+    is accepted once and delays the next ones.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Initializes a new instance of the TokenBucket class.
+
+        Args:
+            rate: tokens added per second, zero for no limit.
+            capacity: max amount of tokens.
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """
+        Provides time until some tokens are left.
+
+        Returns:
+            float: seconds to wait, zero if tokens are available.
+        """
+
+        if not self.rate:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        return 0 if self.tokens > 0 else (1 - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        """
+        Takes tokens, possibly going into debt.
+
+        Args:
+            amount: amount of tokens.
+
+        Returns:
+            None.
+        """
+
+        if self.rate:
+            self.tokens -= amount
+
+
+class Limiter:
+    """
+    Limits of frames of a client: operations and bytes per second.
+
+    A client over a rate is handled by the policy:
+    "queue" waits until the rate allows the frame,
+    so the client is not read meanwhile,
+    "drop" discards the frame,
+    "close" asks to disconnect the client.
+    """
+
+    def __init__(
+        self,
+        operations: float = RATE_OPERATIONS,
+        size: float = RATE_BYTES,
+        burst: float = RATE_BURST,
+        policy: str = RATE_POLICY,
+    ) -> None:
+        """
+        Initializes a new instance of the Limiter class.
+
+        Args:
+            operations: operations per second, zero for no limit.
+            size: bytes per second, zero for no limit.
+            burst: seconds of the rates a client may send at once.
+            policy: one of queue, drop or close.
+        """
+
+        self.operations = TokenBucket(operations, operations * burst)
+        self.size = TokenBucket(size, size * burst)
+        self.policy = policy
+
+    async def admit(self, operations: int = 0, size: int = 0) -> bool:
+        """
+        Takes tokens for a frame of the client.
+
+        Args:
+            operations: amount of operations in the frame.
+            size: size of the frame in bytes.
+
+        Returns:
+            bool: True if the frame may be handled,
+            False if it is dropped or the client should be disconnected.
+        """
+
+        delay = max(
+            self.operations.delay() if operations else 0,
+            self.size.delay() if size else 0,
+        )
+
+        if delay:
+            limited_frames.inc()
+            if self.policy != "queue":
+                rejected_frames.inc()
+                rejected_bytes.inc(size)
+                return False
+            await asyncio.sleep(delay)
+
+        self.operations.take(operations)
+        self.size.take(size)
+
+        return True
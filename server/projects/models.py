@@ -1,10 +1,23 @@
-from typing import AsyncIterator
+from typing import AsyncIterator, Optional
 
 from server.shared.models import Entity
-from sqlalchemy import ForeignKey, String, Text, select
+from sqlalchemy import (
+    ForeignKey,
+    String,
+    Text,
+    UniqueConstraint,
+    delete,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
 
+# Values in a single IN clause, far below the limits of every database.
+IDS_PER_QUERY = 500
+
 
 class Project(Entity):
     """
@@ -16,7 +29,10 @@ class Project(Entity):
 
     archived: Mapped[bool] = mapped_column(default=False)
     author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # Empty if the content is stored in the elements table.
     content: Mapped[str]
+    # Sequence number of the last change included in the content.
+    revision: Mapped[int] = mapped_column(default=0)
     title: Mapped[str] = mapped_column(String(255))
 
     @staticmethod
@@ -31,15 +47,293 @@ class Project(Entity):
         async for scalar in scalars:
             yield scalar
 
+    @classmethod
+    async def delete(cls, item_id: int, db: AsyncSession) -> None:
+        """
+        Deletes the project with its changes, elements and versions,
+        blobs are shared by projects and kept.
+
+        Args:
+            item_id: project id.
+            db: db async session.
+
+        Returns:
+            None.
+
+        Raises:
+            RuntimeError: if the project with specified id not found.
+        """
+
+        for model in (Change, Element, Version):
+            await db.execute(delete(model).where(model.project_id == item_id))
+
+        await super().delete(item_id, db)
+
+    @staticmethod
+    async def save_snapshot(
+        item_id: int,
+        content: str,
+        revision: int,
+        session: AsyncSession,
+    ) -> bool:
+        """
+        Overwrites the project content without loading the project.
+        Older snapshots never replace newer ones.
+
+        Args:
+            item_id: project id.
+            content: project content as JSON array,
+            empty if it is stored in the elements table.
+            revision: sequence number of the last change in the content.
+            session: db async session.
+
+        Returns:
+            bool: True if the content was overwritten,
+            False if a newer one is stored.
+        """
+
+        result = await session.execute(
+            update(Project)
+            .where(Project.id == item_id, Project.revision < revision)
+            .values(content=content, revision=revision)
+        )
+
+        return result.rowcount > 0
+
 
 class Change(Entity):
-    """Project history tracking."""
+    """
+    Project history tracking.
+
+    Append-only log of the operations applied to the project content,
+    changes up to Project.revision are included in the content
+    and are compacted away after a while.
+    """
 
     __tablename__ = "changes"
+    __table_args__ = (UniqueConstraint("project_id", "seq"),)
 
     message: Mapped[str]
     project_id: Mapped[int] = mapped_column(ForeignKey("projects.id"))
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    seq: Mapped[int]
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id"))
+
+    @staticmethod
+    async def by_project(
+        project_id: int,
+        session: AsyncSession,
+        after: int = 0,
+    ) -> AsyncIterator:
+        scalars = await session.stream_scalars(
+            select(Change)
+            .where(Change.project_id == project_id, Change.seq > after)
+            .order_by(Change.seq)
+        )
+
+        async for scalar in scalars:
+            yield scalar
+
+    @staticmethod
+    async def append(changes: list[dict], session: AsyncSession) -> None:
+        """
+        Inserts several changes at once.
+
+        Args:
+            changes: changes data.
+            session: db async session.
+
+        Returns:
+            None.
+        """
+
+        await session.execute(insert(Change), changes)
+
+    @staticmethod
+    async def compact(
+        project_id: int,
+        revision: int,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Deletes changes included in the project content.
+
+        Args:
+            project_id: project id.
+            revision: sequence number of the last change to delete.
+            session: db async session.
+
+        Returns:
+            None.
+        """
+
+        await session.execute(
+            delete(Change).where(
+                Change.project_id == project_id,
+                Change.seq <= revision,
+            )
+        )
+
+
+class Element(Entity):
+    """
+    Element of the project content stored as a separate row.
+
+    Element ids are stored as JSON, so 1 and "1" differ,
+    the order is kept by the id of the previous element.
+    """
+
+    __tablename__ = "elements"
+    __table_args__ = (UniqueConstraint("project_id", "element_id"),)
+
+    after: Mapped[Optional[str]] = mapped_column(String(255))
+    data: Mapped[str] = mapped_column(Text)
+    element_id: Mapped[str] = mapped_column(String(255))
+    parent: Mapped[Optional[str]] = mapped_column(String(255))
+    project_id: Mapped[int] = mapped_column(ForeignKey("projects.id"))
+
+    @staticmethod
+    async def by_project(
+        project_id: int,
+        session: AsyncSession,
+    ) -> AsyncIterator:
+        scalars = await session.stream_scalars(
+            select(Element).where(Element.project_id == project_id)
+        )
+
+        async for scalar in scalars:
+            yield scalar
+
+    @staticmethod
+    async def replace(
+        project_id: int,
+        element_ids: Optional[list[str]],
+        elements: list[dict],
+        session: AsyncSession,
+    ) -> None:
+        """
+        Deletes elements and inserts their new versions.
+
+        Args:
+            project_id: project id.
+            element_ids: ids of the elements to delete,
+            None to delete every element of the project.
+            elements: elements data to insert.
+            session: db async session.
+
+        Returns:
+            None.
+        """
+
+        statement = delete(Element).where(Element.project_id == project_id)
+        if element_ids is None:
+            await session.execute(statement)
+        else:
+            for start in range(0, len(element_ids), IDS_PER_QUERY):
+                await session.execute(
+                    statement.where(
+                        Element.element_id.in_(
+                            element_ids[start : start + IDS_PER_QUERY]
+                        )
+                    )
+                )
+
+        if elements:
+            await session.execute(insert(Element), elements)
+
+
+class Blob(Entity):
+    """
+    Immutable data addressed by its SHA-256 hash,
+    shared by every version of every project.
+    """
+
+    __tablename__ = "blobs"
+
+    data: Mapped[str] = mapped_column(Text)
+    hash: Mapped[str] = mapped_column(String(64), unique=True)
+
+    @staticmethod
+    async def by_hashes(hashes: list[str], session: AsyncSession) -> dict[str, str]:
+        """
+        Provides data of several blobs.
+
+        Args:
+            hashes: blob hashes.
+            session: db async session.
+
+        Returns:
+            dict[str, str]: data by hashes of the found blobs.
+        """
+
+        found = {}
+        for start in range(0, len(hashes), IDS_PER_QUERY):
+            rows = await session.execute(
+                select(Blob.hash, Blob.data).where(
+                    Blob.hash.in_(hashes[start : start + IDS_PER_QUERY])
+                )
+            )
+            found.update(rows.tuples().all())
+
+        return found
+
+    @staticmethod
+    async def store(blobs: dict[str, str], session: AsyncSession) -> None:
+        """
+        Inserts blobs that are not stored yet.
+        Blobs inserted by other sessions meanwhile are kept.
+
+        Args:
+            blobs: data by hashes.
+            session: db async session.
+
+        Returns:
+            None.
+        """
+
+        missing = dict(blobs)
+        while missing:
+            hashes = list(missing)
+            for start in range(0, len(hashes), IDS_PER_QUERY):
+                stored = await session.scalars(
+                    select(Blob.hash).where(
+                        Blob.hash.in_(hashes[start : start + IDS_PER_QUERY])
+                    )
+                )
+                for hash in stored:
+                    del missing[hash]
+
+            if not missing:
+                return
+
+            # Versions saved at once may insert the same blobs,
+            # the savepoint keeps the transaction usable to look them up again.
+            rows = [{"hash": hash, "data": data} for hash, data in missing.items()]
+            try:
+                async with session.begin_nested():
+                    await session.execute(insert(Blob), rows)
+            except IntegrityError:
+                continue
+
+            return
+
+
+class Version(Entity):
+    """
+    Named restore point of the project content.
+
+    The content is kept as blobs: the manifest lists chunks,
+    a chunk lists elements, so versions share unchanged parts.
+    """
+
+    __tablename__ = "versions"
+
+    # Hash of the blob listing chunks of the content.
+    manifest: Mapped[str] = mapped_column(String(64))
+    project_id: Mapped[int] = mapped_column(ForeignKey("projects.id"))
+    # Sequence number of the last change included in the content.
+    revision: Mapped[int]
+    title: Mapped[str] = mapped_column(String(255))
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id"))
 
     @staticmethod
     async def by_project(
@@ -47,7 +341,9 @@ class Change(Entity):
         session: AsyncSession,
     ) -> AsyncIterator:
         scalars = await session.stream_scalars(
-            select(Change).where(Change.project_id == project_id)
+            select(Version)
+            .where(Version.project_id == project_id)
+            .order_by(Version.id)
         )
 
         async for scalar in scalars:
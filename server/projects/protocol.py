@@ -0,0 +1,300 @@
+import json
+import sys
+from typing import Any
+
+import msgpack
+from server.projects.content import COMMANDS, STRUCTURAL
+from server.root import codec
+
+# Frame carrying a list of [command, element_data] pairs
+# applied to the document at once.
+BATCH = "batch"
+
+# Element data fields referencing other elements.
+REFERENCES = ("parent", "after")
+
+# Frames changing the structure of the tree, sent to clients as they are:
+# "duplicate" {"id", "ids": [[id, copy id], ...]} copies a subtree,
+# "group" {"id", "ids": [...], ...} creates a group of the first element
+# and its siblings,
+# "ungroup" {"id"} moves the children out of the group and deletes it,
+# "reparent" {"ids": [...], "parent"} moves the elements under the parent.
+# They can't be batched, clients expand them against their documents.
+MAX_STRUCTURAL = 10000
+
+# Frames reverting the last change of the user or the last reverted one,
+# the payload is ignored. Other clients receive a batch.
+UNDO = "undo"
+REDO = "redo"
+
+# Frames streaming a large document: chunks of [position, element]
+# pairs, top-level elements first, and the final {"length"} marker.
+CHUNK = "chunk"
+LOADED = "loaded"
+
+# Frame changing the viewport of the client,
+# the payload is {"x", "y", "width", "height"}.
+VIEWPORT = "viewport"
+RECT = ("x", "y", "width", "height")
+
+# Frame sharing what the user is looking at, never persisted:
+# {"cursor": {"x", "y"}, "selection": [id, ...], "viewport": {...}},
+# any field may be null. The server sends {"<user>": state, ...},
+# a null state means the user left.
+PRESENCE = "presence"
+PRESENCE_FIELDS = ("cursor", "selection", "viewport")
+POINT = ("x", "y")
+MAX_SELECTION = 1000
+
+# Frames checking the client is alive: the server pings a silent client,
+# the client answers with pong, payloads are ignored.
+PING = "ping"
+PONG = "pong"
+
+# Websocket subprotocol of binary frames:
+# the client sends MessagePack [command, payload],
+# the server sends [seq, command, payload],
+# the document is sent with the "document" command.
+BINARY_SUBPROTOCOL = "msgpack"
+DOCUMENT = "document"
+
+
+def parse(message: str) -> tuple[str, Any]:
+    """
+    Splits a frame into the command and its payload.
+
+    Args:
+        message: frame as "<command> <json>".
+
+    Returns:
+        tuple[str, Any]: command and parsed payload.
+
+    Raises:
+        ValueError: if the payload is not a valid JSON.
+    """
+
+    command, _, data = message.partition(" ")
+
+    # Parsed like the stored documents, integers too large for them
+    # become floats and NaN or Infinity are rejected.
+    return command, codec.loads(data)
+
+
+def dumps(command: str, payload: Any) -> str:
+    """
+    Builds a text frame.
+
+    Args:
+        command: frame command.
+        payload: frame payload.
+
+    Returns:
+        str: frame as "<command> <json>".
+    """
+
+    return f"{command} {json.dumps(payload)}"
+
+
+def unpack(message: bytes) -> tuple[str, Any]:
+    """
+    Decodes a binary frame of the client.
+
+    Args:
+        message: MessagePack [command, payload].
+
+    Returns:
+        tuple[str, Any]: command and payload as parsed from a text frame.
+
+    Raises:
+        ValueError: if the frame is not a valid MessagePack pair
+        or the payload has no JSON form.
+    """
+
+    try:
+        data = msgpack.unpackb(message)
+    except (ValueError, msgpack.UnpackException) as e:
+        raise ValueError("Invalid binary frame.") from e
+
+    if not isinstance(data, list) or len(data) != 2 or not isinstance(data[0], str):
+        raise ValueError("Binary frame must be a [command, payload] pair.")
+
+    # Operations are published and stored as text frames,
+    # so binary values and NaN are rejected.
+    try:
+        return parse(dumps(data[0], data[1]))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Binary frame payload must be a valid JSON.") from e
+
+
+def pack(seq: int, command: str, payload: Any) -> bytes:
+    """
+    Encodes a binary frame for the client.
+
+    Args:
+        seq: sequence number of the frame.
+        command: frame command.
+        payload: frame payload.
+
+    Returns:
+        bytes: MessagePack [seq, command, payload].
+    """
+
+    return msgpack.packb([seq, command, payload])
+
+
+def operations(command: str, payload: Any) -> list[tuple[str, dict]]:
+    """
+    Provides document operations carried by a frame.
+
+    Args:
+        command: frame command.
+        payload: frame payload.
+
+    Returns:
+        list[tuple[str, dict]]: pairs of command and element data.
+
+    Raises:
+        ValueError: if the frame or any of its operations is invalid.
+    """
+
+    if command in STRUCTURAL:
+        return [(command, _structural(command, payload))]
+    if command != BATCH:
+        payload = [(command, payload)]
+    elif not isinstance(payload, list):
+        raise ValueError("Batch must be a list of operations.")
+
+    found = []
+
+    for operation in payload:
+        if not isinstance(operation, (list, tuple)) or len(operation) != 2:
+            raise ValueError("Operation must be a [command, data] pair.")
+
+        command, element_data = operation
+        if command not in COMMANDS:
+            raise ValueError(f"Invalid command {command}.")
+        if not isinstance(element_data, dict) or not _is_id(element_data.get("id")):
+            raise ValueError("Operation data must be an object with id.")
+        if not all(
+            element_data.get(key) is None or _is_id(element_data[key])
+            for key in REFERENCES
+        ):
+            raise ValueError("Referenced element ids must be strings or numbers.")
+        _check_rect(element_data)
+
+        found.append((command, element_data))
+
+    return found
+
+
+def viewport(payload: Any) -> tuple[float, float, float, float]:
+    """
+    Provides the rectangle of a viewport frame.
+
+    Args:
+        payload: frame payload.
+
+    Returns:
+        tuple[float, float, float, float]: x, y, width and height.
+
+    Raises:
+        ValueError: if the payload is not a valid rectangle.
+    """
+
+    if not isinstance(payload, dict):
+        raise ValueError("Viewport must be an object.")
+
+    rect = tuple(payload.get(key) for key in RECT)
+    if not all(_is_number(value) for value in rect):
+        raise ValueError("Viewport must have numeric x, y, width and height.")
+    if rect[2] < 0 or rect[3] < 0:
+        raise ValueError("Viewport size must not be negative.")
+
+    return rect
+
+
+def presence(payload: Any) -> dict:
+    """
+    Provides the state of a presence frame.
+
+    Args:
+        payload: frame payload.
+
+    Returns:
+        dict: cursor, selection and viewport, missing ones are null.
+
+    Raises:
+        ValueError: if the payload is not a valid state.
+    """
+
+    if not isinstance(payload, dict) or not payload.keys() <= set(PRESENCE_FIELDS):
+        raise ValueError("Presence must be an object of cursor, selection, viewport.")
+
+    cursor = payload.get("cursor")
+    if cursor is not None:
+        if not isinstance(cursor, dict) or not all(
+            _is_number(cursor.get(key)) for key in POINT
+        ):
+            raise ValueError("Cursor must have numeric x and y.")
+        cursor = {key: cursor[key] for key in POINT}
+
+    selection = payload.get("selection")
+    if selection is not None and (
+        not isinstance(selection, list)
+        or len(selection) > MAX_SELECTION
+        or not all(_is_id(id) for id in selection)
+    ):
+        raise ValueError("Selection must be a list of element ids.")
+
+    rect = payload.get("viewport")
+    if rect is not None:
+        rect = dict(zip(RECT, viewport(rect)))
+
+    return {"cursor": cursor, "selection": selection, "viewport": rect}
+
+
+def _structural(command: str, payload: Any) -> dict:
+    if not isinstance(payload, dict):
+        raise ValueError("Structural command data must be an object.")
+    if command != "reparent" and not _is_id(payload.get("id")):
+        raise ValueError("Structural command data must have id.")
+    if payload.get("parent") is not None and not _is_id(payload["parent"]):
+        raise ValueError("Referenced element ids must be strings or numbers.")
+    _check_rect(payload)
+    if command == "ungroup":
+        return payload
+
+    ids = payload.get("ids")
+    if not isinstance(ids, list) or len(ids) > MAX_STRUCTURAL:
+        raise ValueError("Structural command must have a list of element ids.")
+    if command == "duplicate":
+        ids = [pair for pair in ids if isinstance(pair, list) and len(pair) == 2]
+        ids = [id for pair in ids for id in pair]
+        if len(ids) != 2 * len(payload["ids"]):
+            raise ValueError("Duplicate ids must be [id, copy id] pairs.")
+    if not all(_is_id(id) for id in ids):
+        raise ValueError("Structural command must have a list of element ids.")
+
+    return payload
+
+
+def _check_rect(element_data: dict) -> None:
+    # Positions and sizes index the elements for viewports.
+    if not all(
+        element_data.get(key) is None or _is_number(element_data[key])
+        for key in RECT
+    ):
+        raise ValueError("Element position and size must be finite numbers.")
+
+
+def _is_number(value: Any) -> bool:
+    # Large integers are not finite as floats.
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and abs(value) <= sys.float_info.max
+    )
+
+
+def _is_id(value: Any) -> bool:
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
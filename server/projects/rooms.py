@@ -0,0 +1,1190 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Hashable,
+    Iterator,
+    Optional,
+    Union,
+)
+
+from server.projects.connection import Connection
+from server.projects.content import STRUCTURAL, Document, History
+from server.projects.flusher import Flusher
+from server.projects.models import Change, Project
+from server.projects.protocol import (
+    BATCH,
+    CHUNK,
+    DOCUMENT,
+    LOADED,
+    PING,
+    PRESENCE,
+    dumps,
+    operations,
+    pack,
+    parse,
+)
+from server.projects.scheduler import Queue, Scheduler
+from server.projects.spatial import Rect, Viewports
+from server.projects.storage import load
+from server.root import codec
+from server.root.broadcast import Broadcast, broadcast
+from server.root.metrics import counter, gauge
+from server.root.settings import (
+    CHUNK_ELEMENTS,
+    EVICTION_COOLDOWN,
+    EVICTION_INTERVAL,
+    HEARTBEAT_INTERVAL,
+    IDLE_TIMEOUT,
+    MEMORY_BUDGET,
+    PRESENCE_INTERVAL,
+    RESYNC_OPERATIONS,
+    ROOM_IDLE_TIMEOUT,
+    SYNC_TIMEOUT,
+    UPDATE_INTERVAL,
+)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+# Messages of a project channel:
+# "op <worker> <user> <frame>" is an operation of a client,
+# "undo" and "redo" messages are alike, the frame reverts a change,
+# "sync <worker>" asks other workers to persist the document,
+# "synced <revision>" tells it is persisted at least up to the revision
+# it had at the sync message,
+# "presence <json>" carries latest states of the users of a worker,
+# "echo <worker>" comes back to a closing room after its own operations.
+OPERATION = "op"
+SYNC = "sync"
+SYNCED = "synced"
+ECHO = "echo"
+ANONYMOUS = "-"
+
+logger = logging.getLogger(__name__)
+
+resync_deltas = counter("resync_deltas")
+resync_snapshots = counter("resync_snapshots")
+room_evictions = counter("room_evictions")
+coalesced_updates = counter("coalesced_updates")
+reaped_connections = counter("reaped_connections")
+documents_size = gauge("documents_bytes")
+
+
+class Room:
+    """
+    Editing session of a project in the current worker.
+
+    Owns the only in-memory document of the project in the worker.
+    Operations of the clients are published to the project channel
+    and applied by every subscribed worker in the same order,
+    so documents and revisions of all workers stay equal.
+    Only the worker of the client logs the operation
+    and keeps the history of the user to revert it.
+
+    The revision is the sequence number of the last operation.
+    Clients tracking it receive operations as "<seq> <frame>"
+    and on reconnect get only the ones they missed.
+    Binary clients always track it.
+
+    Clients with a viewport receive only elements
+    they can see and operations changing them.
+
+    Viewers without a viewport form the audience: they are never
+    served one by one, every frame is encoded once per kind of clients
+    and the same buffer is queued for all of them. Clients joining
+    between operations share the encoded document too.
+
+    Updates of elements made by the worker clients are merged
+    per element and published once per interval, a frame per user,
+    other operations publish pending updates first to keep the order.
+    Clients not tracking sequence numbers receive them as update frames.
+
+    Presence of the users bypasses the document and the database:
+    the latest state of every user is published once per interval
+    and dropped by clients that are behind.
+
+    Messages of the channel are handled in turns with other rooms
+    of the worker, CPU time they take is accounted in the queue.
+    Documents asked by other workers are written outside the turns.
+    """
+
+    def __init__(
+        self,
+        project_id: int,
+        broadcast: Broadcast,
+        worker: str,
+        scheduler: Scheduler,
+    ) -> None:
+        """
+        Initializes a new instance of the Room class.
+
+        Args:
+            project_id: project id.
+            broadcast: channels shared by the workers.
+            worker: id of the current worker.
+            scheduler: scheduler of the rooms of the worker.
+        """
+
+        self.project_id = project_id
+        self.channel = f"projects:{project_id}"
+        self.broadcast = broadcast
+        self.worker = worker
+        self.scheduler = scheduler
+        self.queue = Queue()
+        self.document: Optional[Document] = None
+        self.revision = 0
+        self.flusher = Flusher(project_id)
+
+        # Every joined connection keeps the room opened,
+        # operations are sent only to ones with the document.
+        self.connections: set[Connection] = set()
+        self.clients: set[Connection] = set()
+        self.sequenced: set[Connection] = set()
+        self.binary: set[Connection] = set()
+        # Clients served one by one and viewers by kinds of frames.
+        self.individual: set[Connection] = set()
+        self.audience: dict[str, set[Connection]] = {
+            "text": set(),
+            "sequenced": set(),
+            "binary": set(),
+        }
+        # Encoded documents by kinds of frames, valid for the revision.
+        self._documents: dict[str, Union[str, bytes]] = {}
+        self._documents_revision = 0
+        # Indexed only while some client has a viewport.
+        self.viewports: Optional[Viewports] = None
+
+        # Sequence numbers and frames of the last operations.
+        self.recent: deque[tuple[int, str]] = deque(maxlen=RESYNC_OPERATIONS)
+        # Undo and redo stacks of known users of the worker clients.
+        self.histories: dict[str, History] = {}
+
+        # Presence keys of the clients and states to publish by keys.
+        self.users: dict[Connection, str] = {}
+        self.presence: dict[str, Optional[dict]] = {}
+        self._presence_task: Optional[asyncio.Task] = None
+
+        # Merged updates to publish by element ids, with their users.
+        self.updates: dict[Hashable, tuple[str, dict]] = {}
+        self._updates_task: Optional[asyncio.Task] = None
+
+        self.ready = asyncio.Event()
+        self.synced = asyncio.Event()
+        self.synced_revision = 0
+        # Workers opening the project meanwhile, they have no document.
+        self._openers: set[str] = set()
+        # Set when operations of other workers may be missed,
+        # the document stops changing until the room is evicted.
+        self.stale = False
+        self.echoed = asyncio.Event()
+        # Documents written for other workers outside the turns of the room.
+        self._syncs: set[asyncio.Task] = set()
+
+        # Time of the last activity, rooms used by requests aren't evicted.
+        self.used = time.monotonic()
+        self.pinned = 0
+
+        self._received: list[tuple[str, str]] = []
+
+    async def open(self, project: Project, session: AsyncSession) -> None:
+        """
+        Subscribes to the project channel and loads the document:
+        the content snapshot and the changes after it.
+
+        If another worker has the project opened,
+        it is asked to persist its document first,
+        changes after that are received from the channel.
+
+        Args:
+            project: project to edit.
+            session: db async session the project was loaded with.
+
+        Returns:
+            None.
+        """
+
+        await self.broadcast.subscribe(self.channel, self.receive)
+
+        subscribers = await self.broadcast.subscribers(self.channel)
+        if subscribers > 1:
+            await self.broadcast.publish(self.channel, f"{SYNC} {self.worker}")
+            try:
+                await asyncio.wait_for(self.synced.wait(), SYNC_TIMEOUT)
+            except TimeoutError:
+                # The log is complete only if other workers are opening too,
+                # others may not have written their changes yet.
+                self.stale = len(self._openers) < subscribers - 1
+            await session.refresh(project, ["content", "revision"])
+
+        tail = []
+        if not self.synced.is_set():
+            tail = [
+                change
+                async for change in Change.by_project(
+                    project.id, session, project.revision
+                )
+            ]
+
+        self.document = await load(project, session)
+        self.revision = project.revision
+
+        for change in tail:
+            found = operations(*parse(change.message))
+            self.document.apply_batch(self.document.expand(found))
+            self.revision = change.seq
+            self.recent.append((change.seq, change.message))
+
+        self.flusher.load(self.document, self.revision, project.revision)
+
+        # Operations published while the document was loading,
+        # the persisted one may include the first of them.
+        skipped = 0
+        if self.synced.is_set():
+            skipped = max(self.revision - self.synced_revision, 0)
+        if not self.stale:
+            for kind, data in self._received[skipped:]:
+                self._apply(data, kind)
+        self._received.clear()
+
+        self.ready.set()
+
+    def add(
+        self,
+        connection: Connection,
+        seq: Optional[int] = None,
+        binary: bool = False,
+        viewport: Optional[Rect] = None,
+        chunked: bool = False,
+        viewer: bool = False,
+    ) -> None:
+        """
+        Sends the document to the client and starts sending it operations.
+
+        A client passing a sequence number receives
+        a batch of operations made after it, stamped with the revision,
+        or "<revision> <document>" if it is too far behind.
+        A client passing a viewport receives only visible elements.
+        A chunked document is streamed with bounded frames.
+
+        Args:
+            connection: client connection.
+            seq: sequence number of the last operation the client has,
+            None if the client doesn't track them.
+            binary: send MessagePack frames instead of text.
+            viewport: rectangle of the canvas the client shows.
+            chunked: stream the document in chunks.
+            viewer: the client can't edit the document.
+
+        Returns:
+            None.
+        """
+
+        self.used = time.monotonic()
+
+        if binary:
+            self.binary.add(connection)
+        elif seq is not None:
+            self.sequenced.add(connection)
+
+        elements = None
+        whole = False
+        if viewport is not None:
+            if self.viewports is None:
+                self.viewports = Viewports(self.document)
+            elements = self.viewports.add(connection, viewport)
+        elif seq is None:
+            whole = True
+        else:
+            missing = self.missing(seq)
+            if missing is None:
+                whole = True
+                resync_snapshots.inc()
+            else:
+                self._send(connection, BATCH, missing)
+                resync_deltas.inc()
+
+        if whole and chunked:
+            connection.stream(self._chunks(connection, self.document.to_list()))
+        elif whole:
+            connection.send(self._document(connection))
+        elif elements is not None and chunked:
+            connection.stream(self._chunks(connection, elements))
+        elif elements is not None:
+            self._send(connection, DOCUMENT, elements)
+
+        self.clients.add(connection)
+        if viewer and viewport is None:
+            self.audience[self._kind(connection)].add(connection)
+        else:
+            self.individual.add(connection)
+
+    def move(self, connection: Connection, viewport: Rect) -> None:
+        """
+        Changes the viewport of the client,
+        it receives a batch creating elements that became visible
+        and deleting ones that became hidden.
+
+        Args:
+            connection: client connection.
+            viewport: new rectangle of the canvas the client shows.
+
+        Returns:
+            None.
+        """
+
+        self.used = time.monotonic()
+        if self.viewports is None:
+            self.viewports = Viewports(self.document)
+
+        # Viewers with a viewport get their own operations.
+        if connection in self.audience[self._kind(connection)]:
+            self.audience[self._kind(connection)].discard(connection)
+            self.individual.add(connection)
+
+        changed = self.viewports.move(connection, viewport)
+        if changed:
+            self._send(connection, BATCH, changed)
+
+    def missing(self, seq: int) -> Optional[list[tuple[str, dict]]]:
+        """
+        Provides operations made after the sequence number.
+
+        Args:
+            seq: sequence number of the last known operation.
+
+        Returns:
+            Optional[list[tuple[str, dict]]]: operations in order,
+            None if some of them are not kept anymore.
+        """
+
+        if seq > self.revision:
+            return None
+        if seq < self.revision and (not self.recent or self.recent[0][0] > seq + 1):
+            return None
+
+        return [
+            operation
+            for operation_seq, frame in self.recent
+            if operation_seq > seq
+            for operation in operations(*parse(frame))
+        ]
+
+    def present(
+        self,
+        connection: Connection,
+        user_id: Optional[int],
+        state: dict,
+    ) -> None:
+        """
+        Schedules the presence state of the user to be published,
+        states published meanwhile replace it.
+
+        Args:
+            connection: client connection.
+            user_id: id of the user, if known,
+            anonymous clients are told apart by connections.
+            state: validated presence state.
+
+        Returns:
+            None.
+        """
+
+        self.used = time.monotonic()
+
+        key = self.users.get(connection)
+        if key is None:
+            key = uuid.uuid4().hex if user_id is None else str(user_id)
+            self.users[connection] = key
+
+        self.presence[key] = state
+        if self._presence_task is None:
+            self._presence_task = asyncio.create_task(self._publish_presence())
+
+    def discard(self, connection: Connection) -> None:
+        """
+        Forgets the client.
+
+        Args:
+            connection: client connection.
+
+        Returns:
+            None.
+        """
+
+        # Other clients remove the user if it has no more clients.
+        key = self.users.pop(connection, None)
+        if key is not None and key not in self.users.values():
+            self.presence[key] = None
+            if self._presence_task is None:
+                self._presence_task = asyncio.create_task(self._publish_presence())
+
+        self.connections.discard(connection)
+        self.clients.discard(connection)
+        self.individual.discard(connection)
+        self.audience[self._kind(connection)].discard(connection)
+        self.sequenced.discard(connection)
+        self.binary.discard(connection)
+
+        if self.viewports is not None:
+            self.viewports.discard(connection)
+            if not self.viewports:
+                self.viewports = None
+
+    def heartbeat(self) -> list[Connection]:
+        """
+        Pings clients silent for the heartbeat interval.
+
+        Returns:
+            list[Connection]: dead clients, closed
+            or silent for the idle timeout.
+        """
+
+        now = time.monotonic()
+        dead = []
+
+        for client in self.clients:
+            silent = now - client.received
+            if client.closed or silent >= IDLE_TIMEOUT:
+                dead.append(client)
+            elif silent >= HEARTBEAT_INTERVAL:
+                frame = self._encode(client, PING, None, self.revision)
+                client.send(frame, lossy=True)
+
+        return dead
+
+    async def publish(self, message: str, user_id: Optional[int]) -> None:
+        """
+        Sends an operation of a client to every worker.
+
+        Args:
+            message: validated operation or batch frame.
+            user_id: id of the user who made the operation, if known.
+
+        Returns:
+            None.
+        """
+
+        # Operations of stale rooms would never be logged.
+        if self.stale:
+            return
+
+        await self.settle()
+
+        user = ANONYMOUS if user_id is None else user_id
+
+        await self.broadcast.publish(
+            self.channel, f"{OPERATION} {self.worker} {user} {message}"
+        )
+
+    async def update(self, element_data: dict, user_id: Optional[int]) -> None:
+        """
+        Schedules an update of an element to be published,
+        later updates of the element by the user are merged into it.
+        Updates changing the parent are published at once.
+
+        Args:
+            element_data: validated update of the element.
+            user_id: id of the user who made the update, if known.
+
+        Returns:
+            None.
+        """
+
+        if self.stale:
+            return
+        if "parent" in element_data:
+            await self.publish(dumps("update", element_data), user_id)
+            return
+
+        self.used = time.monotonic()
+        user = ANONYMOUS if user_id is None else str(user_id)
+        id = element_data["id"]
+
+        pending = self.updates.get(id)
+        if pending is not None and pending[0] != user:
+            # Updates of other users are published in their order.
+            await self.settle()
+            pending = None
+
+        if pending is None:
+            self.updates[id] = (user, element_data)
+        else:
+            self.updates[id] = (user, pending[1] | element_data)
+            coalesced_updates.inc()
+
+        if self._updates_task is None:
+            self._updates_task = asyncio.create_task(self._publish_updates())
+
+    async def settle(self) -> None:
+        """
+        Publishes pending updates without waiting for the interval.
+
+        Returns:
+            None.
+        """
+
+        if self._updates_task is not None:
+            self._updates_task.cancel()
+            self._updates_task = None
+            await self._publish_updates(wait=False)
+
+    async def revert(self, command: str, user_id: Optional[int]) -> None:
+        """
+        Sends operations reverting the last change of the user
+        or the last reverted one to every worker.
+        Changes of anonymous users are not reverted.
+
+        Args:
+            command: undo or redo.
+            user_id: id of the user, if known.
+
+        Returns:
+            None.
+        """
+
+        # Anonymous clients have no history, even if they hold a link.
+        if user_id is None or self.stale:
+            return
+
+        # The last change may be still pending.
+        await self.settle()
+
+        history = self.histories.get(str(user_id))
+        found = None if history is None else history.pop(command)
+        if not found:
+            return
+
+        await self.broadcast.publish(
+            self.channel,
+            f"{command} {self.worker} {user_id} {dumps(BATCH, found)}",
+        )
+
+    def receive(self, message: str) -> Awaitable[None]:
+        """
+        Queues a message of the project channel
+        to be handled in the turn of the room.
+
+        Args:
+            message: operation or control message.
+
+        Returns:
+            Awaitable[None]: done when the message is handled.
+        """
+
+        return self.scheduler.submit(self.queue, partial(self.handle, message))
+
+    def expire(self) -> Awaitable[None]:
+        """
+        Stops changing the document after the messages received so far,
+        used when later messages of the channel may be missed.
+        The document is still persisted, it is consistent up to the revision.
+
+        Returns:
+            Awaitable[None]: done when the room is stale.
+        """
+
+        return self.scheduler.submit(self.queue, self._expire)
+
+    async def handle(self, message: str) -> None:
+        """
+        Handles a message of the project channel at once.
+
+        Args:
+            message: operation or control message.
+
+        Returns:
+            None.
+        """
+
+        kind, _, data = message.partition(" ")
+
+        match kind:
+            case "sync":
+                if self.stale:
+                    return
+                if self.document is not None:
+                    # Writing doesn't hold the turn of the room,
+                    # the document may include later operations then.
+                    task = asyncio.create_task(self._sync(self.revision))
+                    self._syncs.add(task)
+                    task.add_done_callback(self._syncs.discard)
+                elif data == self.worker:
+                    # The persisted document includes previous operations.
+                    self._received.clear()
+                else:
+                    self._openers.add(data)
+            case "synced":
+                self.synced_revision = int(data)
+                self.synced.set()
+            case "echo":
+                if data == self.worker:
+                    self.echoed.set()
+            case "presence":
+                if self.document is None:
+                    return
+
+                states = json.loads(data)
+                self._broadcast(dumps(PRESENCE, states), PRESENCE, states, lossy=True)
+            case "op" | "undo" | "redo":
+                if self.stale:
+                    return
+                if self.document is None:
+                    self._received.append((kind, data))
+                    return
+
+                frame, command, payload, changed = self._apply(data, kind)
+                self._broadcast(frame, command, payload, changed)
+
+    async def close(self) -> None:
+        """
+        Persists pending changes and leaves the project channel.
+
+        Returns:
+            None.
+        """
+
+        await self.settle()
+
+        # Operations of the worker are applied and logged when they come back,
+        # the channel delivers them before the echo.
+        self.echoed.clear()
+        await self.broadcast.publish(self.channel, f"{ECHO} {self.worker}")
+        try:
+            await asyncio.wait_for(self.echoed.wait(), SYNC_TIMEOUT)
+        except TimeoutError:
+            pass
+
+        # Users leaving are announced without waiting.
+        if self._presence_task is not None:
+            self._presence_task.cancel()
+            self._presence_task = None
+            await self._publish_presence(wait=False)
+
+        if self._syncs:
+            await asyncio.wait(self._syncs)
+
+        await self.broadcast.unsubscribe(self.channel)
+        await self.flusher.close()
+
+    async def _expire(self) -> None:
+        self.stale = True
+
+    async def _sync(self, revision: int) -> None:
+        try:
+            await self.flusher.flush(snapshot=True)
+        except SQLAlchemyError:
+            # Workers not told load changes logged by then.
+            return
+
+        await self.broadcast.publish(self.channel, f"{SYNCED} {revision}")
+
+    async def _publish_presence(self, wait: bool = True) -> None:
+        if wait:
+            await asyncio.sleep(PRESENCE_INTERVAL)
+
+        states, self.presence = self.presence, {}
+        self._presence_task = None
+        if states:
+            await self.broadcast.publish(
+                self.channel, f"{PRESENCE} {json.dumps(states)}"
+            )
+
+    async def _publish_updates(self, wait: bool = True) -> None:
+        if wait:
+            await asyncio.sleep(UPDATE_INTERVAL)
+
+        updates, self.updates = self.updates, {}
+        self._updates_task = None
+        if self.stale:
+            return
+
+        by_users: dict[str, list[tuple[str, dict]]] = {}
+        for user, element_data in updates.values():
+            by_users.setdefault(user, []).append(("update", element_data))
+
+        for user, found in by_users.items():
+            frame = dumps(*found[0]) if len(found) == 1 else dumps(BATCH, found)
+            await self.broadcast.publish(
+                self.channel, f"{OPERATION} {self.worker} {user} {frame}"
+            )
+
+    def _broadcast(
+        self,
+        frame: str,
+        command: str,
+        payload: Any,
+        changed: Optional[dict[Connection, list[tuple[str, dict]]]] = None,
+        lossy: bool = False,
+    ) -> None:
+        # Every frame is encoded once for each kind of clients.
+        encoded: dict[str, list[Union[str, bytes]]] = {}
+
+        def encode(kind: str) -> list[Union[str, bytes]]:
+            if kind not in encoded:
+                match kind:
+                    case "binary":
+                        encoded[kind] = [pack(self.revision, command, payload)]
+                    case "sequenced":
+                        encoded[kind] = [f"{self.revision} {frame}"]
+                    case _ if _updates(command, payload):
+                        # Plain text clients don't read batches,
+                        # merged updates reach them one by one.
+                        encoded[kind] = [dumps(*operation) for operation in payload]
+                    case _:
+                        encoded[kind] = [frame]
+            return encoded[kind]
+
+        for client in self.individual:
+            if changed and client in changed:
+                if changed[client]:
+                    self._send(client, BATCH, changed[client])
+            else:
+                for message in encode(self._kind(client)):
+                    client.send(message, lossy)
+
+        for kind, viewers in self.audience.items():
+            if viewers:
+                for message in encode(kind):
+                    for viewer in viewers:
+                        viewer.send(message, lossy)
+
+    def _kind(self, connection: Connection) -> str:
+        if connection in self.binary:
+            return "binary"
+        if connection in self.sequenced:
+            return "sequenced"
+        return "text"
+
+    def _document(self, connection: Connection) -> Union[str, bytes]:
+        if self._documents_revision != self.revision:
+            self._documents = {}
+            self._documents_revision = self.revision
+
+        kind = self._kind(connection)
+        if kind not in self._documents:
+            self._documents[kind] = self._encode(
+                connection, DOCUMENT, self.document.to_list(), self.revision
+            )
+
+        return self._documents[kind]
+
+    def _send(self, connection: Connection, command: str, payload: Any) -> None:
+        connection.send(self._encode(connection, command, payload, self.revision))
+
+    def _encode(
+        self,
+        connection: Connection,
+        command: str,
+        payload: Any,
+        revision: int,
+    ) -> Union[str, bytes]:
+        if connection in self.binary:
+            return pack(revision, command, payload)
+
+        # TODO: make send json
+        frame = codec.dumps(payload) if command == DOCUMENT else dumps(command, payload)
+        if connection in self.sequenced:
+            frame = f"{revision} {frame}"
+
+        return frame
+
+    def _chunks(
+        self,
+        connection: Connection,
+        elements: list[dict],
+    ) -> Iterator[Union[str, bytes]]:
+        # Elements are never changed in place,
+        # so they are serialized as they were when the client joined.
+        revision = self.revision
+        chunk = []
+
+        for top in (True, False):
+            for position, element in enumerate(elements):
+                if ("parent" not in element) != top:
+                    continue
+
+                chunk.append((position, element))
+                if len(chunk) >= CHUNK_ELEMENTS:
+                    yield self._encode(connection, CHUNK, chunk, revision)
+                    chunk = []
+
+        if chunk:
+            yield self._encode(connection, CHUNK, chunk, revision)
+
+        yield self._encode(connection, LOADED, {"length": len(elements)}, revision)
+
+    def _apply(self, data: str, kind: str = OPERATION) -> tuple[str, str, Any, dict]:
+        worker, user, frame = data.split(" ", 2)
+        command, payload = parse(frame)
+        found = self.document.expand(operations(command, payload))
+
+        inverse = None
+        if worker == self.worker and user != ANONYMOUS:
+            inverse = []
+
+        prepared = None if self.viewports is None else self.viewports.prepare(found)
+        self.document.apply_batch(found, inverse)
+        self.used = time.monotonic()
+        if inverse:
+            history = self.histories.setdefault(user, History())
+            history.record(inverse, None if kind == OPERATION else kind)
+        self.revision += 1
+        # Structural frames depend on the document, resyncs get their operations.
+        expanded = dumps(BATCH, found) if command in STRUCTURAL else frame
+        self.recent.append((self.revision, expanded))
+
+        change = None
+        if worker == self.worker:
+            change = {
+                "project_id": self.project_id,
+                "seq": self.revision,
+                "user_id": None if user == ANONYMOUS else int(user),
+                "message": frame,
+            }
+        self.flusher.mark_dirty(self.document, self.revision, change)
+
+        changed = {}
+        if prepared is not None:
+            changed = self.viewports.update(found, prepared)
+
+        return frame, command, payload, changed
+
+
+def _updates(command: str, payload: Any) -> bool:
+    return command == BATCH and all(
+        operation_command == "update" for operation_command, _ in payload
+    )
+
+
+class Rooms:
+    """
+    Rooms of the projects opened in the current worker.
+
+    Rooms idle for too long are evicted, and so are the least recently
+    used ones while documents exceed the memory budget.
+    Clients of a room evicted for the budget reconnect at once, so it is
+    evicted for the budget at most once per cooldown: evicting it again
+    would churn reloads without saving memory.
+    Rooms that may have missed messages of other workers are stale,
+    they are evicted as soon as possible.
+    Clients of an evicted room are disconnected,
+    the document is persisted and loaded again on their reconnect.
+    """
+
+    def __init__(self, broadcast: Broadcast) -> None:
+        """
+        Initializes a new instance of the Rooms class.
+
+        Args:
+            broadcast: channels shared by the workers.
+        """
+
+        self.broadcast = broadcast
+        self.worker = uuid.uuid4().hex
+        self.rooms: dict[int, Room] = {}
+        self.scheduler = Scheduler()
+        # Times projects were last evicted for the memory budget.
+        self.evicted: dict[int, float] = {}
+
+        self._wake = asyncio.Event()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._reaper: Optional[asyncio.Task] = None
+
+        broadcast.on_missed(self._missed)
+
+    def start(self) -> None:
+        """
+        Starts evicting rooms and reaping dead clients periodically.
+
+        Returns:
+            None.
+        """
+
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_periodically())
+
+    async def join(
+        self,
+        project: Project,
+        connection: Connection,
+        session: AsyncSession,
+    ) -> Room:
+        """
+        Adds the client to the project room, opening it if needed.
+
+        Args:
+            project: project to edit,
+            its content is parsed only when the room is opened.
+            connection: client connection.
+            session: db async session the project was loaded with.
+
+        Returns:
+            Room: project room with the loaded document.
+        """
+
+        room = self.rooms.get(project.id)
+        if room is None:
+            room = Room(project.id, self.broadcast, self.worker, self.scheduler)
+            self.rooms[project.id] = room
+            room.connections.add(connection)
+            try:
+                await room.open(project, session)
+            except BaseException:
+                # Clients waiting for the room open it again.
+                del self.rooms[project.id]
+                try:
+                    await room.close()
+                finally:
+                    room.ready.set()
+                raise
+
+            if room.stale or self.size() > MEMORY_BUDGET:
+                self._wake.set()
+        else:
+            room.connections.add(connection)
+            await room.ready.wait()
+
+            if room.document is None:
+                room.connections.discard(connection)
+                return await self.join(project, connection, session)
+
+        return room
+
+    async def leave(self, room: Room, connection: Connection) -> None:
+        """
+        Removes the client from the room,
+        the last one closes the room and persists the document.
+        Clients already removed are ignored.
+
+        Args:
+            room: project room.
+            connection: client connection.
+
+        Returns:
+            None.
+        """
+
+        if connection not in room.connections:
+            return
+
+        room.discard(connection)
+        if not room.connections:
+            await self._release(room)
+
+    def size(self) -> int:
+        """
+        Provides estimated memory used by documents of the rooms.
+
+        Returns:
+            int: size in bytes.
+        """
+
+        return sum(
+            room.document.size
+            for room in self.rooms.values()
+            if room.document is not None
+        )
+
+    async def evict(self, room: Room) -> None:
+        """
+        Disconnects clients of the room, persists the document and closes it.
+
+        Args:
+            room: project room.
+
+        Returns:
+            None.
+        """
+
+        room_evictions.inc()
+
+        for connection in list(room.connections):
+            connection.disconnect(status.WS_1001_GOING_AWAY)
+            room.discard(connection)
+
+        await self._release(room)
+
+    async def sweep(self) -> None:
+        """
+        Evicts stale and idle rooms and least recently used ones
+        until documents fit the memory budget.
+        The most recently used room is never evicted for the budget,
+        nor rooms evicted for it within the cooldown.
+
+        Returns:
+            None.
+        """
+
+        now = time.monotonic()
+        size = self.size()
+        candidates = sorted(
+            (room for room in self.rooms.values() if room.ready.is_set()),
+            key=lambda room: room.used,
+        )
+
+        for room in candidates:
+            if room.stale and not room.pinned:
+                size -= room.document.size
+                await self.evict(room)
+        candidates = [room for room in candidates if not room.stale]
+
+        self.evicted = {
+            project_id: evicted
+            for project_id, evicted in self.evicted.items()
+            if now - evicted < EVICTION_COOLDOWN
+        }
+
+        for index, room in enumerate(candidates):
+            idle = now - room.used >= ROOM_IDLE_TIMEOUT
+            over = size > MEMORY_BUDGET and index < len(candidates) - 1
+            if not idle and not over:
+                break
+            if room.pinned:
+                continue
+            if not idle:
+                if room.project_id in self.evicted:
+                    continue
+                self.evicted[room.project_id] = now
+
+            size -= room.document.size
+            await self.evict(room)
+
+        documents_size.set(self.size())
+
+    async def reap(self) -> int:
+        """
+        Pings silent clients and disconnects dead ones,
+        their handlers may never see the disconnect.
+
+        Returns:
+            int: amount of disconnected clients.
+        """
+
+        reaped = 0
+
+        for room in list(self.rooms.values()):
+            for connection in room.heartbeat():
+                connection.disconnect(status.WS_1001_GOING_AWAY)
+                await self.leave(room, connection)
+                reaped += 1
+
+        reaped_connections.inc(reaped)
+
+        return reaped
+
+    def _missed(self) -> None:
+        # Rooms stop changing after the messages received before,
+        # so their documents are persisted consistent.
+        expired = [room.expire() for room in self.rooms.values()]
+        if expired:
+            asyncio.gather(*expired).add_done_callback(lambda _: self._wake.set())
+
+    async def _release(self, room: Room) -> None:
+        await room.flusher.close()
+
+        # Someone could join while the document was being written.
+        if room.connections or self.rooms.get(room.project_id) is not room:
+            return
+
+        del self.rooms[room.project_id]
+        await room.close()
+
+    async def _sweep_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), EVICTION_INTERVAL)
+            except TimeoutError:
+                pass
+            self._wake.clear()
+
+            # Rooms failed to persist stay opened until the next sweep.
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Rooms are not swept.")
+
+    async def _reap_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+            # A room failed to persist stays opened until it is swept,
+            # clients left are reaped next time.
+            try:
+                await self.reap()
+            except Exception:
+                logger.exception("Dead clients are not reaped.")
+
+    @asynccontextmanager
+    async def opened(
+        self,
+        project: Project,
+        session: AsyncSession,
+    ) -> AsyncIterator[Room]:
+        """
+        Keeps the project room opened like a connected client does,
+        used to read or change the actual document outside of sockets.
+
+        Args:
+            project: project to edit.
+            session: db async session the project was loaded with.
+
+        Yields:
+            Room: project room with the loaded document.
+        """
+
+        holder = object()
+        room = await self.join(project, holder, session)
+        room.pinned += 1
+        try:
+            yield room
+        finally:
+            room.pinned -= 1
+            await self.leave(room, holder)
+
+    async def close(self) -> None:
+        """
+        Persists documents of every room, used on shutdown.
+        Rooms failed to persist don't stop the others.
+
+        Returns:
+            None.
+        """
+
+        for task in (self._sweeper, self._reaper):
+            if task is not None:
+                task.cancel()
+        self._sweeper = self._reaper = None
+
+        while self.rooms:
+            project_id, room = self.rooms.popitem()
+            try:
+                await room.close()
+            except Exception:
+                logger.exception("Room of project %s is not persisted.", project_id)
+
+        await self.broadcast.close()
+
+
+rooms = Rooms(broadcast)
+
+
+async def get_rooms() -> Rooms:
+    """
+    Provides rooms of the current worker.
+
+    Returns:
+        Rooms: rooms registry.
+    """
+
+    return rooms
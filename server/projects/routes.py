@@ -1,16 +1,36 @@
 import datetime
-import json
 import os
-from typing import Any, Awaitable, List
+import time
+from typing import Any, Awaitable, List, Optional
 
-from fastapi import APIRouter, Depends, WebSocket
+from fastapi import APIRouter, Cookie, Depends, Query, Response, WebSocket
 from jose import jwt
 from server.auth.models import User
-from server.projects import content
-from server.projects.models import Change, Join, Project, ProjectComment
+from server.projects.connection import Connection
+from server.projects.content import STRUCTURAL
+from server.projects.limits import Limiter, rejected_bytes, rejected_frames
+from server.projects.models import Change, Join, Project, ProjectComment, Version
+from server.projects.protocol import (
+    BATCH,
+    BINARY_SUBPROTOCOL,
+    PONG,
+    PRESENCE,
+    RECT,
+    REDO,
+    UNDO,
+    VIEWPORT,
+    dumps,
+    operations,
+    parse,
+    presence,
+    unpack,
+    viewport,
+)
+from server.projects.rooms import Rooms, get_rooms
 from server.projects.schemas import (
     AccessSchema,
     ChangeItemsSchema,
+    DiffSchema,
     JoinCreateSchema,
     JoinDBSchema,
     ProjectCommentCreateSchema,
@@ -19,11 +39,22 @@ from server.projects.schemas import (
     ProjectDBSchema,
     ProjectUpdateSchema,
     TokenSchema,
+    VersionCreateSchema,
+    VersionDBSchema,
+    VersionItemsSchema,
+)
+from server.projects.storage import content
+from server.projects.versions import (
+    diff,
+    load_version,
+    restore_operations,
+    save_version,
 )
+from server.root import codec
 from server.root.auth import get_current_user
-from server.root.cache import get_clients_storage
-from server.root.db import get_db
-from server.root.settings import ALGORITHM, TOKEN_EXPIRE
+from server.root.cache import get_cache_storage
+from server.root.db import get_db, pooled_session
+from server.root.settings import ALGORITHM, DIFF_CACHE_TTL, MAX_FRAME, TOKEN_EXPIRE
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from starlette.exceptions import HTTPException
@@ -181,6 +212,8 @@ async def item(
             detail=f"Project with id {item_id} doesn't exist.",
         )
 
+    project.content = await content(project, db)
+
     return project
 
 
@@ -223,6 +256,8 @@ async def update(
             status_code=status.HTTP_400_BAD_REQUEST,
         )
 
+    project.content = await content(project, db)
+
     return project
 
 
@@ -293,19 +328,207 @@ async def changes(
     }
 
 
+@router.get("/{item_id}/versions", response_model=VersionItemsSchema)
+async def versions(
+    item_id: int,
+    db: AsyncSession = Depends(get_db),
+) -> Awaitable[dict[str, Any]]:
+    """
+    Get versions of the project, oldest first.
+
+    Args:
+        item_id: project id as integer.
+        db: db async session.
+
+    Returns:
+        dict[str, Any]: versions with their amount.
+    """
+
+    data = [_ async for _ in Version.by_project(item_id, db)]
+    return {
+        "data": data,
+        "length": len(data),
+    }
+
+
+@router.post(
+    "/{item_id}/versions",
+    response_model=VersionDBSchema,
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_version(
+    item_id: int,
+    data: VersionCreateSchema,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    rooms: Rooms = Depends(get_rooms),
+) -> Awaitable[Version]:
+    """
+    Save the actual project content as a new version,
+    parts of the content stored by other versions are shared.
+
+    Args:
+        item_id: project id as integer.
+        data: version data as VersionCreateSchema.
+        db: db async session.
+        current_user: user making the version.
+        rooms: rooms of the projects opened in the worker.
+
+    Returns:
+        Version: created version data.
+
+    Raises:
+        HTTPException: 404 if project with specified id not found.
+    """
+
+    project = await Project.by_id(item_id, db)
+    if project is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Project with id {item_id} doesn't exist.",
+        )
+
+    async with rooms.opened(project, db) as room:
+        return await save_version(
+            item_id,
+            data.title,
+            current_user.id,
+            room.document,
+            room.revision,
+            db,
+        )
+
+
+@router.get(
+    "/{item_id}/versions/{version_id}/diff/{other_id}",
+    response_model=DiffSchema,
+)
+async def diff_versions(
+    item_id: int,
+    version_id: int,
+    other_id: int,
+    db: AsyncSession = Depends(get_db),
+    cache_storage=Depends(get_cache_storage),
+) -> Response:
+    """
+    Get changes of elements from one version to another.
+    Versions never change, so diffs are cached by their contents
+    for a while, diffs may be large.
+
+    Args:
+        item_id: project id as integer.
+        version_id: id of the older version.
+        other_id: id of the newer version.
+        db: db async session.
+        cache_storage: key-value storage interface.
+
+    Returns:
+        Response: diff as DiffSchema.
+
+    Raises:
+        HTTPException: 404 if any of the versions not found.
+    """
+
+    versions = []
+    for id in (version_id, other_id):
+        version = await Version.by_id(id, db)
+        if version is None or version.project_id != item_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Version with id {id} doesn't exist.",
+            )
+        versions.append(version)
+
+    key = f"diff:{versions[0].manifest}:{versions[1].manifest}"
+    data = await cache_storage.get(key)
+    if data is None:
+        data = codec.dumps(
+            diff(
+                await load_version(versions[0], db),
+                await load_version(versions[1], db),
+            )
+        )
+        await cache_storage.set(key, data, expire=DIFF_CACHE_TTL)
+
+    return Response(content=data, media_type="application/json")
+
+
+@router.post("/{item_id}/versions/{version_id}/restore", response_model=ProjectDBSchema)
+async def restore_version(
+    item_id: int,
+    version_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    rooms: Rooms = Depends(get_rooms),
+) -> Awaitable[Project]:
+    """
+    Restore the project content of the version.
+    Connected clients receive a batch of the changed elements.
+
+    Args:
+        item_id: project id as integer.
+        version_id: version id as integer.
+        db: db async session.
+        current_user: user restoring the version.
+        rooms: rooms of the projects opened in the worker.
+
+    Returns:
+        Project: project data with the restored content.
+
+    Raises:
+        HTTPException: 404 if project or its version not found.
+    """
+
+    project = await Project.by_id(item_id, db)
+    version = await Version.by_id(version_id, db)
+    if project is None or version is None or version.project_id != item_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Version with id {version_id} doesn't exist.",
+        )
+
+    elements = await load_version(version, db)
+
+    async with rooms.opened(project, db) as room:
+        found = restore_operations(room.document, elements)
+        if found:
+            await room.publish(dumps(BATCH, found), current_user.id)
+
+    project.content = codec.dumps(elements)
+
+    return project
+
+
 @router.websocket("/{identifier}/content")
 async def manage(
     identifier: str,
     socket: WebSocket,
-    db: AsyncSession = Depends(get_db),
-    clients_storage=Depends(get_clients_storage),
+    session: Optional[str] = Cookie(None),
+    seq: Optional[int] = Query(None),
+    rect: Optional[str] = Query(None, alias="viewport"),
+    chunked: bool = Query(False),
+    cache_storage=Depends(get_cache_storage),
+    rooms: Rooms = Depends(get_rooms),
 ) -> None:
     """
     Collects project content changes from the client
     and notifies other clients about this.
+    Frames are text unless the client asks for the msgpack subprotocol.
+    Presence frames are shared with other clients at a capped rate,
+    undo and redo frames revert changes of the user.
+    Silent clients are pinged and disconnected if they don't answer.
+    Frames are limited in size and rate.
 
     Args:
         socket: client socket.
+        session: session id from cookie, identifies the author of changes.
+        seq: sequence number of the last operation received
+        before reconnect, enables sequence numbers of operations.
+        rect: viewport as "x,y,width,height",
+        only visible elements are sent to the client.
+        chunked: stream the document in chunks.
+        cache_storage: key-value storage interface.
+        rooms: rooms of the projects opened in the worker.
 
     Returns:
         None.
@@ -320,70 +543,118 @@ async def manage(
         item_id = int(payload["id"])
         credential = payload["credential"]
 
-    project = await Project.by_id(item_id, db)
-    if project is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Project with id {item_id} doesn't exist.",
-        )
-
-    await socket.accept()
+    # Link holders are not the author of the link,
+    # they are anonymous unless they have their own session.
+    user_id = None
+    if session is not None:
+        user_id = await cache_storage.get(session)
+    if user_id is not None:
+        user_id = int(user_id)
 
-    clients = await clients_storage.get(project.id)
-    if clients is None:
-        clients = {socket}
-    else:
-        clients.add(socket)
-    await clients_storage.set(project.id, clients)
-
-    # TODO: make send json
+    if rect is not None:
+        try:
+            rect = viewport(dict(zip(RECT, map(float, rect.split(",")))))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid viewport.",
+            )
+
+    connection = None
+    room = None
+
+    # The client leaves the room on any exit, dead sockets are never kept,
+    # even if the session is not closed after the client joins.
     try:
-        await socket.send_text(project.content)
+        # The socket outlives any session, one is held only to load the project,
+        # so editors are not limited by the size of the pool.
+        async with pooled_session() as db:
+            project = await Project.by_id(item_id, db)
+            if project is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Project with id {item_id} doesn't exist.",
+                )
+
+            # Text frames stay the default, binary ones are negotiated.
+            binary = BINARY_SUBPROTOCOL in socket.scope.get("subprotocols", [])
+            await socket.accept(subprotocol=BINARY_SUBPROTOCOL if binary else None)
+
+            connection = Connection(socket)
+            connection.start()
+
+            room = await rooms.join(project, connection, db)
+
+        limiter = Limiter()
+        room.add(connection, seq, binary, rect, chunked, credential != "edit")
+
+        while True:
+            if binary:
+                data = await socket.receive_bytes()
+            else:
+                message = await socket.receive_text()
+            connection.received = time.monotonic()
+
+            # The room of a disconnected client may be closed already.
+            if connection.closed:
+                continue
+
+            size = len(data) if binary else len(message)
+            if size > MAX_FRAME:
+                rejected_frames.inc()
+                rejected_bytes.inc(size)
+                connection.disconnect(status.WS_1009_MESSAGE_TOO_BIG)
+                continue
+
+            # Workers apply only valid operations.
+            try:
+                command, payload = unpack(data) if binary else parse(message)
+
+                # Batches and structural commands cost as much as their elements.
+                cost = 1
+                if command == BATCH and isinstance(payload, list):
+                    cost = len(payload)
+                elif command in STRUCTURAL and isinstance(payload, dict):
+                    ids = payload.get("ids")
+                    cost = max(len(ids), 1) if isinstance(ids, list) else 1
+                if not await limiter.admit(cost, size):
+                    if limiter.policy == "close":
+                        connection.disconnect(status.WS_1008_POLICY_VIOLATION)
+                    continue
+
+                if command == PONG:
+                    continue
+                if command == VIEWPORT:
+                    room.move(connection, viewport(payload))
+                    continue
+                # Viewers share presence too, it is never persisted.
+                if command == PRESENCE:
+                    room.present(connection, user_id, presence(payload))
+                    continue
+                if credential != "edit":
+                    continue
+                if command in (UNDO, REDO):
+                    await room.revert(command, user_id)
+                    continue
+
+                operations(command, payload)
+            except ValueError:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid command.",
+                )
+
+            if command == "update":
+                await room.update(payload, user_id)
+                continue
+
+            if binary:
+                message = dumps(command, payload)
+            await room.publish(message, user_id)
     except WebSocketDisconnect:
-        clients.remove(socket)
-        await clients_storage.set(project.id, clients)
-
-    content_list = json.loads(project.content)
-
-    while True:
-        try:
-            message = await socket.receive_text()
-
-            if credential == "edit":
-                command, data = message.split(" ", 1)
-
-                element_data = json.loads(data)
-
-                match command:
-                    case "create":
-                        content_list = content.create(content_list, element_data)
-                    case "update":
-                        content_list = content.update(content_list, element_data)
-                    case "delete":
-                        content_list = content.delete(content_list, element_data["id"])
-                    case "put":
-                        content_list = content.put(content_list, element_data)
-                    case _:
-                        raise HTTPException(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            detail="Invalid command.",
-                        )
-
-                await project.update({"content": json.dumps(content_list)}, db)
-
-                # # FIXME: need a real user's id here
-                # await Change.create(
-                #     ChangeDBSchema(
-                #         project_id=project.id,
-                #         user_id=1,
-                #         content=message,
-                #     ).model_dump(),
-                #     db,
-                # )
-
-                for client in clients:
-                    await client.send_text(message)
-        except WebSocketDisconnect:
-            clients.remove(socket)
-            await clients_storage.set(project.id, clients)
-            break
+        pass
+    finally:
+        if connection is not None:
+            await connection.close()
+        if room is not None:
+            await rooms.leave(room, connection)
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from server.root.metrics import histogram
+from server.root.settings import SCHEDULER_QUANTUM
+
+Job = Callable[[], Awaitable[None]]
+
+queue_latency = histogram("scheduler_queue_seconds")
+turn_time = histogram("scheduler_turn_cpu_seconds")
+
+
+class Queue:
+    """Jobs of a room waiting for the scheduler and CPU time they took."""
+
+    def __init__(self) -> None:
+        """Initializes a new instance of the Queue class."""
+
+        self.jobs: deque[tuple[Job, asyncio.Future, float]] = deque()
+        # CPU time the queue may still spend, negative after a long job.
+        self.deficit = 0.0
+        self.cpu = 0.0
+
+
+class Scheduler:
+    """
+    Runs jobs of the rooms of a worker in a single task,
+    fairly by deficit round-robin.
+
+    Jobs of a queue run in order. Every turn a queue may spend
+    a quantum of CPU time, a queue spending more skips next turns
+    until the debt is paid, so busy rooms can't starve quiet ones.
+    """
+
+    def __init__(self, quantum: float = SCHEDULER_QUANTUM) -> None:
+        """
+        Initializes a new instance of the Scheduler class.
+
+        Args:
+            quantum: CPU seconds a queue may spend in a turn.
+        """
+
+        self.quantum = quantum
+        self.ready: deque[Queue] = deque()
+
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, queue: Queue, job: Job) -> Awaitable[None]:
+        """
+        Queues the job without waiting for it,
+        jobs submitted in order run in order.
+
+        Args:
+            queue: queue of the room.
+            job: coroutine function to run.
+
+        Returns:
+            Awaitable[None]: done when the job is done,
+            raises any exception raised by the job.
+        """
+
+        # Jobs started by other jobs can't wait for their turn,
+        # they run as soon as they are awaited.
+        if self._task is not None and asyncio.current_task() is self._task:
+            return job()
+
+        future = asyncio.get_running_loop().create_future()
+        queue.jobs.append((job, future, time.perf_counter()))
+        if queue not in self.ready:
+            self.ready.append(queue)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        return future
+
+    async def run(self, queue: Queue, job: Job) -> None:
+        """
+        Queues the job and waits until it is done.
+
+        Args:
+            queue: queue of the room.
+            job: coroutine function to run.
+
+        Returns:
+            None.
+
+        Raises:
+            Exception: any exception raised by the job.
+        """
+
+        await self.submit(queue, job)
+
+    async def _run(self) -> None:
+        try:
+            while self.ready:
+                queue = self.ready.popleft()
+                queue.deficit += self.quantum
+                start = time.thread_time()
+
+                while queue.jobs and queue.deficit > 0:
+                    job, future, queued = queue.jobs.popleft()
+                    queue_latency.observe(time.perf_counter() - queued)
+
+                    began = time.thread_time()
+                    try:
+                        await job()
+                    except Exception as error:
+                        if not future.done():
+                            future.set_exception(error)
+                    else:
+                        if not future.done():
+                            future.set_result(None)
+
+                    spent = time.thread_time() - began
+                    queue.deficit -= spent
+                    queue.cpu += spent
+
+                if queue.jobs:
+                    self.ready.append(queue)
+                else:
+                    # Idle queues don't save up time, debts are kept.
+                    queue.deficit = min(queue.deficit, 0)
+
+                turn_time.observe(time.thread_time() - start)
+                # Clients of other rooms are served between the turns.
+                await asyncio.sleep(0)
+        finally:
+            self._task = None
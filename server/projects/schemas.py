@@ -43,8 +43,9 @@ class ChangeDBSchema(EntityDBSchema):
     """Change data in the database."""
 
     project_id: int
-    user_id: int
-    content: str
+    seq: int
+    user_id: Optional[int]
+    message: str
 
 
 class ChangeItemsSchema(BaseModel):
@@ -54,6 +55,39 @@ class ChangeItemsSchema(BaseModel):
     data: list[ChangeDBSchema]
 
 
+class VersionCreateSchema(BaseModel):
+    """Information to create a version of a project."""
+
+    title: str = Field(
+        min_length=1,
+        max_length=255,
+    )
+
+
+class VersionDBSchema(VersionCreateSchema, EntityDBSchema):
+    """Version data in the database."""
+
+    project_id: int
+    revision: int
+    user_id: Optional[int]
+
+
+class VersionItemsSchema(BaseModel):
+    """Details of requested versions with some additional information."""
+
+    length: int
+    data: list[VersionDBSchema]
+
+
+class DiffSchema(BaseModel):
+    """Changes of elements between two versions of a project."""
+
+    added: list[dict]
+    removed: list[dict]
+    moved: list[dict]
+    changed: list[dict]
+
+
 class JoinCreateSchema(BaseModel):
     """Information to join another user to a project."""
 
@@ -0,0 +1,444 @@
+import math
+import sys
+from typing import Any, Hashable, Iterable, Optional
+
+from server.projects.content import Document
+from server.root.settings import GRID_CELL
+
+# x, y, width and height in the canvas coordinates.
+Rect = tuple[float, float, float, float]
+
+# Elements covering more cells are checked by every query.
+LARGE_CELLS = 64
+
+
+def bounds(element: dict) -> Rect:
+    """
+    Provides the rectangle of the element,
+    attributes with default values are not stored,
+    invalid ones are considered default.
+
+    Args:
+        element: element data.
+
+    Returns:
+        Rect: element rectangle.
+    """
+
+    return tuple(_number(element.get(key)) for key in ("x", "y", "width", "height"))
+
+
+def intersects(first: Rect, second: Rect) -> bool:
+    """
+    Checks if the rectangles intersect, touching counts.
+
+    Args:
+        first: first rectangle.
+        second: second rectangle.
+
+    Returns:
+        bool: True if the rectangles intersect, False otherwise.
+    """
+
+    return (
+        first[0] <= second[0] + second[2]
+        and second[0] <= first[0] + first[2]
+        and first[1] <= second[1] + second[3]
+        and second[1] <= first[1] + first[3]
+    )
+
+
+class Grid:
+    """
+    Uniform grid of square cells over rectangles,
+    a rectangle is kept in every cell it covers.
+    """
+
+    def __init__(self, cell: float = GRID_CELL) -> None:
+        """
+        Initializes a new instance of the Grid class.
+
+        Args:
+            cell: cell size.
+        """
+
+        self.cell = cell
+        self.rects: dict[Hashable, Rect] = {}
+        self.cells: dict[tuple[int, int], set[Hashable]] = {}
+        self.large: set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self.rects)
+
+    def __contains__(self, id: Hashable) -> bool:
+        return id in self.rects
+
+    def add(self, id: Hashable, rect: Rect) -> None:
+        """
+        Adds the rectangle or moves it.
+
+        Args:
+            id: rectangle id.
+            rect: rectangle.
+
+        Returns:
+            None.
+        """
+
+        if self.rects.get(id) == rect:
+            return
+
+        self.discard(id)
+        self.rects[id] = rect
+
+        cells = self._cells(rect)
+        if cells is None:
+            self.large.add(id)
+            return
+
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(id)
+
+    def discard(self, id: Hashable) -> None:
+        """
+        Removes the rectangle, if any.
+
+        Args:
+            id: rectangle id.
+
+        Returns:
+            None.
+        """
+
+        rect = self.rects.pop(id, None)
+        if rect is None:
+            return
+
+        cells = self._cells(rect)
+        if cells is None:
+            self.large.discard(id)
+            return
+
+        for cell in cells:
+            ids = self.cells[cell]
+            ids.discard(id)
+            if not ids:
+                del self.cells[cell]
+
+    def query(self, rect: Rect) -> set[Hashable]:
+        """
+        Provides rectangles intersecting another one.
+
+        Args:
+            rect: rectangle to check.
+
+        Returns:
+            set[Hashable]: ids of intersecting rectangles.
+        """
+
+        cells = self._cells(rect, len(self.rects))
+        if cells is None:
+            candidates = self.rects
+        else:
+            candidates = set(self.large)
+            for cell in cells:
+                candidates.update(self.cells.get(cell, ()))
+
+        return {id for id in candidates if intersects(self.rects[id], rect)}
+
+    def intersects(self, id: Hashable, rect: Rect) -> bool:
+        """
+        Checks if the rectangle intersects another one.
+
+        Args:
+            id: rectangle id.
+            rect: rectangle to check.
+
+        Returns:
+            bool: True if the rectangle is kept and intersects,
+            False otherwise.
+        """
+
+        return id in self.rects and intersects(self.rects[id], rect)
+
+    def _cells(
+        self,
+        rect: Rect,
+        limit: int = LARGE_CELLS,
+    ) -> Optional[list[tuple[int, int]]]:
+        x, y, width, height = map(float, rect)
+        # Rectangles too far away for the cells are large.
+        if not all(math.isfinite(edge) for edge in (x, y, x + width, y + height)):
+            return None
+
+        left = math.floor(x / self.cell)
+        right = math.floor((x + width) / self.cell)
+        top = math.floor(y / self.cell)
+        bottom = math.floor((y + height) / self.cell)
+
+        if (right - left + 1) * (bottom - top + 1) > limit:
+            return None
+
+        return [
+            (column, row)
+            for column in range(left, right + 1)
+            for row in range(top, bottom + 1)
+        ]
+
+
+class View:
+    """Viewport of a client with the elements it has."""
+
+    def __init__(self, rect: Rect) -> None:
+        """
+        Initializes a new instance of the View class.
+
+        Args:
+            rect: viewport rectangle.
+        """
+
+        self.rect = rect
+        self.roots: set[Hashable] = set()
+        self.known: set[Hashable] = set()
+
+
+class Viewports:
+    """
+    Viewports of the clients editing a document.
+
+    Positions of child elements are relative to their parents,
+    so a whole tree is visible when its top-level element
+    intersects the viewport. Top-level elements are kept in a grid
+    updated by every operation, clients receive only elements
+    of visible trees and operations changing them.
+    """
+
+    def __init__(self, document: Document, cell: float = GRID_CELL) -> None:
+        """
+        Initializes a new instance of the Viewports class.
+
+        Args:
+            document: document to index.
+            cell: size of the grid cell.
+        """
+
+        self.document = document
+        self.grid = Grid(cell)
+        self.views: dict[Hashable, View] = {}
+
+        for id, element in document.elements.items():
+            if element.get("parent") not in document:
+                self.grid.add(id, bounds(element))
+
+    def __len__(self) -> int:
+        return len(self.views)
+
+    def __contains__(self, client: Hashable) -> bool:
+        return client in self.views
+
+    def add(self, client: Hashable, rect: Rect) -> list[dict]:
+        """
+        Starts tracking the viewport of a new client.
+
+        Args:
+            client: client key.
+            rect: viewport rectangle.
+
+        Returns:
+            list[dict]: visible elements in the document order.
+        """
+
+        view = View(rect)
+        view.roots = self.grid.query(rect)
+        for root in view.roots:
+            view.known.update(self._tree(root))
+        self.views[client] = view
+
+        return [element for element in self.document if element["id"] in view.known]
+
+    def move(self, client: Hashable, rect: Rect) -> list[tuple[str, dict]]:
+        """
+        Changes the viewport of the client,
+        a client without a viewport is considered to have every element.
+
+        Args:
+            client: client key.
+            rect: new viewport rectangle.
+
+        Returns:
+            list[tuple[str, dict]]: operations creating elements
+            that appeared and deleting ones that disappeared.
+        """
+
+        view = self.views.get(client)
+        if view is None:
+            view = View(rect)
+            view.roots = set(self.grid.rects)
+            view.known = set(self.document.elements)
+            self.views[client] = view
+
+        view.rect = rect
+        roots = self.grid.query(rect)
+        ids = set()
+        for root in roots ^ view.roots:
+            ids.update(self._tree(root))
+        view.roots = roots
+
+        creates, deletes = self._reconcile(view, ids)
+
+        return creates + deletes
+
+    def discard(self, client: Hashable) -> None:
+        """
+        Stops tracking the viewport of the client.
+
+        Args:
+            client: client key.
+
+        Returns:
+            None.
+        """
+
+        self.views.pop(client, None)
+
+    def prepare(self, operations: list[tuple[str, dict]]) -> set[Hashable]:
+        """
+        Collects elements the operations may hide or move,
+        called before the operations are applied.
+
+        Args:
+            operations: pairs of command and element data.
+
+        Returns:
+            set[Hashable]: ids of the elements and of their top-level ones.
+        """
+
+        ids = set()
+
+        for command, element_data in operations:
+            id = element_data["id"]
+            if id not in self.document:
+                continue
+
+            ids.add(self._root(id))
+            if command == "delete" or "parent" in element_data:
+                ids.update(self.document.descendants(id))
+
+        return ids
+
+    def update(
+        self,
+        operations: list[tuple[str, dict]],
+        prepared: set[Hashable],
+    ) -> dict[Hashable, list[tuple[str, dict]]]:
+        """
+        Updates the grid after the operations are applied
+        and provides operations for every client.
+
+        Args:
+            operations: applied pairs of command and element data.
+            prepared: ids collected by prepare.
+
+        Returns:
+            dict[Hashable, list[tuple[str, dict]]]: operations
+            of the clients that should not receive all of them.
+        """
+
+        ids = set(prepared)
+        for command, element_data in operations:
+            id = element_data["id"]
+            ids.add(id)
+            if id in self.document:
+                ids.add(self._root(id))
+                if command == "create" or "parent" in element_data:
+                    ids.update(self.document.children.get(id, ()))
+                    ids.update(self.document.descendants(id))
+
+        for id in ids:
+            element = self.document.get(id)
+            if element is not None and element.get("parent") not in self.document:
+                self.grid.add(id, bounds(element))
+            else:
+                self.grid.discard(id)
+
+        changed = {}
+
+        for client, view in self.views.items():
+            found = set(ids)
+            for id in ids:
+                if id in self.grid:
+                    visible = self.grid.intersects(id, view.rect)
+                    if visible != (id in view.roots):
+                        found.update(self._tree(id))
+                    if visible:
+                        view.roots.add(id)
+                        continue
+                view.roots.discard(id)
+
+            creates, deletes = self._reconcile(view, found)
+            # Created elements are sent in their actual state,
+            # only their order is left to the operations.
+            created = {element["id"] for _, element in creates}
+            forwarded = [
+                (command, element_data)
+                for command, element_data in operations
+                if element_data["id"] in view.known
+                and (command == "put" or element_data["id"] not in created)
+            ]
+
+            if creates or deletes or len(forwarded) != len(operations):
+                changed[client] = creates + forwarded + deletes
+
+        return changed
+
+    def _reconcile(
+        self,
+        view: View,
+        ids: Iterable[Hashable],
+    ) -> tuple[list[tuple[str, dict]], list[tuple[str, dict]]]:
+        created = []
+        deletes = []
+
+        for id in ids:
+            wanted = id in self.document and self._root(id) in view.roots
+            if wanted and id not in view.known:
+                created.append(id)
+            elif not wanted and id in view.known:
+                deletes.append(("delete", {"id": id}))
+                view.known.discard(id)
+
+        # Parents are created before their children.
+        created.sort(key=self._depth)
+        view.known.update(created)
+
+        return [("create", self.document.get(id)) for id in created], deletes
+
+    def _tree(self, root: Hashable) -> list[Hashable]:
+        if root not in self.document:
+            return []
+
+        return [root] + self.document.descendants(root)
+
+    def _ancestors(self, id: Hashable) -> list[Hashable]:
+        found = [id]
+        visited = {id}
+
+        parent = self.document.get(id).get("parent")
+        while parent in self.document and parent not in visited:
+            found.append(parent)
+            visited.add(parent)
+            parent = self.document.get(parent).get("parent")
+
+        return found
+
+    def _root(self, id: Hashable) -> Hashable:
+        return self._ancestors(id)[-1]
+
+    def _depth(self, id: Hashable) -> int:
+        return len(self._ancestors(id))
+
+
+def _number(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0
+    return float(value) if abs(value) <= sys.float_info.max else 0
@@ -0,0 +1,201 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Hashable, Optional
+
+from server.projects.content import Document
+from server.projects.models import Change, Element, Project
+from server.projects.protocol import operations, parse
+from server.root.codec import dumps, dumps_list, loads
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class ContentStorage(ABC):
+    """
+    Provides a way to store snapshots of the project content.
+
+    Any storage loads content written by another one,
+    so the storage of a running project can be changed.
+    """
+
+    @abstractmethod
+    async def dump(self, document: Document, dirty: Optional[set[Hashable]]) -> Any:
+        """
+        Prepares the document to be written, other tasks may run
+        and change the document meanwhile, the data reflects
+        the document as it was when called.
+
+        Args:
+            document: project document.
+            dirty: ids of elements changed since the last snapshot,
+            None if the document is not stored element-wise.
+
+        Returns:
+            Any: data to write.
+        """
+
+        pass
+
+    @abstractmethod
+    async def save(
+        self,
+        project_id: int,
+        data: Any,
+        revision: int,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Writes the prepared document unless a newer one is stored.
+
+        Args:
+            project_id: project id.
+            data: data prepared by dump.
+            revision: sequence number of the last change in the document.
+            session: db async session, it isn't committed.
+
+        Returns:
+            None.
+        """
+
+        pass
+
+
+class DocumentStorage(ContentStorage):
+    """
+    Stores the whole document as JSON array in Project.content,
+    every snapshot rewrites it.
+    """
+
+    async def dump(self, document: Document, dirty: Optional[set[Hashable]]) -> str:
+        # Large documents are serialized in slices not to block the loop.
+        return await dumps_list(document.to_list())
+
+    async def save(
+        self,
+        project_id: int,
+        data: str,
+        revision: int,
+        session: AsyncSession,
+    ) -> None:
+        await Project.save_snapshot(project_id, data, revision, session)
+
+
+class ElementStorage(ContentStorage):
+    """
+    Stores every element as a row of the elements table,
+    a snapshot rewrites only the changed rows.
+    """
+
+    async def dump(
+        self,
+        document: Document,
+        dirty: Optional[set[Hashable]],
+    ) -> tuple[list[dict], Optional[list[str]]]:
+        ids = document.elements if dirty is None else dirty
+
+        elements = [
+            {
+                "after": _dumps_id(document.previous(id)),
+                "data": dumps(document.get(id)),
+                "element_id": json.dumps(id),
+                "parent": _dumps_id(document.get(id).get("parent")),
+            }
+            for id in ids
+            if id in document
+        ]
+        element_ids = None if dirty is None else [json.dumps(id) for id in dirty]
+
+        return elements, element_ids
+
+    async def save(
+        self,
+        project_id: int,
+        data: tuple[list[dict], Optional[list[str]]],
+        revision: int,
+        session: AsyncSession,
+    ) -> None:
+        elements, element_ids = data
+
+        if not await Project.save_snapshot(project_id, "", revision, session):
+            return
+
+        for element in elements:
+            element["project_id"] = project_id
+        await Element.replace(project_id, element_ids, elements, session)
+
+
+async def load(project: Project, session: AsyncSession) -> Document:
+    """
+    Loads the project content stored by any storage.
+
+    Args:
+        project: project to load.
+        session: db async session.
+
+    Returns:
+        Document: project document.
+    """
+
+    if project.content:
+        return Document.loads(project.content)
+
+    # Rows follow the previous ones, the first row follows nothing.
+    rows = {}
+    async for element in Element.by_project(project.id, session):
+        rows[element.after] = element
+
+    elements = []
+    after = None
+    while after in rows:
+        element = rows.pop(after)
+        elements.append(loads(element.data))
+        after = element.element_id
+
+    # Rows cut off from the order are not lost.
+    elements.extend(loads(element.data) for element in rows.values())
+
+    document = Document(elements)
+    document.dirty = set()
+
+    return document
+
+
+async def content(project: Project, session: AsyncSession) -> str:
+    """
+    Provides the project content stored by any storage.
+
+    Args:
+        project: project to load.
+        session: db async session.
+
+    Returns:
+        str: project content as JSON array, with changes
+        logged after the last snapshot.
+    """
+
+    # Snapshots are taken every few operations, later ones are in the log.
+    changes = Change.by_project(project.id, session, project.revision)
+    tail = [change async for change in changes]
+    if project.content and not tail:
+        return project.content
+
+    document = await load(project, session)
+    for change in tail:
+        found = operations(*parse(change.message))
+        document.apply_batch(document.expand(found))
+
+    return document.dumps()
+
+
+def _dumps_id(id: Optional[Hashable]) -> Optional[str]:
+    # Ids are keys of stored rows, so their format never changes.
+    return None if id is None else json.dumps(id)
+
+
+match os.getenv("CONTENT_STORAGE"):
+    case "document":
+        storage = DocumentStorage()
+    case "elements":
+        storage = ElementStorage()
+    case _:
+        storage = DocumentStorage()
@@ -1,27 +1,63 @@
-from typing import Any
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Iterator, Optional
 
+import msgpack
 import pytest
+from fastapi.testclient import TestClient
+from server.projects.connection import Connection
 from server.projects.content import (
+    Document,
+    History,
     _is_default,
     _remove_defaults,
-    create,
-    delete,
-    put,
-    update,
 )
+from server.projects.flusher import Flusher
+from server.projects.limits import Limiter
+from server.projects.models import Blob, Change, Element, Project, Version
+from server.projects.protocol import (
+    operations,
+    pack,
+    parse,
+    presence,
+    unpack,
+    viewport,
+)
+from server.projects.rooms import Rooms, rooms
+from server.projects.scheduler import Queue, Scheduler
+from server.projects.spatial import Grid, Viewports
+from server.projects.storage import ElementStorage, content, load
+from server.projects.versions import (
+    chunks,
+    diff,
+    load_version,
+    restore_operations,
+    save_version,
+)
+from server.root.asgi import app
+from server.root.broadcast import MemoryBroadcast
+from server.root.db import init_db, session_maker
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 
 
 def test_create():
-    content_list = []
+    document = Document()
 
     element_data = {
         "id": 1,
         "name": "test",
     }
 
-    create(content_list, element_data)
+    document.create(element_data)
 
-    assert element_data in content_list
+    assert element_data in document.to_list()
 
 
 def test_create_duplicates_id():
@@ -30,18 +66,99 @@ def test_create_duplicates_id():
         "name": "test",
     }
 
-    content_list = [
-        element_data,
-    ]
+    document = Document([element_data])
 
     duplicates_list = [
         element_data,
         element_data,
     ]
 
-    create(content_list, element_data)
+    assert not document.create(element_data)
+    assert document.to_list() != duplicates_list
+
+
+def test_update_removes_defaults():
+    document = Document([{"id": 1, "name": "test", "x": 10}])
+
+    document.update({"id": 1, "x": 0, "y": 5})
+
+    assert document.to_list() == [{"id": 1, "name": "test", "y": 5}]
 
-    assert content_list != duplicates_list
+
+def test_update_reparents():
+    document = Document([{"id": 1}, {"id": 2}, {"id": 3, "parent": 1}])
+
+    document.update({"id": 3, "parent": 2})
+    document.delete(2)
+
+    assert document.to_list() == [{"id": 1}]
+
+
+@pytest.mark.parametrize(
+    "element_data, order",
+    [
+        ({"id": 3}, [3, 1, 2]),
+        ({"id": 1, "after": 2}, [2, 1, 3]),
+        ({"id": 3, "after": 1}, [1, 3, 2]),
+        ({"id": 1, "after": 1}, [1, 2, 3]),
+        ({"id": 1, "after": 4}, [1, 2, 3]),
+    ]
+)
+def test_put(element_data: dict, order: list[int]):
+    document = Document([{"id": 1}, {"id": 2}, {"id": 3}])
+
+    document.put(element_data)
+
+    assert [element["id"] for element in document] == order
+
+
+def test_delete_descendants():
+    document = Document(
+        [
+            {"id": 1},
+            {"id": 2, "parent": 1},
+            {"id": 3, "parent": 2},
+            {"id": 4},
+            {"id": 5, "parent": 4},
+        ]
+    )
+
+    document.delete(1)
+
+    assert document.to_list() == [{"id": 4}, {"id": 5, "parent": 4}]
+    assert 3 not in document
+
+
+def test_dumps_loads():
+    data = '[{"id":"a","name":"test"},{"id":"b","parent":"a"}]'
+
+    assert Document.loads(data).dumps() == data
+
+
+def test_document_size():
+    document = Document([{"id": 1}])
+    size = document.size
+
+    document.update({"id": 1, "name": "x" * 1000})
+    assert document.size > size + 1000
+
+    document.create({"id": 2, "parent": 1})
+    document.delete(1)
+    assert document.size == 0
+
+
+def test_dirty_elements():
+    document = Document([{"id": 1}, {"id": 2}, {"id": 3, "parent": 1}])
+    assert document.dirty is None
+
+    document.dirty = set()
+    document.put({"id": 3})
+    assert document.dirty == {1, 3}
+
+    document.dirty = set()
+    document.update({"id": 2, "x": 5})
+    document.delete(1)
+    assert document.dirty == {1, 2, 3}
 
 
 @pytest.mark.parametrize(
@@ -58,3 +175,1720 @@ def test_create_duplicates_id():
 )
 def test_is_default(value: Any, result: bool):
     assert _is_default(value) == result
+
+
+def test_apply_batch():
+    document = Document([{"id": 1}])
+
+    changed = document.apply_batch(
+        [
+            ("create", {"id": 2, "parent": 1}),
+            ("update", {"id": 2, "x": 5}),
+            ("put", {"id": 2}),
+            ("create", {"id": 1}),
+        ]
+    )
+
+    assert changed == 3
+    assert document.to_list() == [{"id": 2, "parent": 1, "x": 5}, {"id": 1}]
+
+
+@pytest.mark.parametrize(
+    "batch",
+    [
+        [("create", {"id": 9}), ("update", {"id": 9, "x": 1}), ("put", {"id": 9})],
+        [("update", {"id": 2, "x": 0, "y": 3, "parent": 4})],
+        [("put", {"id": 1, "after": 5}), ("put", {"id": 4})],
+        [("delete", {"id": 1}), ("delete", {"id": 4})],
+    ],
+)
+def test_inverse_restores_document(batch: list[tuple[str, dict]]):
+    elements = [
+        {"id": 1},
+        {"id": 2, "parent": 1, "x": 5},
+        {"id": 4},
+        {"id": 3, "parent": 2},
+        {"id": 5, "parent": 1},
+    ]
+    document = Document(elements)
+
+    inverse = []
+    document.apply_batch(batch, inverse)
+    assert document.to_list() != elements
+
+    document.apply_batch(inverse)
+    assert document.to_list() == elements
+
+
+def test_history_is_bounded():
+    history = History(size=60)
+    history.record([("delete", {"id": 1})])
+    history.record([("delete", {"id": 2})])
+    history.record([("delete", {"id": 3})])
+
+    assert history.pop("undo") == [("delete", {"id": 3})]
+    assert history.pop("undo") == [("delete", {"id": 2})]
+    assert history.pop("undo") is None
+
+    history.record([("create", {"id": 2})], "undo")
+    assert history.pop("redo") == [("create", {"id": 2})]
+
+    history.record([("create", {"id": 2})], "undo")
+    history.record([("delete", {"id": 4})])
+    assert history.pop("redo") is None
+
+    history.record([("create", {"id": 1, "name": "x" * 100})])
+    assert history.pop("undo") is None
+    assert history.used == 0
+
+
+def test_expand_structural_commands():
+    elements = [
+        {"id": 1, "x": 10},
+        {"id": 2, "parent": 1, "x": 5},
+        {"id": 3, "parent": 2},
+        {"id": 4},
+    ]
+    document = Document(elements)
+
+    duplicate = document.expand(
+        [("duplicate", {"id": 1, "ids": [[1, 11], [2, 12], [3, 4]]})]
+    )
+    # The element without a free id is skipped.
+    assert duplicate == [
+        ("create", {"id": 11, "x": 10}),
+        ("create", {"id": 12, "parent": 11, "x": 5}),
+    ]
+
+    inverse = []
+    group = document.expand([("group", {"id": 5, "ids": [4, 1, 9], "x": 4})])
+    document.apply_batch(group, inverse)
+    assert document.to_list() == [
+        {"id": 1, "parent": 5, "x": 6},
+        {"id": 2, "parent": 1, "x": 5},
+        {"id": 3, "parent": 2},
+        {"id": 5, "x": 4},
+        {"id": 4, "parent": 5, "x": -4},
+    ]
+
+    document.apply_batch(document.expand([("ungroup", {"id": 5})]))
+    assert document.to_list() == elements
+
+    # Elements of other parents are not grouped, ones without children kept.
+    assert document.expand([("group", {"id": 6, "ids": [2, 4], "x": 1})]) == [
+        ("create", {"id": 6, "x": 1, "parent": 1}),
+        ("put", {"id": 6, "after": 1}),
+        ("update", {"id": 2, "parent": 6, "x": 4}),
+    ]
+    assert document.expand([("ungroup", {"id": 4})]) == []
+
+    # Elements can't be moved under their descendants.
+    reparent = [("reparent", {"ids": [1, 4, 4], "parent": 3})]
+    assert document.expand(reparent) == [("update", {"id": 4, "parent": 3})]
+
+    document.apply_batch(inverse)
+    assert document.to_list() == elements
+
+
+def test_structural_operations():
+    message = 'reparent {"ids": ["a", "b"], "parent": null}'
+
+    assert operations(*parse(message)) == [
+        ("reparent", {"ids": ["a", "b"], "parent": None})
+    ]
+
+
+def test_batch_operations():
+    message = 'batch [["create", {"id": "a"}], ["delete", {"id": "b"}]]'
+
+    assert operations(*parse(message)) == [
+        ("create", {"id": "a"}),
+        ("delete", {"id": "b"}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        'create {"id": "a"',
+        'rename {"id": "a"}',
+        'update {"x": 1}',
+        'put {"id": "a", "after": ["b"]}',
+        'batch {"id": "a"}',
+        'batch [["create", {"id": "a"}], ["rename", {"id": "b"}]]',
+        'batch [["create"]]',
+        'update {"id": "a", "x": "5"}',
+        'create {"id": "a", "width": Infinity}',
+        'update {"id": "a", "y": 1e999}',
+        'batch [["put", {"id": "a"}], ["update", {"id": "a", "height": []}]]',
+        'group {"id": "g", "ids": ["a"], "x": NaN}',
+        'batch [["ungroup", {"id": "a"}]]',
+        'group {"ids": ["a"]}',
+        'group {"id": "g", "ids": "a"}',
+        'duplicate {"id": "a", "ids": [["a"]]}',
+        'reparent {"ids": [["a"]], "parent": "b"}',
+        'reparent {"ids": ["a"], "parent": {}}',
+    ]
+)
+def test_invalid_operations(message: str):
+    with pytest.raises(ValueError):
+        operations(*parse(message))
+
+
+def test_parse_like_stored_documents():
+    message = 'create {"id": 1, "z": 99999999999999999999}'
+
+    assert parse(message) == ("create", {"id": 1, "z": 1e20})
+
+    with pytest.raises(ValueError):
+        parse('create {"id": 1, "z": NaN}')
+
+
+def test_binary_frames():
+    message = msgpack.packb(["update", {"id": 1, "x": 10.5}])
+
+    assert unpack(message) == ("update", {"id": 1, "x": 10.5})
+    assert msgpack.unpackb(pack(3, "delete", {"id": 1})) == [3, "delete", {"id": 1}]
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        b"\xc1",
+        b"\x92\xa6update",
+        msgpack.packb(["update", {"id": 1}, 1]),
+        msgpack.packb([1, {"id": 1}]),
+        msgpack.packb({"update": {"id": 1}}),
+        msgpack.packb(["update", {"id": 1, "fill": b"\x00"}]),
+        msgpack.packb(["update", {"id": 1, "fill": msgpack.ExtType(1, b"")}]),
+        msgpack.packb(["update", {"id": 1, "opacity": float("nan")}]),
+    ],
+)
+def test_invalid_binary_frames(message: bytes):
+    with pytest.raises(ValueError):
+        unpack(message)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [0, 0, 10, 10],
+        {"x": 0, "y": 0, "width": 10},
+        {"x": 0, "y": 0, "width": -1, "height": 10},
+        {"x": float("inf"), "y": 0, "width": 10, "height": 10},
+        {"x": True, "y": 0, "width": 10, "height": 10},
+    ],
+)
+def test_invalid_viewports(payload: Any):
+    with pytest.raises(ValueError):
+        viewport(payload)
+
+
+def test_presence():
+    assert presence({"cursor": {"x": 1, "y": 2.5, "z": 3}, "selection": [1, "a"]}) == {
+        "cursor": {"x": 1, "y": 2.5},
+        "selection": [1, "a"],
+        "viewport": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [],
+        {"color": "red"},
+        {"cursor": {"x": 1}},
+        {"selection": [True]},
+        {"viewport": {"x": 0, "y": 0, "width": -1, "height": 1}},
+    ],
+)
+def test_invalid_presence(payload: Any):
+    with pytest.raises(ValueError):
+        presence(payload)
+
+
+def test_grid():
+    grid = Grid(cell=10)
+    grid.add(1, (0, 0, 5, 5))
+    grid.add(2, (25, 25, 10, 10))
+    grid.add(3, (-1000, -1000, 5000, 5000))
+
+    assert grid.query((0, 0, 10, 10)) == {1, 3}
+    assert grid.query((-10, -10, 100, 100)) == {1, 2, 3}
+
+    grid.add(1, (30, 30, 1, 1))
+    grid.discard(3)
+
+    assert grid.query((0, 0, 10, 10)) == set()
+    assert grid.query((29, 29, 2, 2)) == {1, 2}
+    assert grid.cells.keys() == {(2, 2), (2, 3), (3, 2), (3, 3)}
+
+
+def test_viewports_ignore_invalid_rects():
+    # Documents stored before the validation may have any values.
+    document = Document(
+        [
+            {"id": 1, "x": "5", "width": 10, "height": 10},
+            {"id": 2, "x": 1.5e308, "width": 1.5e308, "height": 1},
+            {"id": 3, "x": 10**400, "y": True},
+        ]
+    )
+    viewports = Viewports(document, cell=10)
+
+    assert viewports.add("client", (0, 0, 10, 10)) == [document.get(1), document.get(3)]
+    assert viewports.grid.query((1e308, 0, 1e308, 1)) == {2}
+
+
+def test_viewports_send_visible_trees():
+    document = Document(
+        [
+            {"id": 1, "x": 0, "y": 0, "width": 10, "height": 10},
+            {"id": 2, "parent": 1, "x": 500},
+            {"id": 3, "x": 100, "y": 100},
+        ]
+    )
+    viewports = Viewports(document, cell=50)
+
+    assert [element["id"] for element in viewports.add("a", (0, 0, 20, 20))] == [
+        1,
+        2,
+    ]
+    changed = viewports.move("a", (90, 90, 20, 20))
+
+    assert changed[0] == ("create", {"id": 3, "x": 100, "y": 100})
+    assert sorted(changed[1:], key=str) == [
+        ("delete", {"id": 1}),
+        ("delete", {"id": 2}),
+    ]
+    assert viewports.views["a"].known == {3}
+
+
+def test_viewports_filter_operations():
+    document = Document(
+        [
+            {"id": 1, "x": 0, "y": 0, "width": 10, "height": 10},
+            {"id": 2, "x": 100, "y": 100},
+        ]
+    )
+    viewports = Viewports(document, cell=50)
+    viewports.add("a", (0, 0, 20, 20))
+
+    def apply(*found):
+        prepared = viewports.prepare(list(found))
+        document.apply_batch(list(found))
+        return viewports.update(list(found), prepared)
+
+    # Operations of visible elements are sent as they are.
+    assert apply(("update", {"id": 1, "x": 5})) == {}
+    # Operations of hidden elements are not sent.
+    assert apply(("update", {"id": 2, "y": 90})) == {"a": []}
+    # Elements moved into the viewport are created with their children.
+    assert apply(
+        ("create", {"id": 3, "parent": 2}),
+        ("update", {"id": 2, "x": 15, "y": 15}),
+    ) == {
+        "a": [
+            ("create", {"id": 2, "x": 15, "y": 15}),
+            ("create", {"id": 3, "parent": 2}),
+        ]
+    }
+    # Elements moved to a hidden tree are deleted.
+    apply(("create", {"id": 4, "x": 1000}))
+    assert apply(("update", {"id": 3, "parent": 4})) == {
+        "a": [("delete", {"id": 3})]
+    }
+    assert viewports.views["a"].known == {1, 2}
+
+
+class FakeSave:
+    """Records data instead of writing it to the database."""
+
+    def __init__(self) -> None:
+        self.changes = []
+        self.snapshots = []
+
+    async def __call__(
+        self,
+        project_id: int,
+        changes: list[dict],
+        snapshot: Optional[tuple[str, int]],
+    ) -> None:
+        self.changes.extend(changes)
+        if snapshot is not None:
+            self.snapshots.append(snapshot)
+
+
+class FakeSession:
+    """Provides projects and changes saved by FakeSave."""
+
+    def __init__(self, save: FakeSave) -> None:
+        self.save = save
+
+    async def refresh(self, project: SimpleNamespace, attributes: list) -> None:
+        if self.save.snapshots:
+            project.content, project.revision = self.save.snapshots[-1]
+
+    async def stream_scalars(self, statement: Any) -> AsyncIterator:
+        return self._changes()
+
+    async def _changes(self) -> AsyncIterator:
+        for change in self.save.changes:
+            yield SimpleNamespace(**change)
+
+
+def project(content: str = "[]", revision: int = 0) -> SimpleNamespace:
+    return SimpleNamespace(id=1, content=content, revision=revision)
+
+
+@pytest.mark.asyncio
+async def test_flusher_batches_until_interval():
+    save = FakeSave()
+    flusher = Flusher(1, interval=0.05, operations=100, save=save)
+    document = Document()
+
+    for id in range(1, 11):
+        document.create({"id": id})
+        flusher.mark_dirty(document, id, {"seq": id})
+
+    assert save.changes == []
+
+    await asyncio.sleep(0.1)
+
+    assert save.changes == [{"seq": id} for id in range(1, 11)]
+    assert save.snapshots == []
+
+    await flusher.close()
+
+
+@pytest.mark.asyncio
+async def test_flusher_flushes_on_operations_threshold():
+    save = FakeSave()
+    flusher = Flusher(1, interval=60, operations=3, save=save)
+    document = Document()
+
+    for revision in range(1, 4):
+        flusher.mark_dirty(document, revision, {"seq": revision})
+    await asyncio.sleep(0.01)
+
+    assert len(save.changes) == 3
+
+    await flusher.close()
+
+
+@pytest.mark.asyncio
+async def test_flusher_snapshots_every_few_operations():
+    save = FakeSave()
+    flusher = Flusher(1, interval=60, operations=2, snapshot_operations=4, save=save)
+    document = Document()
+
+    for revision in range(1, 6):
+        flusher.mark_dirty(document, revision)
+        await asyncio.sleep(0.01)
+
+    assert save.snapshots == [("[]", 4)]
+
+    await flusher.close()
+
+    assert save.snapshots == [("[]", 4), ("[]", 5)]
+
+
+@pytest.mark.asyncio
+async def test_flusher_close_writes_pending():
+    save = FakeSave()
+    flusher = Flusher(1, interval=60, operations=100, save=save)
+
+    flusher.mark_dirty(Document([{"id": 1}]), 1, {"seq": 1})
+    await flusher.close()
+    await flusher.close()
+
+    assert save.changes == [{"seq": 1}]
+    assert save.snapshots == [('[{"id":1}]', 1)]
+
+
+@pytest.mark.asyncio
+async def test_flusher_keeps_changes_if_document_fails():
+    save = FakeSave()
+    flusher = Flusher(1, interval=60, operations=100, save=save)
+    document = Document([{"id": 1, "z": 10**20}])
+
+    flusher.mark_dirty(document, 1, {"seq": 1})
+    with pytest.raises(TypeError):
+        await flusher.flush(snapshot=True)
+
+    assert save.changes == []
+
+    document.update({"id": 1, "z": 1})
+    await flusher.close()
+
+    assert save.changes == [{"seq": 1}]
+    assert save.snapshots == [('[{"id":1,"z":1}]', 1)]
+
+
+@pytest.mark.asyncio
+async def test_element_storage_writes_changed_rows(monkeypatch: pytest.MonkeyPatch):
+    # Changed rows are deleted in several queries.
+    monkeypatch.setattr("server.projects.models.IDS_PER_QUERY", 2)
+    await init_db()
+    async with session_maker() as session:
+        project = await Project.create(
+            {"author_id": 1, "title": "elements", "content": "[]"}, session
+        )
+
+    storage = ElementStorage()
+    document = Document([{"id": 1}, {"id": "1", "parent": 1}, {"id": 2}])
+
+    async with session_maker() as session:
+        await storage.save(project.id, await storage.dump(document, None), 1, session)
+        await session.commit()
+
+    document.dirty = set()
+    document.update({"id": "1", "x": 5})
+    document.put({"id": 2})
+    elements, element_ids = await storage.dump(document, document.dirty)
+    assert sorted(element_ids) == ['"1"', "1", "2"]
+
+    async with session_maker() as session:
+        await storage.save(project.id, (elements, element_ids), 2, session)
+        # Older snapshots are ignored.
+        await storage.save(project.id, ([], None), 1, session)
+        await session.commit()
+
+    async with session_maker() as session:
+        project = await Project.by_id(project.id, session)
+        loaded = await load(project, session)
+
+    assert project.content == ""
+    assert project.revision == 2
+    assert loaded.to_list() == [{"id": 2}, {"id": 1}, {"id": "1", "parent": 1, "x": 5}]
+    assert loaded.dirty == set()
+
+
+@pytest.mark.asyncio
+async def test_project_is_deleted_with_its_rows():
+    await init_db()
+    async with session_maker() as session:
+        project = await Project.create(
+            {"author_id": 1, "title": "deleted", "content": "[]"}, session
+        )
+
+    async with session_maker() as session:
+        await Change.append(
+            [{"project_id": project.id, "seq": 1, "message": 'create {"id": 1}'}],
+            session,
+        )
+        await ElementStorage().save(
+            project.id, ([{"element_id": "1", "data": '{"id":1}'}], None), 1, session
+        )
+        session.add(
+            Version(project_id=project.id, manifest="", revision=1, title="first")
+        )
+        await session.commit()
+
+        # Foreign keys are enforced like in other databases.
+        await session.execute(text("PRAGMA foreign_keys = ON"))
+        await Project.delete(project.id, session)
+
+        assert await Project.by_id(project.id, session) is None
+        assert [_ async for _ in Change.by_project(project.id, session)] == []
+        assert [_ async for _ in Element.by_project(project.id, session)] == []
+        assert [_ async for _ in Version.by_project(project.id, session)] == []
+
+
+@pytest.mark.asyncio
+async def test_content_includes_changes_after_snapshot():
+    await init_db()
+    async with session_maker() as session:
+        project = await Project.create(
+            {"author_id": 1, "title": "content", "content": '[{"id":1}]'}, session
+        )
+        message = 'update {"id": 1, "x": 5}'
+        await Change.append(
+            [{"project_id": project.id, "seq": 1, "message": message}], session
+        )
+        await session.commit()
+
+        assert await content(project, session) == '[{"id":1,"x":5}]'
+
+        await Project.delete(project.id, session)
+
+
+@pytest.mark.asyncio
+async def test_blobs_stored_meanwhile_are_kept():
+    await init_db()
+    blobs = {f"{time.time_ns():064x}": "[]", f"{time.time_ns() + 1:064x}": "[1]"}
+    first = next(iter(blobs))
+
+    async with session_maker() as session:
+        scalars = session.scalars
+
+        # Another session inserts a blob after it is looked up.
+        async def stale(statement: Any) -> Any:
+            session.scalars = scalars
+            async with session_maker() as other:
+                await Blob.store({first: blobs[first]}, other)
+                await other.commit()
+            return iter(())
+
+        session.scalars = stale
+        await Blob.store(blobs, session)
+        await session.commit()
+
+        assert await Blob.by_hashes(list(blobs), session) == blobs
+
+
+def test_chunks_are_content_defined():
+    hashes = [f"{index:08x}" for index in range(1, 40)]
+    found = chunks(hashes, 8)
+
+    assert [chunk[-1][-2:] for chunk in found] == ["08", "10", "18", "20", "27"]
+
+    # Only the chunk of the inserted hash changes.
+    changed = chunks(hashes[:12] + ["ffffffff"] + hashes[12:], 8)
+    assert [chunk for chunk in changed if chunk not in found] == [
+        hashes[8:12] + ["ffffffff"] + hashes[12:16]
+    ]
+
+    assert [len(chunk) for chunk in chunks(["00000001"] * 70, 8)] == [32, 32, 6]
+
+
+@pytest.mark.parametrize(
+    "elements",
+    [
+        [],
+        [{"id": 3}, {"id": 1, "x": 5}, {"id": 6, "parent": 3}],
+        [{"id": 4}, {"id": 5, "parent": 4}, {"id": 2, "parent": 4}],
+        [{"id": 5}, {"id": 4}, {"id": 3}, {"id": 2}, {"id": 1}],
+    ],
+)
+def test_restore_operations(elements: list[dict]):
+    document = Document(
+        [
+            {"id": 1},
+            {"id": 2, "parent": 1, "y": 1},
+            {"id": 3},
+            {"id": 4, "parent": 3},
+            {"id": 5, "parent": 4},
+        ]
+    )
+
+    document.apply_batch(restore_operations(document, elements))
+
+    assert document.to_list() == elements
+    assert restore_operations(document, elements) == []
+
+
+def test_diff():
+    old = [{"id": 1}, {"id": 2, "x": 5}, {"id": 3}, {"id": 4}, {"id": 5}, {"id": 6}]
+    new = [{"id": 1}, {"id": 4}, {"id": 5}, {"id": 2, "y": 1}, {"id": 3}, {"id": 7}]
+
+    assert diff(old, new) == {
+        "added": [{"id": 7}],
+        "removed": [{"id": 6}],
+        "moved": [{"id": 4, "after": 1}, {"id": 5, "after": 4}],
+        "changed": [
+            {"id": 2, "before": {"x": 5, "y": None}, "after": {"x": None, "y": 1}}
+        ],
+    }
+    assert diff(new, new) == {"added": [], "removed": [], "moved": [], "changed": []}
+
+
+@pytest.mark.asyncio
+async def test_versions_share_blobs():
+    await init_db()
+    async with session_maker() as session:
+        project = await Project.create(
+            {"author_id": 1, "title": "versions", "content": "[]"}, session
+        )
+
+    document = Document({"id": index, "x": index % 7} for index in range(300))
+
+    async with session_maker() as session:
+        first = await save_version(project.id, "first", 1, document, 1, session)
+        stored = len([_ async for _ in Blob.every(session)])
+
+        document.update({"id": 150, "x": 100})
+        second = await save_version(project.id, "second", None, document, 2, session)
+        added = len([_ async for _ in Blob.every(session)]) - stored
+
+        # Versions of another project reuse the blobs.
+        await save_version(project.id + 1, "copy", None, document, 2, session)
+        copied = len([_ async for _ in Blob.every(session)]) - stored - added
+
+        first_elements = await load_version(first, session)
+        second_elements = await load_version(second, session)
+
+    # The element, its chunk and the manifest.
+    assert added == 3
+    assert copied == 0
+    assert first_elements[150] == {"id": 150, "x": 3}
+    assert second_elements == document.to_list()
+
+
+class FakeConnection:
+    """Collects messages sent to the client."""
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.received = time.monotonic()
+        self.closed = False
+
+    def send(self, message: str, lossy: bool = False) -> None:
+        self.sent.append(message)
+
+    def stream(self, messages: Iterator[str]) -> None:
+        self.streamed = messages
+
+    def disconnect(self, code: int) -> None:
+        self.code = code
+
+
+@pytest.mark.asyncio
+async def test_rooms_share_document():
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    first, second = FakeConnection(), FakeConnection()
+
+    room = await rooms.join(project(), first, FakeSession(save))
+    room.add(first)
+    assert await rooms.join(project(), second, FakeSession(save)) is room
+    room.add(second)
+
+    room.flusher.save = save
+    await room.publish('create {"id": 1}', 7)
+
+    assert room.document.to_list() == [{"id": 1}]
+    assert first.sent == second.sent == ["[]", 'create {"id": 1}']
+
+    await rooms.leave(room, first)
+    assert rooms.rooms == {1: room}
+
+    await rooms.leave(room, second)
+    assert rooms.rooms == {}
+    assert save.changes == [
+        {"project_id": 1, "seq": 1, "user_id": 7, "message": 'create {"id": 1}'}
+    ]
+    assert save.snapshots == [('[{"id":1}]', 1)]
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_replays_changes_after_snapshot():
+    save = FakeSave()
+    await save(1, [{"seq": 3, "message": 'update {"id": 1, "x": 5}'}], None)
+
+    rooms = Rooms(MemoryBroadcast())
+    room = await rooms.join(
+        project('[{"id": 1}]', 2), FakeConnection(), FakeSession(save)
+    )
+    room.flusher.save = save
+
+    assert room.document.to_list() == [{"id": 1, "x": 5}]
+    assert room.revision == 3
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_broadcasts_batch_once():
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    connection = FakeConnection()
+    room = await rooms.join(project(), connection, FakeSession(save))
+    room.add(connection)
+    room.flusher.save = save
+
+    message = 'batch [["create", {"id": 1}], ["create", {"id": 2, "parent": 1}]]'
+    await room.publish(message, None)
+
+    assert connection.sent == ["[]", message]
+    assert room.revision == 1
+
+    await rooms.leave(room, connection)
+
+    assert [change["message"] for change in save.changes] == [message]
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_stamps_operations_with_sequence_numbers():
+    rooms = Rooms(MemoryBroadcast())
+    legacy, sequenced = FakeConnection(), FakeConnection()
+    room = await rooms.join(project(), legacy, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(legacy)
+    room.add(sequenced, 0)
+
+    await room.publish('create {"id": 1}', None)
+
+    assert legacy.sent == ["[]", 'create {"id": 1}']
+    assert sequenced.sent == ["0 batch []", '1 create {"id": 1}']
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_resyncs_missing_operations():
+    rooms = Rooms(MemoryBroadcast())
+    connection = FakeConnection()
+    room = await rooms.join(project(), connection, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(connection)
+
+    await room.publish('create {"id": 1}', None)
+    await room.publish('batch [["create", {"id": 2}], ["put", {"id": 2}]]', None)
+    await room.publish('update {"id": 1, "x": 5}', None)
+
+    reconnected = FakeConnection()
+    room.add(reconnected, 1)
+
+    assert reconnected.sent == [
+        '3 batch [["create", {"id": 2}], ["put", {"id": 2}], '
+        '["update", {"id": 1, "x": 5}]]'
+    ]
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_broadcasts_structural_commands():
+    rooms = Rooms(MemoryBroadcast())
+    connection = FakeConnection()
+    content = '[{"id": 1}, {"id": 2, "parent": 1}]'
+    room = await rooms.join(project(content), connection, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(connection)
+
+    message = 'duplicate {"id": 1, "ids": [[1, 3], [2, 4]]}'
+    await room.publish(message, 7)
+
+    assert connection.sent[-1] == message
+    assert room.document.to_list()[2:] == [{"id": 3}, {"id": 4, "parent": 3}]
+
+    # Reconnected clients receive the operations it was expanded into.
+    reconnected = FakeConnection()
+    room.add(reconnected, 0)
+    assert reconnected.sent == [
+        '1 batch [["create", {"id": 3}], ["create", {"id": 4, "parent": 3}]]'
+    ]
+
+    await room.revert("undo", 7)
+    assert room.document.to_list() == [{"id": 1}, {"id": 2, "parent": 1}]
+
+    await rooms.close()
+
+
+@pytest.mark.parametrize("seq", [0, 4])
+@pytest.mark.asyncio
+async def test_room_sends_document_to_clients_far_behind(seq: int):
+    rooms = Rooms(MemoryBroadcast())
+    connection = FakeConnection()
+    room = await rooms.join(project(), connection, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.recent = deque(maxlen=2)
+
+    for id in range(1, 4):
+        await room.publish(f'create {{"id": {id}}}', None)
+
+    assert room.missing(1) is not None
+
+    reconnected = FakeConnection()
+    room.add(reconnected, seq)
+
+    assert reconnected.sent == ['3 [{"id":1},{"id":2},{"id":3}]']
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_sends_binary_frames():
+    rooms = Rooms(MemoryBroadcast())
+    connection = FakeConnection()
+    room = await rooms.join(project(), connection, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(connection, binary=True)
+
+    await room.publish('create {"id": 1, "x": 10}', None)
+
+    reconnected = FakeConnection()
+    room.add(reconnected, 0, binary=True)
+
+    assert [msgpack.unpackb(frame) for frame in connection.sent] == [
+        [0, "document", []],
+        [1, "create", {"id": 1, "x": 10}],
+    ]
+    assert msgpack.unpackb(reconnected.sent[0]) == [
+        1,
+        "batch",
+        [["create", {"id": 1, "x": 10}]],
+    ]
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_sends_visible_elements():
+    rooms = Rooms(MemoryBroadcast())
+    first, second = FakeConnection(), FakeConnection()
+    content = '[{"id": 1}, {"id": 2, "x": 1000}]'
+    room = await rooms.join(project(content), first, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(first, viewport=(0, 0, 100, 100))
+    room.add(second)
+
+    await room.publish('update {"id": 2, "y": 5}', None)
+    await room.publish('update {"id": 1, "y": 5}', None)
+    room.move(first, (900, 0, 200, 200))
+
+    assert first.sent == [
+        '[{"id":1}]',
+        'update {"id": 1, "y": 5}',
+        'batch [["create", {"id": 2, "x": 1000, "y": 5}], ["delete", {"id": 1}]]',
+    ]
+    assert len(second.sent) == 3
+
+    await rooms.leave(room, first)
+    assert room.viewports is None
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_streams_document_in_chunks(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.CHUNK_ELEMENTS", 2)
+    rooms = Rooms(MemoryBroadcast())
+    connection = FakeConnection()
+    content = '[{"id": 1, "parent": 2}, {"id": 2}, {"id": 3}]'
+    room = await rooms.join(project(content), connection, FakeSession(FakeSave()))
+    room.flusher.save = FakeSave()
+    room.add(connection, chunked=True)
+
+    await room.publish('update {"id": 2, "x": 5}', None)
+
+    # Chunks hold elements as they were when the client joined.
+    assert list(connection.streamed) == [
+        'chunk [[1, {"id": 2}], [2, {"id": 3}]]',
+        'chunk [[0, {"id": 1, "parent": 2}]]',
+        'loaded {"length": 3}',
+    ]
+    assert connection.sent == ['update {"id": 2, "x": 5}']
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_share_latest_presence(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.PRESENCE_INTERVAL", 0.01)
+    hub = {}
+    save = FakeSave()
+    first, second, viewer = FakeConnection(), FakeConnection(), FakeConnection()
+
+    first_rooms = Rooms(MemoryBroadcast(hub))
+    first_room = await first_rooms.join(project(), first, FakeSession(save))
+    first_room.add(first)
+    second_rooms = Rooms(MemoryBroadcast(hub))
+    second_room = await second_rooms.join(project(), second, FakeSession(save))
+    second_room.add(second)
+    await second_rooms.join(project(), viewer, FakeSession(save))
+    second_room.add(viewer)
+
+    state = presence({"cursor": {"x": 1, "y": 1}})
+    first_room.present(first, 7, presence({}))
+    first_room.present(first, 7, state)
+    second_room.present(viewer, None, state)
+    await asyncio.sleep(0.05)
+
+    anonymous = second_room.users[viewer]
+    assert second.sent[1:] == [
+        f'presence {{"7": {json.dumps(state)}}}',
+        f'presence {{"{anonymous}": {json.dumps(state)}}}',
+    ]
+
+    await second_rooms.leave(second_room, viewer)
+    await asyncio.sleep(0.05)
+
+    assert first.sent[-1] == f'presence {{"{anonymous}": null}}'
+    assert save.changes == []
+
+    await first_rooms.close()
+    await second_rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_write_documents_for_other_workers_outside_turns():
+    rooms = Rooms(MemoryBroadcast())
+    noisy = await rooms.join(project(), FakeConnection(), FakeSession(FakeSave()))
+    quiet = await rooms.join(
+        SimpleNamespace(id=2, content="[]", revision=0),
+        FakeConnection(),
+        FakeSession(FakeSave()),
+    )
+    quiet.flusher.save = FakeSave()
+
+    async def save(*args: Any) -> None:
+        await asyncio.sleep(0.5)
+
+    noisy.flusher.save = save
+    await noisy.publish('create {"id": 1}', None)
+    await rooms.broadcast.publish(noisy.channel, "sync other")
+
+    start = time.perf_counter()
+    await quiet.publish('create {"id": 1}', None)
+    assert time.perf_counter() - start < 0.1
+
+    await rooms.close()
+    assert noisy.synced_revision == 1
+
+
+@pytest.mark.asyncio
+async def test_room_skips_operations_in_persisted_document():
+    hub = {}
+    save = FakeSave()
+    first_rooms = Rooms(MemoryBroadcast(hub))
+    first_room = await first_rooms.join(
+        project('[{"id": 1}]'), FakeConnection(), FakeSession(save)
+    )
+    first_room.flusher.save = save
+    await first_room.publish('update {"id": 1, "x": 1}', 7)
+
+    # The document is written after an operation following the sync.
+    await first_room.flusher._lock.acquire()
+    second_rooms = Rooms(MemoryBroadcast(hub))
+    joining = asyncio.create_task(
+        second_rooms.join(project('[{"id": 1}]'), FakeConnection(), FakeSession(save))
+    )
+    await asyncio.sleep(0.01)
+    await first_room.publish('update {"id": 1, "y": 2}', 7)
+    first_room.flusher._lock.release()
+    second_room = await joining
+
+    assert save.snapshots == [('[{"id":1,"x":1,"y":2}]', 2)]
+    assert second_room.document.to_list() == [{"id": 1, "x": 1, "y": 2}]
+    assert second_room.revision == first_room.revision == 2
+
+    await first_rooms.close()
+    await second_rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_evict_stale_rooms(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.SYNC_TIMEOUT", 0.05)
+    hub = {}
+    save = FakeSave()
+    first, second = FakeConnection(), FakeConnection()
+
+    first_rooms = Rooms(MemoryBroadcast(hub))
+    first_room = await first_rooms.join(project(), first, FakeSession(save))
+    first_room.flusher.save = save
+    first_room.add(first)
+    second_rooms = Rooms(MemoryBroadcast(hub))
+    second_room = await second_rooms.join(project(), second, FakeSession(save))
+    second_room.flusher.save = FakeSave()
+    second_room.add(second)
+    await first_room.publish('create {"id": 1}', 7)
+
+    # Messages published later may be missed, so the document stops changing.
+    first_rooms.broadcast.notify_missed()
+    await asyncio.sleep(0.01)
+    await second_room.publish('create {"id": 2}', 7)
+    await first_room.publish('create {"id": 3}', 7)
+
+    assert first_room.revision == 1
+    assert second_room.revision == 2
+
+    # Stale rooms don't answer, so workers joining load the document again.
+    await second_rooms.close()
+    third_rooms = Rooms(MemoryBroadcast(hub))
+    third_room = await third_rooms.join(project(), FakeConnection(), FakeSession(save))
+    third_room.flusher.save = FakeSave()
+    assert third_room.stale
+
+    await first_rooms.sweep()
+
+    assert first.code == 1001
+    assert first_rooms.rooms == {}
+    assert save.snapshots == [('[{"id":1}]', 1)]
+
+    await first_rooms.close()
+    await third_rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_opening_together_load_the_log(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.SYNC_TIMEOUT", 0.05)
+    hub = {}
+    save = FakeSave()
+    first_rooms, second_rooms = Rooms(MemoryBroadcast(hub)), Rooms(MemoryBroadcast(hub))
+
+    # Neither of the workers has a document to persist.
+    first_room, second_room = await asyncio.gather(
+        first_rooms.join(project(), FakeConnection(), FakeSession(save)),
+        second_rooms.join(project(), FakeConnection(), FakeSession(save)),
+    )
+
+    assert not first_room.stale
+    assert not second_room.stale
+
+    await first_rooms.close()
+    await second_rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_close_every_room():
+    broadcast = MemoryBroadcast()
+    rooms = Rooms(broadcast)
+    save = FakeSave()
+    other = await rooms.join(project(), FakeConnection(), FakeSession(save))
+    other.flusher.save = save
+    # The last opened room is closed first.
+    failing = await rooms.join(
+        SimpleNamespace(id=2, content="[]", revision=0),
+        FakeConnection(),
+        FakeSession(FakeSave()),
+    )
+
+    async def fail(*args: Any) -> None:
+        raise SQLAlchemyError()
+
+    async def close() -> None:
+        closed.append(True)
+
+    failing.flusher.save = fail
+    closed = []
+    broadcast.close = close
+
+    for room in (failing, other):
+        await room.publish('create {"id": 1}', None)
+    await rooms.close()
+
+    assert save.snapshots == [('[{"id":1}]', 1)]
+    assert rooms.rooms == {}
+    assert closed
+
+
+@pytest.mark.asyncio
+async def test_room_coalesces_updates(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.UPDATE_INTERVAL", 0.01)
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    connection = FakeConnection()
+    room = await rooms.join(
+        project('[{"id": 1}, {"id": 2}]'), connection, FakeSession(save)
+    )
+    room.flusher.save = save
+    room.add(connection)
+    sequenced = FakeConnection()
+    room.add(sequenced, 0)
+
+    await room.update({"id": 1, "x": 1}, 7)
+    await room.update({"id": 2, "x": 2}, 7)
+    await room.update({"id": 1, "x": 3, "y": 1}, 7)
+    await asyncio.sleep(0.05)
+
+    # Plain text clients don't read batches.
+    assert connection.sent[1:] == [
+        'update {"id": 1, "x": 3, "y": 1}',
+        'update {"id": 2, "x": 2}',
+    ]
+    assert sequenced.sent[1:] == [
+        '1 batch [["update", {"id": 1, "x": 3, "y": 1}], ["update", {"id": 2, "x": 2}]]'
+    ]
+
+    # Other users and operations don't overtake pending updates.
+    await room.update({"id": 1, "x": 4}, 7)
+    await room.update({"id": 1, "x": 5}, None)
+    await room.publish('delete {"id": 2}', 7)
+
+    assert connection.sent[3:] == [
+        'update {"id": 1, "x": 4}',
+        'update {"id": 1, "x": 5}',
+        'delete {"id": 2}',
+    ]
+    assert room.document.to_list() == [{"id": 1, "x": 5, "y": 1}]
+
+    await rooms.leave(room, connection)
+
+    assert [change["user_id"] for change in save.changes] == [7, 7, None, 7]
+
+    await rooms.close()
+
+
+class QueuedBroadcast(MemoryBroadcast):
+    """Delivers messages later in publish order, like a broadcast server."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages = asyncio.Queue()
+        self._reader = asyncio.create_task(self._read())
+
+    async def publish(self, channel: str, message: str) -> None:
+        self.messages.put_nowait((channel, message))
+
+    async def close(self) -> None:
+        self._reader.cancel()
+
+    async def _read(self) -> None:
+        while True:
+            channel, message = await self.messages.get()
+            await asyncio.sleep(0.01)
+            for callback in list(self.hub.get(channel, {}).values()):
+                await callback(message)
+
+
+@pytest.mark.asyncio
+async def test_room_persists_own_operations_on_close():
+    rooms = Rooms(QueuedBroadcast())
+    save = FakeSave()
+    connection = FakeConnection()
+    room = await rooms.join(project('[{"id": 1}]'), connection, FakeSession(save))
+    room.flusher.save = save
+    room.add(connection)
+
+    # The pending update comes back from the channel after the room is closing.
+    await room.update({"id": 1, "x": 1}, 7)
+    await rooms.leave(room, connection)
+
+    assert [change["message"] for change in save.changes] == [
+        'update {"id": 1, "x": 1}'
+    ]
+    assert save.snapshots == [('[{"id":1,"x":1}]', 1)]
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_reap_dead_clients(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.HEARTBEAT_INTERVAL", 10)
+    monkeypatch.setattr("server.projects.rooms.IDLE_TIMEOUT", 30)
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    active, silent, dead, closed = (FakeConnection() for _ in range(4))
+
+    for connection in (active, silent, dead, closed):
+        room = await rooms.join(project(), connection, FakeSession(save))
+        room.add(connection)
+    silent.received -= 15
+    dead.received -= 45
+    closed.closed = True
+
+    assert await rooms.reap() == 2
+    assert active.sent == ["[]"]
+    assert silent.sent == ["[]", "ping null"]
+    assert dead.code == closed.code == 1001
+    assert room.clients == {active, silent}
+
+    # Handlers of reaped clients leave too.
+    await rooms.leave(room, dead)
+    await rooms.leave(room, active)
+    await rooms.leave(room, silent)
+
+    assert rooms.rooms == {}
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_open_again_after_failure():
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    connection = FakeConnection()
+
+    with pytest.raises(ValueError):
+        await rooms.join(project("not json"), connection, FakeSession(save))
+    assert rooms.rooms == {}
+
+    room = await rooms.join(project(), connection, FakeSession(save))
+    assert room.document.to_list() == []
+
+    await rooms.leave(room, connection)
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_shares_frames_with_viewers():
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    editor, first, second, moving = (FakeConnection() for _ in range(4))
+    content = '[{"id": 1}, {"id": 2, "x": 1000}]'
+
+    room = await rooms.join(project(content), editor, FakeSession(save))
+    room.flusher.save = save
+    room.add(editor)
+    for viewer in (first, second, moving):
+        await rooms.join(project(content), viewer, FakeSession(save))
+        room.add(viewer, viewer=True)
+
+    # Clients joining between operations share the encoded document.
+    assert first.sent[0] is second.sent[0] is editor.sent[0]
+    assert room.audience["text"] == {first, second, moving}
+
+    room.move(moving, (0, 0, 100, 100))
+    assert room.individual == {editor, moving}
+
+    await room.publish('update {"id": 2, "y": 5}', 7)
+
+    assert first.sent[1] is second.sent[1]
+    assert first.sent[1:] == editor.sent[1:] == ['update {"id": 2, "y": 5}']
+    # The element is out of the viewport.
+    assert moving.sent[1:] == ['batch [["delete", {"id": 2}]]']
+
+    for connection in (editor, first, second, moving):
+        await rooms.leave(room, connection)
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_room_reverts_changes_of_user():
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    connection = FakeConnection()
+    content = '[{"id": 1}, {"id": 2, "parent": 1}, {"id": 3}]'
+    room = await rooms.join(project(content), connection, FakeSession(save))
+    room.flusher.save = save
+    room.add(connection)
+
+    await room.publish('update {"id": 3, "x": 5}', 7)
+    await room.publish('delete {"id": 1}', 7)
+    await room.publish('update {"id": 3, "y": 2}', None)
+    await room.revert("undo", None)
+    await room.revert("undo", 7)
+
+    assert connection.sent[-1] == (
+        'batch [["create", {"id": 1}], ["put", {"id": 1, "after": null}], '
+        '["create", {"id": 2, "parent": 1}], ["put", {"id": 2, "after": 1}]]'
+    )
+
+    await room.revert("redo", 7)
+    assert room.document.to_list() == [{"id": 3, "x": 5, "y": 2}]
+
+    for _ in range(3):
+        await room.revert("undo", 7)
+
+    assert room.document.to_list() == [
+        {"id": 1},
+        {"id": 2, "parent": 1},
+        {"id": 3, "y": 2},
+    ]
+
+    await rooms.leave(room, connection)
+
+    # Reverting changes are logged as any other ones.
+    assert len(save.changes) == 7
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_evict_idle_and_least_recently_used(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    rooms = Rooms(MemoryBroadcast())
+    save = FakeSave()
+    connections = [FakeConnection() for _ in range(4)]
+
+    opened = []
+    for index, connection in enumerate(connections):
+        item = project(f'[{{"id": {index}, "name": "{"x" * 1000}"}}]')
+        item.id = index
+        room = await rooms.join(item, connection, FakeSession(save))
+        room.flusher.save = save
+        room.add(connection)
+        opened.append(room)
+
+    # The oldest room is idle, the next one is evicted to fit the budget.
+    monkeypatch.setattr("server.projects.rooms.ROOM_IDLE_TIMEOUT", 1000)
+    monkeypatch.setattr(
+        "server.projects.rooms.MEMORY_BUDGET", rooms.size() // 2 + 1
+    )
+    now = time.monotonic()
+    for room, used in zip(opened, (now - 2000, now - 20, now - 10, now)):
+        room.used = used
+
+    item = project()
+    item.id = 9
+    async with rooms.opened(item, FakeSession(save)) as pinned:
+        pinned.used = now - 30
+        await rooms.sweep()
+
+        assert sorted(rooms.rooms) == [2, 3, 9]
+    assert [getattr(connection, "code", None) for connection in connections] == [
+        1001,
+        1001,
+        None,
+        None,
+    ]
+
+    # The client of the room evicted for the budget reconnects,
+    # the room isn't evicted for it again for a while.
+    item = project(f'[{{"id": 1, "name": "{"x" * 1000}"}}]')
+    item.id = 1
+    room = await rooms.join(item, FakeConnection(), FakeSession(save))
+    room.flusher.save = save
+    room.used = now - 100
+    await rooms.sweep()
+
+    assert sorted(rooms.rooms) == [1, 3]
+    assert connections[2].code == 1001
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_keep_sweeping_and_reaping(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("server.projects.rooms.EVICTION_INTERVAL", 0.01)
+    monkeypatch.setattr("server.projects.rooms.HEARTBEAT_INTERVAL", 0.01)
+    rooms = Rooms(MemoryBroadcast())
+    calls = []
+
+    async def fail(name: str) -> None:
+        calls.append(name)
+        raise TypeError()
+
+    rooms.sweep = partial(fail, "sweep")
+    rooms.reap = partial(fail, "reap")
+    rooms.start()
+    await asyncio.sleep(0.05)
+
+    assert calls.count("sweep") > 1
+    assert calls.count("reap") > 1
+
+    await rooms.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_of_workers_share_operations():
+    hub = {}
+    save = FakeSave()
+    first, second = FakeConnection(), FakeConnection()
+
+    # Every worker has its own rooms subscribed to the same channel.
+    first_rooms = Rooms(MemoryBroadcast(hub))
+    first_room = await first_rooms.join(project(), first, FakeSession(save))
+    first_room.add(first)
+    first_room.flusher.save = save
+    await first_room.publish('create {"id": 1}', None)
+
+    # The second worker loads the document persisted by the first one.
+    second_rooms = Rooms(MemoryBroadcast(hub))
+    second_room = await second_rooms.join(project(), second, FakeSession(save))
+    second_room.add(second)
+    second_room.flusher.save = save
+    await second_room.publish('update {"id": 1, "x": 5}', None)
+
+    assert first.sent == ["[]", 'create {"id": 1}', 'update {"id": 1, "x": 5}']
+    assert second.sent == ['[{"id":1}]', 'update {"id": 1, "x": 5}']
+    assert first_room.document.to_list() == second_room.document.to_list()
+    assert first_room.revision == second_room.revision == 2
+
+    await first_rooms.close()
+    await second_rooms.close()
+
+    # Every operation is logged once by the worker of its client.
+    assert [change["seq"] for change in save.changes] == [1, 2]
+
+
+class SlowSocket:
+    """Client socket which sends only when allowed."""
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.allowed = asyncio.Event()
+        self.closed = None
+
+    async def send_text(self, message: str) -> None:
+        await self.allowed.wait()
+        self.sent.append(message)
+
+    async def send_bytes(self, message: bytes) -> None:
+        await self.send_text(message)
+
+    async def close(self, code: int) -> None:
+        self.closed = code
+
+
+@pytest.mark.asyncio
+async def test_connection_writes_in_order():
+    socket = SlowSocket()
+    socket.allowed.set()
+    connection = Connection(socket, size=10)
+    connection.start()
+
+    for message in ("a", b"b", "c"):
+        connection.send(message)
+    await asyncio.sleep(0.01)
+
+    assert socket.sent == ["a", b"b", "c"]
+
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_drops_when_full():
+    connection = Connection(SlowSocket(), size=2, policy="drop")
+
+    for message in ("a", "b", "c"):
+        connection.send(message)
+
+    assert [message for message, _ in connection.queue] == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_connection_coalesces_updates():
+    connection = Connection(SlowSocket(), size=4, policy="coalesce")
+
+    connection.send('update {"id": 1, "x": 1}')
+    connection.send('create {"id": 2}')
+    connection.send(b"binary")
+    connection.send('update {"id": 1, "x": 2, "y": 3}')
+    connection.send('update {"id": 2, "x": 4}')
+
+    assert [message for message, _ in connection.queue] == [
+        'update {"id": 1, "x": 2, "y": 3}',
+        'create {"id": 2}',
+        b"binary",
+        'update {"id": 2, "x": 4}',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_connection_keeps_order_of_frames_of_element():
+    connection = Connection(SlowSocket(), size=5, policy="coalesce")
+
+    connection.send('update {"id": 1, "x": 1}')
+    connection.send('delete {"id": 1}')
+    connection.send('create {"id": 1}')
+    connection.send('update {"id": 1, "x": 2}')
+    connection.send('update {"id": 1, "y": 3}')
+    connection.send('create {"id": 2}')
+
+    assert [message for message, _ in connection.queue] == [
+        'update {"id": 1, "x": 1}',
+        'delete {"id": 1}',
+        'create {"id": 1}',
+        'update {"id": 1, "x": 2, "y": 3}',
+        'create {"id": 2}',
+    ]
+
+    # Batches may change any element.
+    connection = Connection(SlowSocket(), size=3, policy="coalesce")
+    connection.send('update {"id": 1, "x": 1}')
+    connection.send('batch [["delete", {"id": 1}]]')
+    connection.send('update {"id": 1, "x": 2}')
+    connection.send('create {"id": 2}')
+
+    assert connection.overflowed
+
+
+@pytest.mark.asyncio
+async def test_connection_drops_lossy_messages():
+    connection = Connection(SlowSocket(), size=3, policy="disconnect")
+
+    connection.send('presence {"1": null, "2": {}}')
+    connection.send('create {"id": 1}')
+    connection.send('presence {"1": {}}')
+    connection.send('presence {"3": {}}', lossy=True)
+
+    assert not connection.overflowed
+
+    connection.policy = "coalesce"
+    connection.send('presence {"3": {}}')
+
+    assert [message for message, _ in connection.queue] == [
+        'presence {"1": {}, "2": {}}',
+        'create {"id": 1}',
+        'presence {"3": {}}',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_connection_streams_one_message_at_once():
+    socket = SlowSocket()
+    connection = Connection(socket, size=10)
+    connection.start()
+
+    produced = []
+
+    def messages() -> Iterator[str]:
+        for message in ("a", "b", "c"):
+            produced.append(message)
+            yield message
+
+    connection.stream(messages())
+    connection.send("d")
+    await asyncio.sleep(0.01)
+
+    assert produced == ["a"]
+    assert connection.held == ["d"]
+
+    socket.allowed.set()
+    await asyncio.sleep(0.01)
+
+    assert socket.sent == ["a", "b", "c", "d"]
+    assert connection.held is None
+
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_disconnects_slow_client():
+    socket = SlowSocket()
+    connection = Connection(socket, size=1, policy="disconnect")
+    connection.start()
+
+    connection.send("a")
+    await asyncio.sleep(0.01)
+    connection.send("b")
+    connection.send("c")
+    socket.allowed.set()
+    await asyncio.sleep(0.01)
+
+    assert socket.sent == ["a"]
+    assert socket.closed == 1013
+
+
+@pytest.mark.asyncio
+async def test_scheduler_serves_quiet_rooms_first():
+    scheduler = Scheduler(quantum=0.001)
+    noisy, quiet = Queue(), Queue()
+    done = []
+
+    def job(name: str) -> Any:
+        async def run() -> None:
+            start = time.thread_time()
+            while time.thread_time() - start < 0.002:
+                pass
+            done.append(name)
+
+        return run
+
+    tasks = [asyncio.create_task(scheduler.run(noisy, job("noisy"))) for _ in range(4)]
+    await asyncio.sleep(0)
+    await scheduler.run(quiet, job("quiet"))
+    await asyncio.gather(*tasks)
+
+    # The noisy room spends its quantum on a single job.
+    assert done == ["noisy", "quiet", "noisy", "noisy", "noisy"]
+    assert noisy.cpu >= 0.008
+    assert 0 < quiet.cpu < noisy.cpu
+
+    # Messages read from a channel are queued without waiting.
+    done.clear()
+    noisy, quiet = Queue(), Queue()
+    handled = [scheduler.submit(noisy, job("noisy")) for _ in range(4)]
+    handled.append(scheduler.submit(quiet, job("quiet")))
+    await asyncio.gather(*handled)
+
+    assert done == ["noisy", "quiet", "noisy", "noisy", "noisy"]
+
+
+@pytest.mark.asyncio
+async def test_limiter_policies():
+    dropping = Limiter(operations=10, size=0, burst=0.2, policy="drop")
+    assert await dropping.admit(1, 100)
+    # A large frame is admitted while any tokens are left.
+    assert await dropping.admit(5, 100)
+    assert not await dropping.admit(1, 100)
+
+    closing = Limiter(operations=0, size=1000, burst=1, policy="close")
+    assert await closing.admit(1, 1500)
+    assert not await closing.admit(1, 1)
+
+    queueing = Limiter(operations=100, size=0, burst=0.1, policy="queue")
+    start = time.monotonic()
+    assert await queueing.admit(20, 10)
+    assert await queueing.admit(1, 10)
+    assert time.monotonic() - start >= 0.1
+
+
+@contextmanager
+def shared_project(client: TestClient) -> Iterator[tuple[int, str]]:
+    """
+    Signs in, creates a project and a link editing it,
+    the project is deleted then, users may have only a few.
+    """
+
+    client.post(
+        "/api/v1/auth/sign-in",
+        json={
+            "name": os.getenv("SUPERUSER_NAME"),
+            "password": os.getenv("SUPERUSER_PASSWORD"),
+        },
+    )
+    item_id = client.post("/api/v1/projects", json={"title": "shared"}).json()["id"]
+    token = client.post(f"/api/v1/projects/{item_id}/link", json={"credential": "edit"})
+
+    try:
+        yield item_id, token.json()["token"]
+    finally:
+        client.delete(f"/api/v1/projects/{item_id}")
+
+
+def test_link_holders_are_told_apart():
+    with TestClient(app) as client, shared_project(client) as (_, token):
+        # Holders of the link have no session of the author.
+        client.cookies.clear()
+        url = f"/api/v1/projects/{token}/content"
+        with (
+            client.websocket_connect(url) as first,
+            client.websocket_connect(url) as second,
+        ):
+            first.receive_text()
+            second.receive_text()
+
+            state = '{"cursor": {"x": 1, "y": 2}}'
+            first.send_text(f"presence {state}")
+            second.send_text(f"presence {state}")
+            time.sleep(0.2)
+            second.send_text('create {"id": "end"}')
+
+            users = set()
+            while (message := first.receive_text()) != 'create {"id": "end"}':
+                users.update(parse(message)[1])
+
+            first.close()
+            second.close()
+
+    assert len(users) == 2
+    assert not any(user.isnumeric() for user in users)
+
+
+def test_link_holders_revert_only_own_changes():
+    with TestClient(app) as client, shared_project(client) as (item_id, token):
+        with client.websocket_connect(f"/api/v1/projects/{item_id}/content") as author:
+            author.receive_text()
+            author.send_text('create {"id": "a"}')
+            author.receive_text()
+
+            client.cookies.clear()
+            with client.websocket_connect(f"/api/v1/projects/{token}/content") as guest:
+                guest.receive_text()
+                guest.send_text("undo null")
+                guest.send_text('create {"id": "end"}')
+
+                # The undo of the guest doesn't delete the element of the author.
+                assert author.receive_text() == 'create {"id": "end"}'
+
+                guest.close()
+            author.close()
+
+
+def test_clients_leave_room_if_session_fails(monkeypatch: pytest.MonkeyPatch):
+    @asynccontextmanager
+    async def failing_session() -> AsyncIterator:
+        async with session_maker() as session:
+            yield session
+        raise RuntimeError("The session is not closed.")
+
+    with TestClient(app) as client, shared_project(client) as (item_id, _):
+        monkeypatch.setattr("server.projects.routes.pooled_session", failing_session)
+
+        with pytest.raises(RuntimeError):
+            url = f"/api/v1/projects/{item_id}/content"
+            with client.websocket_connect(url) as socket:
+                socket.receive_text()
+
+        assert item_id not in rooms.rooms
+
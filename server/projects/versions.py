@@ -0,0 +1,258 @@
+import bisect
+import hashlib
+from typing import Any, Optional
+
+from server.projects.content import Document
+from server.projects.models import Blob, Version
+from server.root.codec import dumps, loads
+from server.root.settings import VERSION_CHUNK
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Chunks without a boundary are cut at this multiple of the average size.
+MAX_CHUNK_FACTOR = 4
+
+
+def chunks(hashes: list[str], size: int = VERSION_CHUNK) -> list[list[str]]:
+    """
+    Splits hashes of elements into chunks at content-defined boundaries:
+    a chunk ends after an element whose hash is divisible by the size,
+    so a changed element changes only its own chunk.
+
+    Args:
+        hashes: hashes of elements in the document order.
+        size: average amount of elements in a chunk.
+
+    Returns:
+        list[list[str]]: chunks of hashes.
+    """
+
+    found = []
+    chunk = []
+
+    for hash in hashes:
+        chunk.append(hash)
+        if int(hash[:8], 16) % size == 0 or len(chunk) >= size * MAX_CHUNK_FACTOR:
+            found.append(chunk)
+            chunk = []
+
+    if chunk:
+        found.append(chunk)
+
+    return found
+
+
+async def save_version(
+    project_id: int,
+    title: str,
+    user_id: Optional[int],
+    document: Document,
+    revision: int,
+    session: AsyncSession,
+) -> Version:
+    """
+    Stores the document as a new version of the project,
+    only blobs which are not stored yet are written.
+
+    Args:
+        project_id: project id.
+        title: version title.
+        user_id: id of the user who made the version, if known.
+        document: project document.
+        revision: sequence number of the last change in the document.
+        session: db async session.
+
+    Returns:
+        Version: new version.
+    """
+
+    blobs = {}
+
+    def add(value: Any) -> str:
+        data = _dumps(value)
+        hash = hashlib.sha256(data.encode()).hexdigest()
+        blobs[hash] = data
+        return hash
+
+    elements = [add(element) for element in document]
+    manifest = add([add(chunk) for chunk in chunks(elements)])
+
+    await Blob.store(blobs, session)
+
+    return await Version.create(
+        {
+            "manifest": manifest,
+            "project_id": project_id,
+            "revision": revision,
+            "title": title,
+            "user_id": user_id,
+        },
+        session,
+    )
+
+
+async def load_version(version: Version, session: AsyncSession) -> list[dict]:
+    """
+    Provides the content of the version.
+
+    Args:
+        version: project version.
+        session: db async session.
+
+    Returns:
+        list[dict]: elements in the document order.
+    """
+
+    manifest = await Blob.by_hashes([version.manifest], session)
+    chunk_hashes = loads(manifest[version.manifest])
+
+    chunk_data = await Blob.by_hashes(list(set(chunk_hashes)), session)
+    hashes = [hash for chunk in chunk_hashes for hash in loads(chunk_data[chunk])]
+
+    element_data = await Blob.by_hashes(list(set(hashes)), session)
+
+    return [loads(element_data[hash]) for hash in hashes]
+
+
+def restore_operations(
+    document: Document,
+    elements: list[dict],
+) -> list[tuple[str, dict]]:
+    """
+    Provides operations turning the document into the elements.
+
+    Args:
+        document: project document.
+        elements: restored elements in the document order.
+
+    Returns:
+        list[tuple[str, dict]]: pairs of command and element data,
+        empty if the document already has the elements.
+    """
+
+    restored = {element["id"]: element for element in elements}
+    found = []
+
+    for element in elements:
+        current = document.get(element["id"])
+        if current is None:
+            found.append(("create", element))
+        elif current != element:
+            # Attributes missing in the restored element are removed.
+            found.append(("update", dict.fromkeys(current) | element))
+
+    # Kept elements are moved to their restored parents at this point,
+    # descendants of deleted elements are deleted with them.
+    for id, element in document.elements.items():
+        parent = element.get("parent")
+        if id not in restored and (parent in restored or parent not in document):
+            found.append(("delete", {"id": id}))
+
+    # Most elements already in the restored order stay in place,
+    # others are put after their restored predecessors.
+    positions = {}
+    for element in document:
+        if element["id"] in restored:
+            positions[element["id"]] = len(positions)
+    for command, element in found:
+        if command == "create":
+            positions[element["id"]] = len(positions)
+
+    stable = _increasing([positions[element["id"]] for element in elements])
+    after = None
+
+    for index, element in enumerate(elements):
+        if index not in stable:
+            found.append(("put", {"id": element["id"], "after": after}))
+        after = element["id"]
+
+    return found
+
+
+def diff(old: list[dict], new: list[dict]) -> dict[str, list[dict]]:
+    """
+    Compares two contents of a project by element ids.
+
+    Every element is visited once, moved ones are found
+    as elements out of the longest run kept in the same order.
+
+    Args:
+        old: elements of the older content in the document order.
+        new: elements of the newer content in the document order.
+
+    Returns:
+        dict[str, list[dict]]: "added" and "removed" elements,
+        "moved" {"id", "after"} with the new previous element
+        and "changed" {"id", "before", "after"} with changed attributes.
+    """
+
+    old_elements = {element["id"]: element for element in old}
+    new_elements = {element["id"]: element for element in new}
+
+    changed = []
+    for element in new:
+        before = old_elements.get(element["id"])
+        if before is None or before == element:
+            continue
+
+        keys = [
+            key
+            for key in dict.fromkeys([*before, *element])
+            if before.get(key) != element.get(key)
+        ]
+        changed.append(
+            {
+                "id": element["id"],
+                "before": {key: before.get(key) for key in keys},
+                "after": {key: element.get(key) for key in keys},
+            }
+        )
+
+    positions = {}
+    for element in old:
+        if element["id"] in new_elements:
+            positions[element["id"]] = len(positions)
+
+    # Indexes of the new elements kept from the old content.
+    kept = [index for index, element in enumerate(new) if element["id"] in positions]
+    stable = _increasing([positions[new[index]["id"]] for index in kept])
+
+    return {
+        "added": [element for element in new if element["id"] not in old_elements],
+        "removed": [element for element in old if element["id"] not in new_elements],
+        "moved": [
+            {"id": new[index]["id"], "after": new[index - 1]["id"] if index else None}
+            for position, index in enumerate(kept)
+            if position not in stable
+        ],
+        "changed": changed,
+    }
+
+
+def _increasing(values: list[int]) -> set[int]:
+    # Indexes of the longest increasing subsequence, in O(n log n).
+    tails = []
+    tail_indexes = []
+    previous = []
+
+    for index, value in enumerate(values):
+        position = bisect.bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[position] = value
+            tail_indexes[position] = index
+        previous.append(tail_indexes[position - 1] if position else None)
+
+    found = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        found.add(index)
+        index = previous[index]
+
+    return found
+
+
+def _dumps(value: Any) -> str:
+    # Equal elements are stored once whatever the order of their attributes.
+    return dumps(value, sort_keys=True)
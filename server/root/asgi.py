@@ -1,3 +1,4 @@
+import asyncio
 import os
 from contextlib import asynccontextmanager
 from pathlib import Path
@@ -5,8 +6,11 @@ from typing import AsyncGenerator
 
 from fastapi import APIRouter, FastAPI
 from server.auth.routes import router as auth_router
+from server.projects.rooms import rooms
 from server.projects.routes import router as projects_router
 from server.root.db import init_db
+from server.root.metrics import router as metrics_router
+from server.root.metrics import watch_loop
 from server.users.routes import router as users_router
 from starlette.staticfiles import StaticFiles
 
@@ -16,9 +20,14 @@ async def lifespan(app: FastAPI) -> AsyncGenerator:
     """Run operations on application startup and shutdown."""
 
     await init_db()
+    rooms.start()
+    watcher = asyncio.create_task(watch_loop())
 
     yield
 
+    watcher.cancel()
+    await rooms.close()
+
 
 debug = os.getenv("DEBUG") == "True"
 app = FastAPI(
@@ -42,5 +51,6 @@ api_v1_router = APIRouter(prefix="/api/v1", tags=["API v1"])
 api_v1_router.include_router(auth_router)
 api_v1_router.include_router(users_router)
 api_v1_router.include_router(projects_router)
+api_v1_router.include_router(metrics_router)
 
 app.include_router(api_v1_router)
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Awaitable, Callable, Optional
+
+from server.root.metrics import counter
+from server.root.settings import BROADCAST_RETRY_INTERVAL
+
+if os.getenv("BROADCAST_TYPE") == "redis":
+    from redis.asyncio import Redis
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from redis.exceptions import TimeoutError as RedisTimeoutError
+
+Callback = Callable[[str], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+broadcast_errors = counter("broadcast_errors")
+
+
+class Broadcast(ABC):
+    """
+    Provides a publish/subscribe channels shared by the workers.
+
+    Every worker subscribes at most once to a channel
+    and fans the received messages out to its own clients.
+    """
+
+    def __init__(self) -> None:
+        """Initializes a new instance of the Broadcast class."""
+
+        self.listeners: list[Callable[[], None]] = []
+
+    def on_missed(self, listener: Callable[[], None]) -> None:
+        """
+        Adds a listener called when messages of the subscribed channels
+        may have been missed. It is called before later messages
+        are passed to the callbacks, so it must not wait for them.
+
+        Args:
+            listener: function called without arguments.
+
+        Returns:
+            None.
+        """
+
+        self.listeners.append(listener)
+
+    def notify_missed(self) -> None:
+        """
+        Calls the listeners of missed messages.
+
+        Returns:
+            None.
+        """
+
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception:
+                broadcast_errors.inc()
+                logger.exception("Listener of missed messages failed.")
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        """
+        Sends a message to every worker subscribed to the channel.
+
+        Args:
+            channel: channel name.
+            message: message to send.
+
+        Returns:
+            None.
+        """
+
+        pass
+
+    @abstractmethod
+    async def subscribe(self, channel: str, callback: Callback) -> None:
+        """
+        Starts receiving messages of the channel.
+
+        Args:
+            channel: channel name.
+            callback: called with every message in publish order,
+            provides an awaitable done when the message is handled.
+            Workers may not wait for it before the next message,
+            so the callback takes the message in order before it returns.
+
+        Returns:
+            None.
+        """
+
+        pass
+
+    @abstractmethod
+    async def unsubscribe(self, channel: str) -> None:
+        """
+        Stops receiving messages of the channel.
+
+        Args:
+            channel: channel name.
+
+        Returns:
+            None.
+        """
+
+        pass
+
+    @abstractmethod
+    async def subscribers(self, channel: str) -> int:
+        """
+        Provides amount of workers subscribed to the channel.
+
+        Args:
+            channel: channel name.
+
+        Returns:
+            int: amount of subscribed workers, including the current one.
+        """
+
+        pass
+
+    async def close(self) -> None:
+        """
+        Releases resources of the broadcast.
+
+        Returns:
+            None.
+        """
+
+        pass
+
+
+class MemoryBroadcast(Broadcast):
+    """
+    Provides channels inside the current process,
+    used with a single worker and in tests.
+    """
+
+    def __init__(self, hub: Optional[dict] = None) -> None:
+        """
+        Initializes a new instance of the MemoryBroadcast class.
+
+        Args:
+            hub: subscriptions shared with other instances,
+            every instance acts as a separate worker.
+        """
+
+        super().__init__()
+
+        self.hub: dict[str, dict[MemoryBroadcast, Callback]] = (
+            {} if hub is None else hub
+        )
+
+    async def publish(self, channel: str, message: str) -> None:
+        for callback in list(self.hub.get(channel, {}).values()):
+            await callback(message)
+
+    async def subscribe(self, channel: str, callback: Callback) -> None:
+        self.hub.setdefault(channel, {})[self] = callback
+
+    async def unsubscribe(self, channel: str) -> None:
+        callbacks = self.hub.get(channel, {})
+        callbacks.pop(self, None)
+        if not callbacks:
+            self.hub.pop(channel, None)
+
+    async def subscribers(self, channel: str) -> int:
+        return len(self.hub.get(channel, ()))
+
+
+class RedisBroadcast(Broadcast):
+    """
+    Provides channels shared by every worker and node
+    based on Redis pub/sub.
+    """
+
+    def __init__(self, host: str, port: int, db: int) -> None:
+        """Initializes a new instance of the RedisBroadcast class."""
+
+        super().__init__()
+
+        self.storage = Redis(host=host, port=port, db=db)
+        self.pubsub = self.storage.pubsub(ignore_subscribe_messages=True)
+        self.callbacks: dict[str, Callback] = {}
+
+        self._reader: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self.storage.publish(channel, message)
+
+    async def subscribe(self, channel: str, callback: Callback) -> None:
+        self.callbacks[channel] = callback
+        await self.pubsub.subscribe(channel)
+
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read())
+
+    async def unsubscribe(self, channel: str) -> None:
+        self.callbacks.pop(channel, None)
+        await self.pubsub.unsubscribe(channel)
+
+    async def subscribers(self, channel: str) -> int:
+        [(_, amount)] = await self.storage.pubsub_numsub(channel)
+        return amount
+
+    async def close(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+        await self.pubsub.aclose()
+        await self.storage.aclose()
+
+    async def _read(self) -> None:
+        # A failed message or a lost connection never stops the reader,
+        # messages published while the connection is lost are missed
+        # and the listeners are told after the reconnect.
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=None)
+            except (RedisConnectionError, RedisTimeoutError):
+                broadcast_errors.inc()
+                logger.exception("Broadcast connection is lost, reconnecting.")
+                await self._reconnect()
+                if self.pubsub.connection is None:
+                    # Nothing is subscribed, the next subscription starts a reader.
+                    self._reader = None
+                    return
+                continue
+
+            if message is None or message["type"] != "message":
+                continue
+
+            channel = message["channel"].decode()
+            callback = self.callbacks.get(channel)
+            if callback is None:
+                continue
+
+            # Messages are queued by the callbacks and handled meanwhile,
+            # so a busy channel doesn't hold messages of other ones.
+            try:
+                handled = asyncio.ensure_future(callback(message["data"].decode()))
+            except Exception:
+                self._failed(channel)
+            else:
+                handled.add_done_callback(partial(self._handled, channel))
+
+    def _handled(self, channel: str, handled: asyncio.Future) -> None:
+        if not handled.cancelled() and handled.exception() is not None:
+            self._failed(channel, handled.exception())
+
+    def _failed(self, channel: str, error: Optional[BaseException] = None) -> None:
+        broadcast_errors.inc()
+        logger.error(
+            "Message of channel %s is not handled.",
+            channel,
+            exc_info=error or True,
+        )
+
+    async def _reconnect(self) -> None:
+        while True:
+            await asyncio.sleep(BROADCAST_RETRY_INTERVAL)
+            try:
+                await self.pubsub.aclose()
+                # Channels subscribed meanwhile are kept in the callbacks.
+                if self.callbacks:
+                    await self.pubsub.subscribe(*self.callbacks)
+                    self.notify_missed()
+                return
+            except (RedisConnectionError, RedisTimeoutError):
+                broadcast_errors.inc()
+                logger.exception("Broadcast is not reconnected, retrying.")
+
+
+match os.getenv("BROADCAST_TYPE"):
+    case "memory":
+        broadcast = MemoryBroadcast()
+    case "redis":
+        broadcast = RedisBroadcast(
+            os.getenv("CACHE_HOST"),
+            int(os.getenv("CACHE_PORT")),
+            int(os.getenv("CACHE_DB")),
+        )
+    case _:
+        broadcast = MemoryBroadcast()
+
+
+async def get_broadcast() -> Broadcast:
+    """
+    Provides channels shared by the workers.
+
+    Returns:
+        Broadcast: publish/subscribe channels.
+    """
+
+    return broadcast
@@ -1,6 +1,9 @@
+import heapq
+import itertools
 import os
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Hashable
+from typing import Any, Hashable, Optional
 
 if os.getenv("CACHE_TYPE") == "redis":
     from redis.asyncio import Redis
@@ -24,13 +27,19 @@ class CacheStorage(ABC):
         pass
 
     @abstractmethod
-    async def set(self, key: Hashable, value: Any) -> None:
+    async def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expire: Optional[float] = None,
+    ) -> None:
         """
         Sets a value by a key.
 
         Args:
             key: key as a hashable object.
             value: value to set with the key.
+            expire: seconds the value is kept, None to keep it forever.
 
         Returns:
             None.
@@ -57,6 +66,9 @@ class DictCacheStorage(CacheStorage):
     """
     Provides a key-value storage
     based on a standard Python dictionary.
+
+    Expired values are removed whenever a value is set,
+    so values that are never read again don't stay in memory.
     """
 
     def __init__(self) -> None:
@@ -65,15 +77,41 @@ class DictCacheStorage(CacheStorage):
         super().__init__()
 
         self.storage = {}
+        self.deadlines: dict[Hashable, float] = {}
+
+        # Deadlines in order, a counter breaks ties between keys.
+        self._expiring: list[tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
 
     async def get(self, key: Hashable) -> Any:
+        deadline = self.deadlines.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            await self.delete(key)
+
         return self.storage.get(key)
 
-    async def set(self, key: Hashable, value: Any) -> None:
+    async def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expire: Optional[float] = None,
+    ) -> None:
+        now = time.monotonic()
+        while self._expiring and self._expiring[0][0] <= now:
+            deadline, _, expired = heapq.heappop(self._expiring)
+            if self.deadlines.get(expired) == deadline:
+                await self.delete(expired)
+
         self.storage[key] = value
+        if expire is None:
+            self.deadlines.pop(key, None)
+        else:
+            self.deadlines[key] = now + expire
+            heapq.heappush(self._expiring, (now + expire, next(self._counter), key))
 
     async def delete(self, key: Hashable) -> None:
         self.storage.pop(key, None)
+        self.deadlines.pop(key, None)
 
 
 class RedisCacheStorage(CacheStorage):
@@ -94,8 +132,15 @@ class RedisCacheStorage(CacheStorage):
     async def get(self, key: Hashable) -> Any:
         return await self.storage.get(key)
 
-    async def set(self, key: Hashable, value: Any) -> None:
-        await self.storage.set(key, value)
+    async def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expire: Optional[float] = None,
+    ) -> None:
+        await self.storage.set(
+            key, value, px=None if expire is None else int(expire * 1000)
+        )
 
     async def delete(self, key: Hashable) -> None:
         await self.storage.delete(key)
@@ -114,13 +159,6 @@ match os.getenv("CACHE_TYPE"):
         storage = DictCacheStorage()
 
 
-clients = DictCacheStorage()
-
-
-async def get_clients_storage() -> CacheStorage:
-    return clients
-
-
 async def get_cache_storage() -> CacheStorage:
     """
     Provides a key-value storage.
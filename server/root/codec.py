@@ -0,0 +1,66 @@
+import asyncio
+from typing import Any, Union
+
+import orjson
+from server.root.settings import CODEC_SLICE
+
+
+def dumps(value: Any, sort_keys: bool = False) -> str:
+    """
+    Serializes a value to compact JSON.
+
+    Args:
+        value: JSON serializable value.
+        sort_keys: sort keys of objects, used for canonical forms.
+
+    Returns:
+        str: JSON text.
+
+    Raises:
+        TypeError: if the value is not serializable.
+    """
+
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Parses JSON.
+
+    Args:
+        data: JSON text.
+
+    Returns:
+        Any: parsed value.
+
+    Raises:
+        ValueError: if the data is not a valid JSON.
+    """
+
+    return orjson.loads(data)
+
+
+async def dumps_list(values: list, size: int = CODEC_SLICE) -> str:
+    """
+    Serializes a large list to compact JSON slice by slice,
+    other tasks run between the slices.
+    Values must not be changed meanwhile, the list may be.
+
+    Args:
+        values: JSON serializable values.
+        size: amount of values in a slice.
+
+    Returns:
+        str: JSON array.
+    """
+
+    values = list(values)
+    parts = []
+
+    for start in range(0, len(values), size):
+        if start:
+            await asyncio.sleep(0)
+        # Slices are arrays, their brackets are dropped.
+        parts.append(orjson.dumps(values[start : start + size])[1:-1])
+
+    return (b"[" + b",".join(parts) + b"]").decode()
@@ -1,10 +1,14 @@
 import os
-from typing import AsyncGenerator
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, AsyncIterator
 
 from server.auth.models import User
 from server.auth.schemas import UserSignUpSchema
 from server.root.crypt import get_crypt_context
+from server.root.metrics import gauge, histogram
 from server.root.models import Base
+from sqlalchemy import Connection, Inspector, event, inspect, text
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
@@ -72,6 +76,29 @@ session_maker: async_sessionmaker = async_sessionmaker(
     autoflush=False,
 )
 
+pool_checked_out = gauge("db_pool_checked_out")
+pool_overflow = gauge("db_pool_overflow")
+pool_wait = histogram("db_pool_wait_seconds")
+
+
+@event.listens_for(engine.sync_engine.pool, "checkout")
+def _checked_out(*args: Any) -> None:
+    pool_checked_out.inc()
+    _measure_overflow()
+
+
+@event.listens_for(engine.sync_engine.pool, "checkin")
+def _checked_in(*args: Any) -> None:
+    pool_checked_out.dec()
+    _measure_overflow()
+
+
+def _measure_overflow() -> None:
+    # Only queue pools have a fixed size to overflow.
+    overflow = getattr(engine.sync_engine.pool, "overflow", None)
+    if overflow is not None:
+        pool_overflow.set(max(overflow(), 0))
+
 
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
@@ -88,8 +115,58 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
             await session.close()
 
 
+@asynccontextmanager
+async def pooled_session() -> AsyncIterator[AsyncSession]:
+    """
+    Provides a database session for a short block of work,
+    used by long-lived tasks instead of keeping a session:
+    the pooled connection is checked out at once and returned
+    when the block ends. The time waited for it is measured.
+
+    Yields:
+        AsyncSession: database session.
+    """
+
+    async with session_maker() as session:
+        start = time.perf_counter()
+        await session.connection()
+        pool_wait.observe(time.perf_counter() - start)
+
+        yield session
+
+
+def migrate(connection: Connection) -> None:
+    """
+    Upgrades tables made before the change log,
+    create_all adds only missing tables.
+
+    Args:
+        connection: db connection in a transaction.
+
+    Returns:
+        None.
+    """
+
+    inspector = inspect(connection)
+    tables = inspector.get_table_names()
+
+    if "projects" in tables and "revision" not in _columns(inspector, "projects"):
+        connection.execute(
+            text("ALTER TABLE projects ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+        )
+
+    # Changes were never written before, the table is made again.
+    if "changes" in tables and "seq" not in _columns(inspector, "changes"):
+        connection.execute(text("DROP TABLE changes"))
+
+
+def _columns(inspector: Inspector, table: str) -> set[str]:
+    return {column["name"] for column in inspector.get_columns(table)}
+
+
 async def init_db() -> None:
     async with engine.begin() as conn:
+        await conn.run_sync(migrate)
         await conn.run_sync(Base.metadata.create_all)
 
     async with session_maker() as session:
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Iterable
+
+from fastapi import APIRouter
+from server.root.settings import LOOP_LAG_INTERVAL
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+
+class Metric(ABC):
+    """Provides a value collected by the worker at runtime."""
+
+    @abstractmethod
+    def snapshot(self) -> Any:
+        """
+        Provides the current state of the metric.
+
+        Returns:
+            Any: JSON serializable metric state.
+        """
+
+        pass
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    def __init__(self) -> None:
+        """Initializes a new instance of the Counter class."""
+
+        super().__init__()
+
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> Any:
+        return self.value
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    def __init__(self) -> None:
+        """Initializes a new instance of the Gauge class."""
+
+        super().__init__()
+
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def snapshot(self) -> Any:
+        return self.value
+
+
+class Histogram(Metric):
+    """Distribution of observed values over cumulative buckets."""
+
+    def __init__(self, buckets: Iterable[float]) -> None:
+        """
+        Initializes a new instance of the Histogram class.
+
+        Args:
+            buckets: upper bounds of the buckets in ascending order.
+        """
+
+        super().__init__()
+
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self) -> Any:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": dict(zip(map(str, self.buckets), self.counts)),
+        }
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+registry: dict[str, Metric] = {}
+
+
+def counter(name: str) -> Counter:
+    """
+    Provides a registered counter, creating it if needed.
+
+    Args:
+        name: metric name.
+
+    Returns:
+        Counter: counter.
+    """
+
+    return registry.setdefault(name, Counter())
+
+
+def gauge(name: str) -> Gauge:
+    """
+    Provides a registered gauge, creating it if needed.
+
+    Args:
+        name: metric name.
+
+    Returns:
+        Gauge: gauge.
+    """
+
+    return registry.setdefault(name, Gauge())
+
+
+def histogram(name: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+    """
+    Provides a registered histogram, creating it if needed.
+
+    Args:
+        name: metric name.
+        buckets: upper bounds of the buckets, used on creation only.
+
+    Returns:
+        Histogram: histogram.
+    """
+
+    metric = registry.get(name)
+    if metric is None:
+        metric = registry[name] = Histogram(buckets)
+
+    return metric
+
+
+async def watch_loop(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """
+    Measures how long the event loop is blocked: a sleeping task
+    wakes up late by the time other code runs without yielding.
+    Runs until cancelled.
+
+    Args:
+        interval: seconds between checks.
+
+    Returns:
+        None.
+    """
+
+    blocked = histogram("loop_blocked_seconds")
+
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        blocked.observe(max(time.perf_counter() - start - interval, 0))
+
+
+@router.get("", response_model=dict[str, Any])
+async def metrics() -> Awaitable[dict[str, Any]]:
+    """
+    Provides runtime metrics of the current worker.
+
+    Returns:
+        dict[str, Any]: metrics by name.
+    """
+
+    return {name: metric.snapshot() for name, metric in registry.items()}
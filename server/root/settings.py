@@ -1,2 +1,93 @@
+import os
+
 TOKEN_EXPIRE = 1 * 24 * 60 * 60
 ALGORITHM = "HS256"
+
+# Write-behind persistence of project content:
+# seconds between flushes and amount of operations forcing an early flush.
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2"))
+FLUSH_OPERATIONS = int(os.getenv("FLUSH_OPERATIONS", "500"))
+
+# Change log of project content: operations between content snapshots
+# and amount of operations kept in the history after a snapshot.
+SNAPSHOT_OPERATIONS = int(os.getenv("SNAPSHOT_OPERATIONS", "1000"))
+CHANGES_RETENTION = int(os.getenv("CHANGES_RETENTION", "1000"))
+
+# Recent operations kept by a room to resync reconnected clients,
+# clients missing older ones receive the whole document.
+RESYNC_OPERATIONS = int(os.getenv("RESYNC_OPERATIONS", "1000"))
+
+# Max size of the undo and redo history of a user in a project,
+# in bytes of the operations reverting changes as JSON.
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "1048576"))
+
+# Average amount of elements in a chunk of a project version,
+# chunks end after elements with certain hashes,
+# so unchanged runs of elements are shared by versions.
+VERSION_CHUNK = int(os.getenv("VERSION_CHUNK", "64"))
+
+# Seconds a diff of two versions is kept in the cache.
+DIFF_CACHE_TTL = float(os.getenv("DIFF_CACHE_TTL", "3600"))
+
+# Elements in a chunk of a streamed document.
+CHUNK_ELEMENTS = int(os.getenv("CHUNK_ELEMENTS", "500"))
+
+# Cell size of the grid indexing elements for viewports.
+GRID_CELL = float(os.getenv("GRID_CELL", "512"))
+
+# Seconds between presence broadcasts of a room,
+# meanwhile states of every user are coalesced to the latest one.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "0.05"))
+
+# Seconds updates of elements are merged by a room before they are
+# published, every user of a worker sends at most a frame per interval.
+UPDATE_INTERVAL = float(os.getenv("UPDATE_INTERVAL", "0.05"))
+
+# CPU seconds messages of a room may take in a turn of the scheduler
+# before other rooms of the worker get their turns,
+# rooms taking more skip next turns.
+SCHEDULER_QUANTUM = float(os.getenv("SCHEDULER_QUANTUM", "0.005"))
+
+# Eviction of project rooms: seconds without activity before a room
+# is closed, estimated bytes of documents a worker keeps in memory
+# and seconds between checks. Clients of evicted rooms are disconnected,
+# documents are reloaded when they reconnect, so a room evicted
+# for the memory budget isn't evicted for it again for the cooldown.
+ROOM_IDLE_TIMEOUT = float(os.getenv("ROOM_IDLE_TIMEOUT", "1800"))
+MEMORY_BUDGET = int(os.getenv("MEMORY_BUDGET", "536870912"))
+EVICTION_INTERVAL = float(os.getenv("EVICTION_INTERVAL", "30"))
+EVICTION_COOLDOWN = float(os.getenv("EVICTION_COOLDOWN", "600"))
+
+# Limits of frames of every client socket: operations and bytes
+# per second, seconds of the rates a client may send at once,
+# max bytes of a frame and what to do with a client over the rates
+# (queue, drop or close). Zero rates are not limited.
+RATE_OPERATIONS = float(os.getenv("RATE_OPERATIONS", "500"))
+RATE_BYTES = float(os.getenv("RATE_BYTES", "1048576"))
+RATE_BURST = float(os.getenv("RATE_BURST", "2"))
+RATE_POLICY = os.getenv("RATE_POLICY", "queue")
+MAX_FRAME = int(os.getenv("MAX_FRAME", "4194304"))
+
+# Seconds of silence of a client before the server pings it
+# and before the client is considered dead and disconnected.
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "20"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "60"))
+
+# Seconds between attempts to reconnect to the broadcast channels.
+BROADCAST_RETRY_INTERVAL = float(os.getenv("BROADCAST_RETRY_INTERVAL", "1"))
+
+# Seconds to wait for other workers to persist a project
+# before loading it into a new room.
+SYNC_TIMEOUT = float(os.getenv("SYNC_TIMEOUT", "1"))
+
+# Outbound queue of every client socket: max amount of messages
+# and what to do with a slow client (drop, coalesce or disconnect).
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", "256"))
+OUTBOX_POLICY = os.getenv("OUTBOX_POLICY", "coalesce")
+
+# Elements serialized between yields to the event loop
+# when a snapshot of a large document is written.
+CODEC_SLICE = int(os.getenv("CODEC_SLICE", "1000"))
+
+# Seconds between checks of how long the event loop is blocked.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
@@ -1,9 +1,24 @@
+import asyncio
+import time
+from pathlib import Path
+
 import pytest
 from passlib.context import CryptContext
 from server.root.auth import verify_password
+from server.root.cache import DictCacheStorage
+from server.root.codec import dumps, dumps_list
 from server.root.crypt import get_crypt_context
-from server.root.db import build_url, get_db
-from sqlalchemy.ext.asyncio import AsyncSession
+from server.root.db import (
+    build_url,
+    get_db,
+    migrate,
+    pool_checked_out,
+    pool_wait,
+    pooled_session,
+)
+from server.root.metrics import Histogram, registry, watch_loop
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 
 def test_build_db_url_full():
@@ -98,6 +113,20 @@ async def test_get_db():
     assert isinstance(session, AsyncSession)
 
 
+@pytest.mark.asyncio
+async def test_pooled_session_is_measured():
+    """Test: connection of the pooled session is checked out for the block only."""
+
+    checked_out = pool_checked_out.value
+    waits = pool_wait.count
+
+    async with pooled_session():
+        assert pool_checked_out.value == checked_out + 1
+
+    assert pool_checked_out.value == checked_out
+    assert pool_wait.count == waits + 1
+
+
 @pytest.mark.asyncio
 async def test_get_crypt_context():
     """Test: get crypt context."""
@@ -135,3 +164,93 @@ async def test_verify_password_and_hash_not_equal():
     verified: bool = await verify_password(plain_password, hashed_password, context)
 
     assert not verified
+
+
+def test_histogram_buckets():
+    """Test: observed values are counted in every bucket they fit."""
+
+    metric = Histogram([1, 10])
+
+    for value in (0.5, 5, 50):
+        metric.observe(value)
+
+    assert metric.snapshot() == {
+        "count": 3,
+        "sum": 55.5,
+        "max": 50,
+        "buckets": {"1": 1, "10": 2},
+    }
+
+
+@pytest.mark.asyncio
+async def test_dumps_list_in_slices():
+    """Test: a list serialized slice by slice equals the whole one."""
+
+    values = [{"id": id, "name": "é"} for id in range(7)]
+
+    assert await dumps_list(values, 3) == dumps(values)
+    assert await dumps_list(values, 10) == dumps(values)
+    assert await dumps_list([], 3) == "[]"
+
+
+@pytest.mark.asyncio
+async def test_watch_loop_observes_blocked_time():
+    """Test: time the loop is blocked is observed by the watcher."""
+
+    task = asyncio.create_task(watch_loop(0.001))
+    await asyncio.sleep(0.01)
+    count = registry["loop_blocked_seconds"].count
+
+    # Blocking call, the watcher can't wake up meanwhile.
+    time.sleep(0.05)
+    await asyncio.sleep(0.01)
+    task.cancel()
+
+    metric = registry["loop_blocked_seconds"]
+    assert metric.count > count
+    assert metric.max >= 0.04
+
+
+@pytest.mark.asyncio
+async def test_migrate_tables_made_before_change_log(tmp_path: Path):
+    """Test: old projects get a revision, the unused changes table is dropped."""
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.sqlite3'}")
+    async with engine.begin() as connection:
+        await connection.execute(
+            text("CREATE TABLE projects (id INTEGER PRIMARY KEY, content VARCHAR)")
+        )
+        await connection.execute(text("INSERT INTO projects VALUES (1, '[]')"))
+        await connection.execute(
+            text("CREATE TABLE changes (id INTEGER PRIMARY KEY, message VARCHAR)")
+        )
+
+        await connection.run_sync(migrate)
+
+        tables = await connection.run_sync(
+            lambda connection: inspect(connection).get_table_names()
+        )
+        revision = await connection.scalar(text("SELECT revision FROM projects"))
+
+    await engine.dispose()
+
+    assert tables == ["projects"]
+    assert revision == 0
+
+
+@pytest.mark.asyncio
+async def test_dict_cache_storage_expires():
+    """Test: expired values are not provided and are removed on later sets."""
+
+    cache = DictCacheStorage()
+    await cache.set("session", 1)
+    await cache.set("first", "diff", expire=0.01)
+    await cache.set("second", "diff", expire=0.01)
+    assert await cache.get("first") == "diff"
+
+    await asyncio.sleep(0.02)
+    assert await cache.get("first") is None
+
+    # Values never read again are removed too.
+    await cache.set("third", "diff", expire=60)
+    assert cache.storage == {"session": 1, "third": "diff"}
@@ -5,6 +5,7 @@ from server.auth.models import User
 from server.auth.schemas import UserDBSchema
 from server.projects.models import Project
 from server.projects.schemas import ProjectItemsSchema
+from server.projects.storage import content
 from server.root.auth import get_current_user
 from server.root.db import get_db
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -49,6 +50,9 @@ async def projects(
     """
 
     data = [_ async for _ in Project.by_author(current_user.id, db)]
+    for project in data:
+        project.content = await content(project, db)
+
     return {
         "data": data,
         "length": len(data),